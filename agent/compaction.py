@@ -0,0 +1,184 @@
+DEFAULT_BUDGET_TOKENS = 120_000
+DEFAULT_KEEP_RECENT = 6
+# Compacting down to a fraction of the budget, rather than just under it,
+# keeps the compacted prefix stable (and cacheable) for several turns.
+DEFAULT_TARGET_RATIO = 0.7
+# Rough average for English text and code; good enough for budgeting without
+# calling the token counting API.
+CHARS_PER_TOKEN = 3.5
+MIN_ELIDE_CHARS = 400
+KEEP_HEAD_CHARS = 200
+TEXT_KEEP_CHARS = 1000
+
+
+def _text_length(value):
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_text_length(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_text_length(v) for v in value)
+    if value is None:
+        return 0
+    return len(str(value))
+
+
+def estimate_tokens(value, chars_per_token=CHARS_PER_TOKEN):
+    return int(_text_length(value) / chars_per_token) + 1
+
+
+def _result_text(content):
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        texts = [block.get("text", "") for block in content if isinstance(block, dict)]
+        return "".join(texts)
+    return str(content)
+
+
+def _describe_tool_use(tool_use):
+    if tool_use is None:
+        return "tool"
+    tool_input = tool_use.get("input") or {}
+    if tool_use.get("name") == "bash":
+        return f"bash `{tool_input.get('command', '')[:80]}`"
+    command = tool_input.get("command", tool_use.get("name"))
+    return f"{command} {tool_input.get('path', '')}".strip()
+
+
+class ContextCompactor:
+    # Keeps a message history under a token budget without an API call.
+    # Once the estimate exceeds the budget, older turns are compacted in place
+    # in three passes, oldest first, until the target is reached:
+    #   1. views repeated later with identical output become a reference
+    #   2. large tool_result payloads are elided down to a short head
+    #   3. long text in old messages is cut to its head and tail
+    # The newest keep_recent messages are always left verbatim, and messages
+    # are never dropped, so tool_use/tool_result pairs stay intact.
+
+    def __init__(
+        self,
+        budget_tokens=DEFAULT_BUDGET_TOKENS,
+        keep_recent=DEFAULT_KEEP_RECENT,
+        target_ratio=DEFAULT_TARGET_RATIO,
+        chars_per_token=CHARS_PER_TOKEN,
+    ):
+        self.budget_tokens = budget_tokens
+        self.keep_recent = keep_recent
+        self.target_ratio = target_ratio
+        self.chars_per_token = chars_per_token
+
+    def estimate(self, messages):
+        return estimate_tokens(messages, self.chars_per_token)
+
+    def compact(self, messages):
+        # Returns (tokens_before, tokens_after) if anything was compacted
+        before = self.estimate(messages)
+        if self.budget_tokens is None or before <= self.budget_tokens:
+            return None
+        self._target = int(self.budget_tokens * self.target_ratio)
+        self._total = before
+        cutoff = max(len(messages) - self.keep_recent, 0)
+        tool_uses = self._tool_uses(messages)
+
+        self._collapse_repeated_views(messages, cutoff, tool_uses)
+        if self._total > self._target:
+            self._elide_tool_results(messages, cutoff, tool_uses)
+        if self._total > self._target:
+            self._shorten_text(messages, cutoff)
+        if self._total == before:
+            return None
+        return before, self._total
+
+    def _tool_uses(self, messages):
+        tool_uses = {}
+        for message in messages:
+            if message["role"] != "assistant" or isinstance(message["content"], str):
+                continue
+            for block in message["content"]:
+                if isinstance(block, dict) and block.get("type") == "tool_use":
+                    tool_uses[block["id"]] = block
+        return tool_uses
+
+    def _tool_results(self, messages, indices):
+        for index in indices:
+            message = messages[index]
+            if message["role"] != "user" or isinstance(message["content"], str):
+                continue
+            for position, block in enumerate(message["content"]):
+                if isinstance(block, dict) and block.get("type") == "tool_result":
+                    yield index, position, block
+
+    def _replace_block(self, messages, index, position, block):
+        # Content lists may be shared between messages, so never mutate them
+        message = dict(messages[index])
+        content = list(message["content"])
+        old_tokens = estimate_tokens(content[position], self.chars_per_token)
+        content[position] = block
+        message["content"] = content
+        messages[index] = message
+        self._total += estimate_tokens(block, self.chars_per_token) - old_tokens
+
+    def _collapse_repeated_views(self, messages, cutoff, tool_uses):
+        latest = {}
+        newest_first = range(len(messages) - 1, -1, -1)
+        for index, position, block in list(self._tool_results(messages, newest_first)):
+            tool_use = tool_uses.get(block.get("tool_use_id"))
+            if tool_use is None or (tool_use.get("input") or {}).get("command") != "view":
+                continue
+            tool_input = tool_use["input"]
+            key = (tool_input.get("path"), str(tool_input.get("view_range")))
+            text = _result_text(block.get("content"))
+            if index < cutoff and latest.get(key) == text and len(text) > KEEP_HEAD_CHARS:
+                reference = (
+                    f"[Output identical to a later view of {tool_input.get('path')}; "
+                    "the file was unchanged in between]"
+                )
+                self._replace_block(messages, index, position, dict(block, content=reference))
+            else:
+                latest[key] = text
+
+    def _elide_tool_results(self, messages, cutoff, tool_uses):
+        for index, position, block in list(self._tool_results(messages, range(cutoff))):
+            text = _result_text(block.get("content"))
+            if len(text) < MIN_ELIDE_CHARS:
+                continue
+            tool_use = tool_uses.get(block.get("tool_use_id"))
+            elided = (
+                text[:KEEP_HEAD_CHARS]
+                + f"\n[... {len(text) - KEEP_HEAD_CHARS} more characters of "
+                + f"{_describe_tool_use(tool_use)} output elided from an older turn]"
+            )
+            self._replace_block(messages, index, position, dict(block, content=elided))
+            if self._total <= self._target:
+                return
+
+    def _shorten(self, text):
+        if len(text) <= 2 * TEXT_KEEP_CHARS + MIN_ELIDE_CHARS:
+            return text
+        omitted = len(text) - 2 * TEXT_KEEP_CHARS
+        return (
+            text[:TEXT_KEEP_CHARS]
+            + f"\n[... {omitted} characters elided from an older turn ...]\n"
+            + text[-TEXT_KEEP_CHARS:]
+        )
+
+    def _shorten_text(self, messages, cutoff):
+        for index in range(cutoff):
+            message = messages[index]
+            if isinstance(message["content"], str):
+                shortened = self._shorten(message["content"])
+                if shortened != message["content"]:
+                    old_tokens = estimate_tokens(message["content"], self.chars_per_token)
+                    messages[index] = dict(message, content=shortened)
+                    self._total += estimate_tokens(shortened, self.chars_per_token) - old_tokens
+            else:
+                for position, block in enumerate(message["content"]):
+                    if isinstance(block, dict) and block.get("type") == "text":
+                        shortened = self._shorten(block["text"])
+                        if shortened != block["text"]:
+                            self._replace_block(
+                                messages, index, position, dict(block, text=shortened)
+                            )
+            if self._total <= self._target:
+                return
@@ -0,0 +1,44 @@
+import copy
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def cached_system(system_prompt):
+    return [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+
+
+def cached_tools(tools):
+    # A breakpoint on the last tool caches the whole tool list
+    tools = copy.deepcopy(tools)
+    tools[-1]["cache_control"] = CACHE_CONTROL
+    return tools
+
+
+def with_history_breakpoint(messages):
+    # Returns a copy of messages whose last block carries a cache breakpoint,
+    # so the next turn reads everything up to here from the cache. The
+    # history itself is left untouched: the API allows only a few breakpoints
+    # per request, so old ones must not accumulate.
+    if not messages:
+        return messages
+    last = dict(messages[-1])
+    content = last["content"]
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+    else:
+        content = list(content)
+    if not content:
+        return messages
+    content[-1] = dict(content[-1], cache_control=CACHE_CONTROL)
+    last["content"] = content
+    return messages[:-1] + [last]
+
+
+def format_usage(usage):
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    cache_miss = usage.input_tokens + cache_write
+    return (
+        f"Tokens: {cache_read} cache hit, {cache_miss} cache miss "
+        f"({cache_write} written to cache), {usage.output_tokens} output"
+    )
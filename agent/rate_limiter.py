@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import anthropic
+
+from agent.compaction import estimate_tokens
+from agent.streaming import stream_message
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+DEFAULT_INITIAL_CONCURRENCY = 4
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+# Back off before the API has to say no once the headers report less than
+# this share of a limit left
+LOW_REMAINING_RATIO = 0.1
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504, 529}
+THROTTLE_STATUS_CODES = {429, 529}
+ASYNC_POLL_INTERVAL = 0.05
+# Many calls in flight see the same throttling signal; halve only once per
+# cooldown so a single burst does not collapse concurrency to the minimum
+DECREASE_COOLDOWN = 1.0
+
+
+class TokenBucket:
+    # Refills continuously at per_minute / 60 per second up to per_minute.
+    # A bucket without a limit never makes anyone wait.
+
+    def __init__(self, per_minute=None):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity is None:
+            return
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        if self.capacity is None:
+            return 0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def sync(self, remaining, limit):
+        # The server's view wins: adopt its limit and never assume more is
+        # left than it reports
+        if limit is not None:
+            if self.capacity is None:
+                self.level = limit
+            self.capacity = limit
+        if remaining is not None and self.capacity is not None:
+            self.level = min(self.level, remaining)
+
+
+def _header_int(headers, name):
+    value = headers.get(name) if headers is not None else None
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def is_retryable(error):
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    return isinstance(error, anthropic.APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+
+def estimate_request_tokens(request):
+    return estimate_tokens([request.get("system"), request.get("tools"), request.get("messages")])
+
+
+class RequestScheduler:
+    # Shared gate in front of messages.create. Every call waits for a
+    # concurrency slot and for the request and input-token buckets, in
+    # priority order (lower first, FIFO within a priority). Concurrency adapts
+    # AIMD-style: +1 per window of successful calls, halved on a 429/529 or
+    # when the rate-limit headers show a limit nearly used up. Throttled calls
+    # pause everyone until retry-after, then retry with jittered backoff.
+
+    def __init__(
+        self,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        initial_concurrency=DEFAULT_INITIAL_CONCURRENCY,
+        max_concurrency=DEFAULT_MAX_CONCURRENCY,
+        min_concurrency=1,
+        max_retries=DEFAULT_MAX_RETRIES,
+        base_delay=DEFAULT_BASE_DELAY,
+        max_delay=DEFAULT_MAX_DELAY,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0}
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._tickets = itertools.count()
+
+    def configure(self, requests_per_minute=None, tokens_per_minute=None):
+        with self._cond:
+            if requests_per_minute is not None:
+                self.requests = TokenBucket(requests_per_minute)
+            if tokens_per_minute is not None:
+                self.tokens = TokenBucket(tokens_per_minute)
+            self._cond.notify_all()
+
+    def _try_acquire(self, ticket, tokens):
+        # Called with the lock held. Returns (acquired, seconds to wait or
+        # None to wait for a release)
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False, self.paused_until - now
+        if self._waiters[0] != ticket or self.in_flight >= int(self.concurrency):
+            return False, None
+        wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return False, wait
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        return True, None
+
+    def _enqueue(self, priority):
+        with self._cond:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiters, ticket)
+            return ticket
+
+    def _dequeue(self, ticket):
+        with self._cond:
+            self._waiters.remove(ticket)
+            heapq.heapify(self._waiters)
+            self._cond.notify_all()
+
+    def _acquire(self, priority, tokens):
+        ticket = self._enqueue(priority)
+        try:
+            with self._cond:
+                while True:
+                    acquired, timeout = self._try_acquire(ticket, tokens)
+                    if acquired:
+                        return
+                    self._cond.wait(timeout)
+        finally:
+            self._dequeue(ticket)
+
+    async def _async_acquire(self, priority, tokens):
+        # Polls rather than blocking a thread per waiting coroutine
+        ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    acquired, timeout = self._try_acquire(ticket, tokens)
+                if acquired:
+                    return
+                await asyncio.sleep(min(timeout or ASYNC_POLL_INTERVAL, ASYNC_POLL_INTERVAL))
+        finally:
+            self._dequeue(ticket)
+
+    def _release(self, headers=None, estimated_tokens=0, used_tokens=None):
+        with self._cond:
+            self.in_flight -= 1
+            self.stats["requests"] += 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - estimated_tokens)
+            low = self._sync_headers(headers)
+            if low:
+                self._decrease()
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / max(self.concurrency, 1)
+                )
+            self._cond.notify_all()
+
+    def _sync_headers(self, headers):
+        # Returns True if any reported limit is nearly used up
+        low = False
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "input-tokens")):
+            limit = _header_int(headers, f"anthropic-ratelimit-{kind}-limit")
+            remaining = _header_int(headers, f"anthropic-ratelimit-{kind}-remaining")
+            bucket.sync(remaining, limit)
+            if limit and remaining is not None and remaining < limit * LOW_REMAINING_RATIO:
+                low = True
+        return low
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= DECREASE_COOLDOWN:
+            self._last_decrease = now
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+
+    def _on_failure(self, error, attempt):
+        # Returns how long the failed call should wait before retrying
+        retry_after = _retry_after(error)
+        with self._cond:
+            self.in_flight -= 1
+            if isinstance(error, anthropic.APIStatusError) and error.status_code in THROTTLE_STATUS_CODES:
+                self.stats["throttled"] += 1
+                self._decrease()
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            self._cond.notify_all()
+        backoff = min(self.max_delay, self.base_delay * 2**attempt) * random.random()
+        return (retry_after or 0) + backoff
+
+    def _should_retry(self, error, attempt):
+        if is_retryable(error) and attempt < self.max_retries:
+            self.stats["retries"] += 1
+            return True
+        self.stats["errors"] += 1
+        return False
+
+    def run(self, fn, priority=PRIORITY_INTERACTIVE, estimated_tokens=0):
+        # fn() returns (result, response_headers, used_input_tokens)
+        for attempt in itertools.count():
+            self._acquire(priority, estimated_tokens)
+            try:
+                result, headers, used_tokens = fn()
+            except Exception as error:
+                delay = self._on_failure(error, attempt)
+                if not self._should_retry(error, attempt):
+                    raise
+                time.sleep(delay)
+                continue
+            self._release(headers, estimated_tokens, used_tokens)
+            return result
+
+    async def arun(self, fn, priority=PRIORITY_BATCH, estimated_tokens=0):
+        # Async variant: fn() returns an awaitable of the same triple
+        for attempt in itertools.count():
+            await self._async_acquire(priority, estimated_tokens)
+            try:
+                result, headers, used_tokens = await fn()
+            except asyncio.CancelledError:
+                with self._cond:
+                    self.in_flight -= 1
+                    self._cond.notify_all()
+                raise
+            except Exception as error:
+                delay = self._on_failure(error, attempt)
+                if not self._should_retry(error, attempt):
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self._release(headers, estimated_tokens, used_tokens)
+            return result
+
+    def create(self, client, priority=PRIORITY_INTERACTIVE, **request):
+        # client.beta.messages.create through the scheduler. The SDK's own
+        # retries are disabled so that every retry goes through the queue.
+        raw_client = client.with_options(max_retries=0)
+
+        def attempt():
+            raw = raw_client.beta.messages.with_raw_response.create(**request)
+            message = raw.parse()
+            return message, raw.headers, message.usage.input_tokens
+
+        return self.run(attempt, priority, estimate_request_tokens(request))
+
+    def stream(self, client, priority=PRIORITY_INTERACTIVE, on_tool_use=None, **request):
+        # agent.streaming.stream_message through the scheduler. Throttling is
+        # reported before the first event, so a retried stream has not
+        # dispatched any tool calls yet.
+        raw_client = client.with_options(max_retries=0)
+
+        def attempt():
+            responses = []
+            message = stream_message(
+                raw_client, on_tool_use=on_tool_use, on_response=responses.append, **request
+            )
+            return message, responses[0].headers, message.usage.input_tokens
+
+        return self.run(attempt, priority, estimate_request_tokens(request))
+
+    async def acreate(self, client, priority=PRIORITY_BATCH, **request):
+        raw_client = client.with_options(max_retries=0)
+
+        async def attempt():
+            raw = await raw_client.beta.messages.with_raw_response.create(**request)
+            message = raw.parse()
+            return message, raw.headers, message.usage.input_tokens
+
+        return await self.arun(attempt, priority, estimate_request_tokens(request))
+
+
+# One scheduler per process, so every editor loop and batch worker draws on
+# the same limits
+shared_scheduler = RequestScheduler()
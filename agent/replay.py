@@ -0,0 +1,302 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+CASSETTE_VERSION = 1
+
+
+def _jsonable(value):
+    # Requests hold plain dicts, but response content blocks may be SDK models
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"Cannot record {type(value).__name__}")
+
+
+class Cassette:
+    # A JSONL file of model calls and the user's chat inputs, in the order
+    # they happened. Appended to line by line, so an interrupted session
+    # still leaves a usable recording.
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _append(self, entry):
+        line = json.dumps(entry, default=_jsonable)
+        with self._lock, open(self.path, "a") as f:
+            f.write(line + "\n")
+
+    def start(self):
+        with self._lock, open(self.path, "w") as f:
+            f.write(json.dumps({"type": "header", "version": CASSETTE_VERSION, "created": time.time()}))
+            f.write("\n")
+
+    def record_message(self, request, message, latency, first_event_latency=None, stream=False):
+        self._append(
+            {
+                "type": "message",
+                "stream": stream,
+                "request": request,
+                "response": message,
+                "latency": latency,
+                "first_event_latency": first_event_latency,
+            }
+        )
+
+    def record_input(self, text):
+        self._append({"type": "input", "text": text})
+
+    def load(self):
+        with open(self.path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        if not entries or entries[0].get("type") != "header":
+            raise ValueError(f"{self.path} is not a cassette")
+        if entries[0]["version"] != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version {entries[0]['version']}")
+        return entries[1:]
+
+
+class _RecordingStream:
+    # Passes a real stream through and records its final message
+    def __init__(self, manager, cassette, request):
+        self.manager = manager
+        self.cassette = cassette
+        self.request = request
+        self.first_event_latency = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.stream = self.manager.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.manager.__exit__(*exc_info)
+
+    @property
+    def response(self):
+        return self.stream.response
+
+    def __iter__(self):
+        for event in self.stream:
+            if self.first_event_latency is None:
+                self.first_event_latency = time.perf_counter() - self.start
+            yield event
+
+    def get_final_message(self):
+        message = self.stream.get_final_message()
+        self.cassette.record_message(
+            self.request,
+            message,
+            time.perf_counter() - self.start,
+            self.first_event_latency,
+            stream=True,
+        )
+        return message
+
+
+class _RecordingRawResponse:
+    def __init__(self, raw, cassette, request, start):
+        self.raw = raw
+        self.headers = raw.headers
+        self.cassette = cassette
+        self.request = request
+        self.start = start
+
+    def parse(self):
+        message = self.raw.parse()
+        self.cassette.record_message(self.request, message, time.perf_counter() - self.start)
+        return message
+
+
+class _RecordingMessages:
+    def __init__(self, messages, cassette):
+        self.messages = messages
+        self.cassette = cassette
+
+    def create(self, **request):
+        start = time.perf_counter()
+        message = self.messages.create(**request)
+        self.cassette.record_message(request, message, time.perf_counter() - start)
+        return message
+
+    def stream(self, **request):
+        return _RecordingStream(self.messages.stream(**request), self.cassette, request)
+
+    @property
+    def with_raw_response(self):
+        messages, cassette = self.messages, self.cassette
+
+        class RawResponses:
+            def create(self, **request):
+                start = time.perf_counter()
+                raw = messages.with_raw_response.create(**request)
+                return _RecordingRawResponse(raw, cassette, request, start)
+
+        return RawResponses()
+
+
+class RecordingClient:
+    # Wraps an anthropic.Anthropic client, appending every beta.messages call
+    # (create, with_raw_response.create or stream) to a cassette
+
+    def __init__(self, client, cassette):
+        self.client = client
+        self.cassette = cassette
+        self.beta = SimpleNamespace(messages=_RecordingMessages(client.beta.messages, cassette))
+
+    @classmethod
+    def open(cls, client, path):
+        cassette = Cassette(path)
+        cassette.start()
+        return cls(client, cassette)
+
+    def with_options(self, **options):
+        return RecordingClient(self.client.with_options(**options), self.cassette)
+
+    def prompt(self, text):
+        user_input = input(text)
+        self.cassette.record_input(user_input)
+        return user_input
+
+
+class CassetteExhausted(Exception):
+    pass
+
+
+class _ReplayStream:
+    def __init__(self, message, delays):
+        self.message = message
+        self.delays = delays
+        # No rate-limit headers were recorded, as for replayed raw responses
+        self.response = SimpleNamespace(headers={})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __iter__(self):
+        # The recorded wait for the first event, then the rest of the
+        # latency spread evenly over the content blocks, so tool calls are
+        # dispatched at roughly the points they were while recording
+        first, per_block = self.delays
+        time.sleep(first)
+        for block in self.message.content:
+            time.sleep(per_block)
+            if block.type == "text":
+                yield SimpleNamespace(type="text", text=block.text)
+            yield SimpleNamespace(type="content_block_stop", content_block=block)
+        yield SimpleNamespace(type="message_stop")
+
+    def get_final_message(self):
+        return self.message
+
+
+class ReplayClient:
+    # Serves the responses of a cassette in the order they were recorded, in
+    # place of an anthropic.Anthropic client. Requests are not matched
+    # against the recording, since tool output may differ between runs;
+    # requests whose message count differs from the recording are counted in
+    # mismatches. latency is "recorded" to wait as long as the original call
+    # took (times latency_scale), or a fixed number of seconds per call.
+
+    def __init__(self, entries, latency="recorded", latency_scale=1.0):
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self._messages = [entry for entry in entries if entry["type"] == "message"]
+        self._inputs = [entry["text"] for entry in entries if entry["type"] == "input"]
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.mismatches = 0
+        self.beta = SimpleNamespace(messages=_ReplayMessages(self))
+
+    @classmethod
+    def open(cls, path, latency="recorded", latency_scale=1.0):
+        return cls(Cassette(path).load(), latency, latency_scale)
+
+    def with_options(self, **options):
+        return self
+
+    def _next(self, request):
+        from anthropic.types.beta import BetaMessage
+
+        with self._lock:
+            if self.calls >= len(self._messages):
+                raise CassetteExhausted(f"The cassette has only {len(self._messages)} responses")
+            entry = self._messages[self.calls]
+            self.calls += 1
+            if len(request.get("messages", ())) != len(entry["request"].get("messages", ())):
+                self.mismatches += 1
+        return BetaMessage.model_validate(entry["response"]), entry
+
+    def _latency(self, entry):
+        if self.latency == "recorded":
+            return (entry.get("latency") or 0) * self.latency_scale
+        return float(self.latency)
+
+    def create(self, **request):
+        message, entry = self._next(request)
+        time.sleep(self._latency(entry))
+        return message
+
+    def stream(self, **request):
+        message, entry = self._next(request)
+        total = self._latency(entry)
+        if self.latency == "recorded" and entry.get("first_event_latency") is not None:
+            first = entry["first_event_latency"] * self.latency_scale
+        else:
+            first = 0.0
+        per_block = max(total - first, 0.0) / max(len(message.content), 1)
+        return _ReplayStream(message, (first, per_block))
+
+    def prompt(self, text):
+        # The recorded chat inputs, then /quit
+        with self._lock:
+            user_input = self._inputs.pop(0) if self._inputs else "/quit"
+        print(text + user_input)
+        return user_input
+
+
+class _ReplayMessages:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, **request):
+        return self.client.create(**request)
+
+    def stream(self, **request):
+        return self.client.stream(**request)
+
+    @property
+    def with_raw_response(self):
+        client = self.client
+
+        class RawResponses:
+            def create(self, **request):
+                message = client.create(**request)
+                return SimpleNamespace(headers={}, parse=lambda: message)
+
+        return RawResponses()
+
+
+def model_client(config, client_factory):
+    # The client an editor should use: a replay of config["replay_cassette"],
+    # a recording to config["record_cassette"], or client_factory() as is
+    if config.get("replay_cassette"):
+        return ReplayClient.open(
+            config["replay_cassette"],
+            config.get("replay_latency", "recorded"),
+            config.get("replay_latency_scale", 1.0),
+        )
+    client = client_factory()
+    if config.get("record_cassette"):
+        return RecordingClient.open(client, config["record_cassette"])
+    return client
+
+
+def prompt_user(client, text):
+    # input(), recorded to or replayed from the cassette when there is one
+    prompt = getattr(client, "prompt", None)
+    return prompt(text) if prompt is not None else input(text)
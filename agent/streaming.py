@@ -0,0 +1,24 @@
+def print_text_delta(text):
+    print(text, end="", flush=True)
+
+
+def stream_message(client, on_text=print_text_delta, on_tool_use=None, on_response=None, **request):
+    # Streams one model response and returns the final message. Text deltas go
+    # to on_text as they arrive, and each tool_use block is handed to
+    # on_tool_use as soon as its input JSON is complete, while the rest of the
+    # response is still being generated. on_response, if given, gets the HTTP
+    # response as soon as the stream opens, e.g. for its headers.
+    with client.beta.messages.stream(**request) as stream:
+        if on_response is not None:
+            on_response(stream.response)
+        for event in stream:
+            if event.type == "text":
+                if on_text is not None:
+                    on_text(event.text)
+            elif event.type == "content_block_stop":
+                if event.content_block.type == "text":
+                    if on_text is not None:
+                        on_text("\n")
+                elif event.content_block.type == "tool_use" and on_tool_use is not None:
+                    on_tool_use(event.content_block)
+        return stream.get_final_message()
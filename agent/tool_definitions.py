@@ -0,0 +1,118 @@
+# Custom tools shared by both editors, next to the built-in text editor and
+# bash tools. Each maps onto a TextEditTools method of the same name and a
+# tools service endpoint.
+
+SEARCH_TOOL = {
+    "name": "search",
+    "description": (
+        "Search the project's files for a literal string or a regular expression "
+        "and return matching lines as path:line: text. Much faster and cheaper "
+        "than viewing files one by one or running grep through bash; use it to "
+        "find definitions, usages and strings before opening files."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "The text or regular expression to search for",
+            },
+            "path": {
+                "type": "string",
+                "description": "Directory to search in, defaults to /repo/",
+            },
+            "regex": {
+                "type": "boolean",
+                "description": "Treat query as a Python regular expression",
+            },
+            "ignore_case": {
+                "type": "boolean",
+                "description": "Match case-insensitively",
+            },
+            "max_results": {
+                "type": "integer",
+                "description": "Maximum number of matching lines to return (default 50)",
+            },
+        },
+        "required": ["query"],
+    },
+}
+
+VIEW_MANY_TOOL = {
+    "name": "view_many",
+    "description": (
+        "View several files, or line ranges of them, in one call. Output is "
+        "shared fairly between the files, so a large file is clipped rather "
+        "than hiding the others; view it on its own or by range for the rest. "
+        "Errors for one file are reported in its place."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "files": {
+                "type": "array",
+                "description": "The files to view, at most 50",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "path": {
+                            "type": "string",
+                            "description": "The file to view, e.g. /repo/src/app.py",
+                        },
+                        "view_range": {
+                            "type": "array",
+                            "items": {"type": "integer"},
+                            "description": "Optional [start_line, end_line]; -1 as end_line reads to the end",
+                        },
+                    },
+                    "required": ["path"],
+                },
+            },
+        },
+        "required": ["files"],
+    },
+}
+
+OUTLINE_TOOL = {
+    "name": "outline",
+    "description": (
+        "List the classes, functions and methods of a Python, JavaScript or "
+        "TypeScript file with their line ranges. Use it before viewing a large "
+        "file, then view only the line ranges you need."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "path": {
+                "type": "string",
+                "description": "The file to outline, e.g. /repo/src/app.py",
+            },
+        },
+        "required": ["path"],
+    },
+}
+
+APPLY_PATCH_TOOL = {
+    "name": "apply_patch",
+    "description": (
+        "Apply a unified diff (as produced by diff -u or git diff) to one or more "
+        "files in a single call. Hunks are located by their context, so line "
+        "numbers may be approximate. Either every hunk applies or nothing is "
+        "changed. Use --- /dev/null to create a file and +++ /dev/null to delete "
+        "one. undo_edit reverts the patch one file at a time. Prefer it over "
+        "several str_replace calls for multi-hunk or multi-file edits."
+    ),
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "patch": {
+                "type": "string",
+                "description": (
+                    "The unified diff; paths are relative to /repo/ (a/ and b/ "
+                    "prefixes are accepted)"
+                ),
+            },
+        },
+        "required": ["patch"],
+    },
+}
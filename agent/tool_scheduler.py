@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from tools.patch import patch_paths
+
+DEFAULT_MAX_WORKERS = 8
+READ_ONLY_COMMANDS = {"view", "list_directory"}
+
+
+class ToolAccess:
+    def __init__(self, paths=(), write=False, barrier=False):
+        self.paths = set(paths)
+        self.write = write
+        self.barrier = barrier
+
+
+def _normalize(path):
+    path = path or ""
+    if path.startswith("/repo/"):
+        path = path[len("/repo/") :]
+    return os.path.normpath(path.lstrip("/")) if path.strip("/") else "."
+
+
+def tool_access(name, tool_input):
+    # What a tool call touches: read-only calls on a path, writes to a path,
+    # or a barrier (bash, unknown tools) that may touch anything.
+    if name == "file_delete":
+        return ToolAccess([_normalize(tool_input.get("path"))], write=True)
+    if name == "apply_patch":
+        paths = patch_paths(tool_input.get("patch", ""))
+        if paths:
+            return ToolAccess([_normalize(path) for path in paths], write=True)
+    if name == "view_many":
+        return ToolAccess(_normalize(spec.get("path")) for spec in tool_input.get("files", []))
+    if name in ("search", "outline"):
+        return ToolAccess([_normalize(tool_input.get("path"))])
+    if name == "str_replace_editor":
+        command = tool_input.get("command")
+        return ToolAccess(
+            [_normalize(tool_input.get("path"))],
+            write=command not in READ_ONLY_COMMANDS,
+        )
+    return ToolAccess(write=True, barrier=True)
+
+
+def _overlaps(a, b):
+    if a == "." or b == "." or a == b:
+        return True
+    return a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+
+def _conflicts(earlier, later):
+    if earlier.barrier or later.barrier:
+        return True
+    if not (earlier.write or later.write):
+        return False
+    return any(_overlaps(a, b) for a in earlier.paths for b in later.paths)
+
+
+class ToolScheduler:
+    # Runs tool calls on a thread pool. A call starts only after every earlier
+    # call it conflicts with has finished: reads of the same path run in
+    # parallel, writes stay in submission order with anything touching an
+    # overlapping path, and barriers wait for (and block) everything.
+    #
+    # Waiting happens inside the worker, which is safe because the pool
+    # dequeues in FIFO order: a call only ever waits on calls submitted
+    # before it, and those have already been picked up by a worker.
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._submitted = []
+
+    def submit(self, access, fn, *args):
+        self._submitted = [(f, a) for f, a in self._submitted if not f.done()]
+        dependencies = [f for f, a in self._submitted if _conflicts(a, access)]
+
+        def run():
+            if dependencies:
+                wait(dependencies)
+            return fn(*args)
+
+        future = self.executor.submit(run)
+        self._submitted.append((future, access))
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
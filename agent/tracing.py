@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+import uuid
+
+from agent.compaction import estimate_tokens
+
+
+class TurnSpan:
+    # Timing and token usage of one model turn: the model request, the tool
+    # calls it asked for, and for tools run through the tools service, how
+    # much of each call was spent in the service (from its Server-Timing
+    # header) rather than on the network. Tool calls may run on scheduler
+    # threads, so they are recorded under a lock.
+
+    def __init__(self, session_id, turn, messages):
+        self.session_id = session_id
+        self.turn = turn
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._model_end = None
+        self._lock = threading.Lock()
+        self.history_messages = len(messages)
+        self.history_tokens = estimate_tokens(messages)
+        self.usage = {}
+        self.stop_reason = None
+        self.tool_calls = []
+        self.service_seconds = 0.0
+        self.service_round_trip_seconds = 0.0
+
+    def model_done(self, response):
+        self._model_end = time.perf_counter()
+        usage = response.usage
+        self.usage = {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0,
+            "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None)
+            or 0,
+        }
+        self.stop_reason = response.stop_reason
+
+    def timed(self, name, fn):
+        # Wraps fn so each call is recorded as a tool call named name
+        def run(*args, **kwargs):
+            start = time.perf_counter()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                end = time.perf_counter()
+                with self._lock:
+                    self.tool_calls.append(
+                        {
+                            "name": name,
+                            "start": round(start - self._start, 6),
+                            "seconds": round(end - start, 6),
+                            "ok": ok,
+                        }
+                    )
+
+        return run
+
+    def service_call(self, round_trip_seconds, server_timing=None, server_seconds=0.0):
+        # server_timing is the Server-Timing header, "app;dur=<ms>", of an
+        # HTTP call; the channel reports server_seconds directly
+        for metric in (server_timing or "").split(","):
+            name, _, params = metric.strip().partition(";")
+            if name == "app" and params.startswith("dur="):
+                server_seconds = float(params[4:]) / 1000
+        with self._lock:
+            self.service_round_trip_seconds += round_trip_seconds
+            self.service_seconds += server_seconds
+
+    def to_dict(self, end):
+        model_end = self._model_end if self._model_end is not None else end
+        with self._lock:
+            tool_calls = list(self.tool_calls)
+            network = max(self.service_round_trip_seconds - self.service_seconds, 0.0)
+            service = self.service_seconds
+        return {
+            "type": "turn",
+            "session": self.session_id,
+            "turn": self.turn,
+            "started_at": self.started_at,
+            "turn_seconds": round(end - self._start, 6),
+            "model_seconds": round(model_end - self._start, 6),
+            # Time the turn waited on tools after the model finished; tools
+            # started while a response was still streaming overlap the model
+            "tool_wait_seconds": round(end - model_end, 6),
+            "tool_seconds": round(sum(call["seconds"] for call in tool_calls), 6),
+            "service_seconds": round(service, 6),
+            "network_seconds": round(network, 6),
+            "stop_reason": self.stop_reason,
+            **self.usage,
+            "history_messages": self.history_messages,
+            "history_tokens": self.history_tokens,
+            "tool_calls": tool_calls,
+        }
+
+
+class Tracer:
+    # Writes one JSON line per finished turn to path. Without a path spans
+    # are still built (they are cheap) but not exported.
+
+    def __init__(self, path=None):
+        self.path = path
+        self.session_id = uuid.uuid4().hex[:12]
+        self.turns = 0
+        self._lock = threading.Lock()
+
+    def turn(self, messages):
+        self.turns += 1
+        return TurnSpan(self.session_id, self.turns, messages)
+
+    def finish(self, span):
+        record = span.to_dict(time.perf_counter())
+        if self.path:
+            with self._lock, open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        return record
+
+
+def summarize(path):
+    # Totals of a JSONL trace file, to see where a session's time went
+    totals = {}
+    turns = 0
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("type") != "turn":
+                continue
+            turns += 1
+            for key, value in record.items():
+                if key.endswith(("_seconds", "_tokens")) and isinstance(value, (int, float)):
+                    totals[key] = totals.get(key, 0) + value
+    return {"turns": turns, **{key: round(value, 3) for key, value in totals.items()}}
+
+
+if __name__ == "__main__":
+    import sys
+
+    print(json.dumps(summarize(sys.argv[1]), indent=2))
@@ -3,87 +3,194 @@ from dotenv import load_dotenv
 import yaml
 import sys
 from anthropic.types.beta import BetaTextBlock, BetaToolUseBlock
+from agent.compaction import ContextCompactor
+from agent.rate_limiter import PRIORITY_INTERACTIVE, shared_scheduler
+from agent.tool_definitions import APPLY_PATCH_TOOL, OUTLINE_TOOL, SEARCH_TOOL, VIEW_MANY_TOOL
+from agent.tool_scheduler import ToolScheduler, tool_access
+from agent.replay import model_client, prompt_user
+from agent.tracing import Tracer
+from agent.prompt_cache import cached_system, cached_tools, with_history_breakpoint, format_usage
+from tools.dir_index import parse_ignore_names
 from tools.text_edit_tools import TextEditTools
+import os
 import readline
 
 load_dotenv()
 
-client = anthropic.Anthropic()
+# Names left out of listings and searches, as for the tools service
+IGNORE_NAMES = parse_ignore_names(os.environ.get("TEXT_EDITOR_IGNORE"))
+
+# Created in main(): the API client, or a recording or replaying stand-in
+# when the config names a cassette (see agent.replay)
+client = None
 global_history = []
+# (snapshot id, history length) taken as each goal starts, for /rollback
+checkpoints = []
+
+with open("system_prompt.txt", "r") as f:
+    SYSTEM_PROMPT = f.read()
+
+TOOLS = [
+    {
+        "type": "text_editor_20241022",
+        "name": "str_replace_editor"
+    },
+    {
+        "name": "file_delete",
+        "description": "Delete a file",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "path": {
+                    "type": "string",
+                    "description": "The path to the file to delete"
+                }
+            },
+            "required": ["path"],
+        },
+    },
+    SEARCH_TOOL,
+    VIEW_MANY_TOOL,
+    OUTLINE_TOOL,
+    APPLY_PATCH_TOOL,
+]
+
+# System prompt and tool definitions never change, so both carry a cache
+# breakpoint; the history gets one on its latest message every turn.
+CACHED_SYSTEM = cached_system(SYSTEM_PROMPT)
+CACHED_TOOLS = cached_tools(TOOLS)
+
+# Token budget for the history sent each turn, see main() for overriding it
+compactor = ContextCompactor()
+# Per-turn timing and token spans, written as JSONL when trace_file is set
+tracer = Tracer()
+
+def run_tool(tools, name, tool_input):
+    if name == "file_delete":
+        return tools.delete(tool_input['path'])
+    if name == "outline":
+        return tools.outline(tool_input['path'])
+    if name == "view_many":
+        return tools.view_many(tool_input['files'])
+    if name == "apply_patch":
+        return tools.apply_patch(tool_input['patch'])
+    if name == "search":
+        return tools.search(
+            tool_input['query'],
+            tool_input.get('path', '/repo/'),
+            tool_input.get('regex', False),
+            tool_input.get('ignore_case', False),
+            tool_input.get('max_results'),
+        )
+    command = tool_input['command']
+    if command == 'view':
+        return tools.view(tool_input['path'], tool_input.get('view_range'))
+    elif command == 'create':
+        return tools.create(tool_input['path'], tool_input['file_text'])
+    elif command == 'str_replace':
+        return tools.str_replace(tool_input['path'], tool_input['old_str'], tool_input['new_str'])
+    elif command == 'insert':
+        return tools.insert(tool_input['path'], tool_input['insert_line'], tool_input['new_str'])
+    elif command == 'undo_edit':
+        return tools.undo_edit(tool_input['path'])
+
+def checkpoint_label(input_goal):
+    return input_goal.strip().split('\n')[0][:80]
 
-def process_goal(input_goal, start_dir='.'):
-    tools = TextEditTools(start_dir)
-    files = tools.list_directory('.', 6)
-    system_prompt = open("system_prompt.txt", "r").read()
+def rollback(start_dir):
+    # Undoes the last goal: the whole workspace, including what bash changed,
+    # goes back to the checkpoint taken as the goal started, and the goal
+    # leaves the history
+    if not checkpoints:
+        print("Nothing to roll back")
+        return
+    snapshot_id, history_length = checkpoints.pop()
+    result = TextEditTools(start_dir, ignore_names=IGNORE_NAMES).restore(snapshot_id)
+    print(result)
+    if result.startswith('Error'):
+        checkpoints.append((snapshot_id, history_length))
+    else:
+        del global_history[history_length:]
+
+def process_goal(input_goal, start_dir='.', stream=False):
+    tools = TextEditTools(start_dir, ignore_names=IGNORE_NAMES)
+    snapshot = tools.checkpoint(checkpoint_label(input_goal))
+    if isinstance(snapshot, dict):
+        checkpoints.append((snapshot['id'], len(global_history)))
+    else:
+        print(snapshot)
     input_goal_message = {"role": "user", "content": input_goal}
 
     global_history.append(input_goal_message)
+    compactor.compact(global_history)
     message_history = global_history.copy()
+    # Independent tool calls run in parallel; conflicting ones keep their order
+    scheduler = ToolScheduler()
 
     done = False
     while not done:
-        response = client.beta.messages.create(
+        compacted = compactor.compact(message_history)
+        if compacted:
+            print(f"Compacted context from ~{compacted[0]} to ~{compacted[1]} tokens")
+        pending = {}
+        span = tracer.turn(message_history)
+
+        def dispatch(block):
+            access = tool_access(block.name, block.input)
+            pending[block.id] = scheduler.submit(
+                access, span.timed(block.name, run_tool), tools, block.name, block.input
+            )
+
+        request = dict(
             model="claude-3-5-sonnet-20241022",
-            system=system_prompt,
+            system=CACHED_SYSTEM,
             max_tokens=4095,
-            tools=[
-                {
-                    "type": "text_editor_20241022",
-                    "name": "str_replace_editor"
-                },
-                {
-                    "name": "file_delete",
-                    "description": "Delete a file",
-                    "input_schema": {
-                        "type": "object",
-                        "properties": {
-                            "path": {
-                                "type": "string",
-                                "description": "The path to the file to delete"
-                            }
-                        },
-                        "required": ["path"],
-                    },
-                }
-            ],
-            messages=message_history,
+            tools=CACHED_TOOLS,
+            messages=with_history_breakpoint(message_history),
             betas=["computer-use-2024-10-22"],
         )
+        if stream:
+            # Tools start running as soon as each tool_use block is complete
+            response = shared_scheduler.stream(
+                client, priority=PRIORITY_INTERACTIVE, on_tool_use=dispatch, **request
+            )
+        else:
+            response = shared_scheduler.create(client, priority=PRIORITY_INTERACTIVE, **request)
+        span.model_done(response)
+        print(format_usage(response.usage))
         if response.stop_reason=='tool_use':
             messages = response.content
             content = []
             for message in messages:
                 if isinstance(message, BetaTextBlock):
                     content.append({"type": "text", "text": message.text})
-                    print(message.text)
+                    if not stream:
+                        print(message.text)
                 if isinstance(message, BetaToolUseBlock):
-                    tool_input = message.input
-                    content.append({"type": "tool_use", "id": message.id, "name": message.name, "input": tool_input})
-                    message_history.append({"role": "assistant", "content": content})
-                    if message.name == "file_delete":
-                        result = tools.delete(tool_input['path'])
-                    else:
-                        command = tool_input['command']
-                        if command == 'view':
-                            result = tools.view(tool_input['path'], tool_input.get('view_range'))
-                        elif command == 'create':
-                            result = tools.create(tool_input['path'], tool_input['file_text'])
-                        elif command == 'str_replace':
-                            result = tools.str_replace(tool_input['path'], tool_input['old_str'], tool_input['new_str'])
-                        elif command == 'insert':
-                            result = tools.insert(tool_input['path'], tool_input['insert_line'], tool_input['new_str'])
-                        elif command == 'undo_edit':
-                            result = tools.undo_edit(tool_input['path'])
-                    message_history.append({"role": "user", "content": [{"type": "tool_result", "tool_use_id": message.id, "content": result}]})
+                    content.append({"type": "tool_use", "id": message.id, "name": message.name, "input": message.input})
+                    if message.id not in pending:
+                        dispatch(message)
+            message_history.append({"role": "assistant", "content": content})
+            # Results are collected in tool_use order, whatever order they finished in
+            tool_results = []
+            for block in content:
+                if block["type"] == "tool_use":
+                    result = pending[block["id"]].result()
+                    tool_results.append({"type": "tool_result", "tool_use_id": block["id"], "content": result})
                     print(result)
+            message_history.append({"role": "user", "content": tool_results})
+        tracer.finish(span)
 
         if response.stop_reason in ['end_turn', 'max_tokens', 'stop_sequence']:
             print("Stopped: ", response.stop_reason)
-            print(response.content[0].text)
+            if not stream:
+                print(response.content[0].text)
             done = True
             global_history.append( {"role": "assistant", "content": response.content[0].text} )
+    scheduler.shutdown()
 
 def main():
+    global client
     config_path = sys.argv[1] if len(sys.argv) > 1 else 'config.yaml'
     
     with open("yamls/" + config_path, 'r') as f:
@@ -91,24 +198,31 @@ def main():
 
     repo_path = config['repo_path']
     input_goal = config['input_goal']
+    compactor.budget_tokens = config.get('context_budget_tokens', compactor.budget_tokens)
+    stream = '--stream' in sys.argv or config.get('stream', False)
+    shared_scheduler.configure(config.get('requests_per_minute'), config.get('tokens_per_minute'))
+    tracer.path = config.get('trace_file')
+    client = model_client(config, anthropic.Anthropic)
 
     if config.get('include_files', True):
         input_goal += f"""
 
 Here's a list of the existing files in the project:
-{TextEditTools(repo_path).list_directory('.', 6)}
+{TextEditTools(repo_path, ignore_names=IGNORE_NAMES).list_directory('.', 6)}
 
 Review the existing files and create or update files as needed to implement the site.
 """
     # chat loop
-    process_goal(input_goal, repo_path)
+    process_goal(input_goal, repo_path, stream)
     user_quit = False
     while not user_quit:
-        user_input = input("> ")
+        user_input = prompt_user(client, "> ")
         if user_input == "/quit":
             user_quit = True
+        elif user_input == "/rollback":
+            rollback(repo_path)
         else:
-            process_goal(user_input, repo_path)
+            process_goal(user_input, repo_path, stream)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,197 @@
+import anthropic
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import yaml
+from anthropic.types.beta import BetaTextBlock, BetaToolUseBlock
+from agent.compaction import ContextCompactor, DEFAULT_BUDGET_TOKENS
+from agent.prompt_cache import with_history_breakpoint
+from agent.rate_limiter import PRIORITY_BATCH, shared_scheduler
+from agent.tool_scheduler import ToolScheduler, tool_access
+from anthropic_editor import CACHED_SYSTEM, CACHED_TOOLS, IGNORE_NAMES, run_tool
+from tools.text_edit_tools import TextEditTools
+
+load_dotenv()
+
+DEFAULT_WORKERS = 4
+DEFAULT_GOAL_TIMEOUT = 1800
+DEFAULT_REPORT_PATH = "batch_report.jsonl"
+
+
+def load_goals(paths):
+    # Goals come from JSONL files (one goal per line) or from YAML configs in
+    # the same format the interactive editors read from yamls/.
+    goals = []
+    for path in paths:
+        if path.endswith(".jsonl"):
+            with open(path, "r") as f:
+                for line_number, line in enumerate(f, 1):
+                    if line.strip():
+                        goals.append(goal_from_entry(json.loads(line), f"{path}:{line_number}"))
+        else:
+            if not os.path.exists(path) and os.path.exists(os.path.join("yamls", path)):
+                path = os.path.join("yamls", path)
+            with open(path, "r") as f:
+                goals.append(goal_from_entry(yaml.safe_load(f), path))
+
+    directories = {}
+    for goal in goals:
+        if goal["repo_path"] in directories:
+            raise ValueError(
+                f"Goals {directories[goal['repo_path']]} and {goal['id']} both use "
+                f"repo_path {goal['repo_path']}; each goal needs its own directory"
+            )
+        directories[goal["repo_path"]] = goal["id"]
+    return goals
+
+
+def goal_from_entry(entry, source):
+    goal_id = str(entry.get("id") or entry.get("request_id") or source)
+    if "input_goal" in entry:
+        input_goal = entry["input_goal"]
+    else:
+        input_goal = "\n\n".join(part for part in (entry.get("title"), entry.get("body")) if part)
+    repo_path = entry.get("repo_path") or re.sub(r"[^A-Za-z0-9_.-]", "_", goal_id)
+    return {
+        "id": goal_id,
+        "repo_path": repo_path,
+        "input_goal": input_goal,
+        "include_files": entry.get("include_files", True),
+    }
+
+
+async def run_goal(client, goal, stats, budget_tokens):
+    # The loop of anthropic_editor.process_goal, on an async client and with a
+    # history and TextEditTools of its own.
+    tools = TextEditTools(goal["repo_path"], ignore_names=IGNORE_NAMES)
+    input_goal = goal["input_goal"]
+    if goal["include_files"]:
+        listing = await asyncio.to_thread(tools.list_directory, ".", 6)
+        input_goal += f"""
+
+Here's a list of the existing files in the project:
+{listing}
+
+Review the existing files and create or update files as needed to execute the goal.
+"""
+    messages = [{"role": "user", "content": input_goal}]
+    compactor = ContextCompactor(budget_tokens=budget_tokens)
+    scheduler = ToolScheduler()
+    try:
+        while True:
+            compactor.compact(messages)
+            response = await shared_scheduler.acreate(
+                client,
+                priority=PRIORITY_BATCH,
+                model="claude-3-5-sonnet-20241022",
+                system=CACHED_SYSTEM,
+                max_tokens=4095,
+                tools=CACHED_TOOLS,
+                messages=with_history_breakpoint(messages),
+                betas=["computer-use-2024-10-22"],
+            )
+            stats["turns"] += 1
+            usage = response.usage
+            stats["input_tokens"] += usage.input_tokens
+            stats["output_tokens"] += usage.output_tokens
+            stats["cache_read_input_tokens"] += usage.cache_read_input_tokens or 0
+            stats["cache_creation_input_tokens"] += usage.cache_creation_input_tokens or 0
+
+            if response.stop_reason != "tool_use":
+                texts = [block.text for block in response.content if isinstance(block, BetaTextBlock)]
+                return response.stop_reason, "\n".join(texts)
+
+            content = []
+            pending = []
+            for block in response.content:
+                if isinstance(block, BetaTextBlock):
+                    content.append({"type": "text", "text": block.text})
+                if isinstance(block, BetaToolUseBlock):
+                    content.append(
+                        {"type": "tool_use", "id": block.id, "name": block.name, "input": block.input}
+                    )
+                    future = scheduler.submit(
+                        tool_access(block.name, block.input), run_tool, tools, block.name, block.input
+                    )
+                    pending.append((block.id, asyncio.wrap_future(future)))
+            messages.append({"role": "assistant", "content": content})
+            tool_results = []
+            for tool_use_id, future in pending:
+                result = await future
+                stats["tool_calls"] += 1
+                tool_results.append(
+                    {"type": "tool_result", "tool_use_id": tool_use_id, "content": str(result)}
+                )
+            messages.append({"role": "user", "content": tool_results})
+    finally:
+        # Do not block the event loop on tool calls left running by a timeout
+        scheduler.shutdown(wait=False)
+
+
+async def run_batch(goals, workers, timeout, report_path, budget_tokens):
+    client = anthropic.AsyncAnthropic()
+    queue = asyncio.Queue()
+    for goal in goals:
+        queue.put_nowait(goal)
+    report = open(report_path, "a")
+
+    async def worker():
+        while not queue.empty():
+            goal = queue.get_nowait()
+            stats = {
+                "turns": 0,
+                "tool_calls": 0,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "cache_read_input_tokens": 0,
+                "cache_creation_input_tokens": 0,
+            }
+            record = {"id": goal["id"], "repo_path": goal["repo_path"]}
+            started = time.perf_counter()
+            try:
+                stop_reason, final_text = await asyncio.wait_for(
+                    run_goal(client, goal, stats, budget_tokens), timeout
+                )
+                record.update(status="ok", stop_reason=stop_reason, result=final_text)
+            except asyncio.TimeoutError:
+                record.update(status="timeout")
+            except Exception as e:
+                record.update(status="error", error=f"{type(e).__name__}: {e}")
+            record["wall_clock_s"] = round(time.perf_counter() - started, 3)
+            record.update(stats)
+            report.write(json.dumps(record) + "\n")
+            report.flush()
+            print(f"[{goal['id']}] {record['status']} in {record['wall_clock_s']}s")
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker() for _ in range(min(workers, len(goals)))))
+    finally:
+        report.close()
+    print(f"Ran {len(goals)} goals in {time.perf_counter() - started:.1f}s, report in {report_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many goals headlessly and concurrently")
+    parser.add_argument("sources", nargs="+", help="JSONL goal files and/or YAML configs")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_GOAL_TIMEOUT, help="seconds per goal")
+    parser.add_argument("--report", default=DEFAULT_REPORT_PATH)
+    parser.add_argument("--context-budget-tokens", type=int, default=DEFAULT_BUDGET_TOKENS)
+    parser.add_argument("--rpm", type=int, help="API requests per minute to stay under")
+    parser.add_argument("--tpm", type=int, help="API input tokens per minute to stay under")
+    args = parser.parse_args()
+    shared_scheduler.configure(args.rpm, args.tpm)
+
+    goals = load_goals(args.sources)
+    asyncio.run(
+        run_batch(goals, args.workers, args.timeout, args.report, args.context_budget_tokens)
+    )
+
+
+if __name__ == "__main__":
+    main()
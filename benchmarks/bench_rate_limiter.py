@@ -0,0 +1,91 @@
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import anthropic
+
+from agent.rate_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, RequestScheduler
+from benchmarks.stub_api_server import start_stub_server
+
+REQUEST = dict(
+    model="stub",
+    max_tokens=16,
+    messages=[{"role": "user", "content": "hello"}],
+    betas=["computer-use-2024-10-22"],
+)
+
+
+def naive(client, count, threads):
+    # Every thread fires as fast as it can, relying on the SDK's retries
+    def call(_):
+        try:
+            client.beta.messages.create(**REQUEST)
+            return True
+        except anthropic.APIStatusError:
+            return False
+
+    with ThreadPoolExecutor(threads) as pool:
+        return sum(pool.map(call, range(count)))
+
+
+def scheduled(client, scheduler, count, threads):
+    finished = {PRIORITY_INTERACTIVE: [], PRIORITY_BATCH: []}
+
+    def call(i):
+        priority = PRIORITY_INTERACTIVE if i % 10 == 0 else PRIORITY_BATCH
+        scheduler.create(client, priority=priority, **REQUEST)
+        finished[priority].append(time.perf_counter())
+        return True
+
+    with ThreadPoolExecutor(threads) as pool:
+        ok = sum(pool.map(call, range(count)))
+    return ok, finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate-limit scheduler against a 429-ing stub")
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--rpm", type=int, default=20, help="stub quota per window")
+    parser.add_argument("--window", type=float, default=2.0, help="stub window in seconds")
+    args = parser.parse_args()
+    results = {}
+
+    server, url, limits = start_stub_server(args.rpm, args.window)
+    client = anthropic.Anthropic(base_url=url, api_key="stub", max_retries=2)
+    start = time.perf_counter()
+    ok = naive(client, args.requests, args.threads)
+    results["naive"] = {
+        "succeeded": ok,
+        "rejected_429": limits.rejected,
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+    server.shutdown()
+
+    server, url, limits = start_stub_server(args.rpm, args.window)
+    client = anthropic.Anthropic(base_url=url, api_key="stub")
+    # The stub's window is shortened, so express its quota per minute
+    scheduler = RequestScheduler(requests_per_minute=args.rpm * 60 / args.window, base_delay=0.1)
+    start = time.perf_counter()
+    ok, finished = scheduled(client, scheduler, args.requests, args.threads)
+    elapsed = time.perf_counter() - start
+    results["scheduled"] = {
+        "succeeded": ok,
+        "rejected_429": limits.rejected,
+        "seconds": round(elapsed, 2),
+        "final_concurrency": round(scheduler.concurrency, 2),
+        "stats": scheduler.stats,
+        "mean_finish_interactive_s": round(
+            sum(t - start for t in finished[PRIORITY_INTERACTIVE]) / max(len(finished[PRIORITY_INTERACTIVE]), 1), 2
+        ),
+        "mean_finish_batch_s": round(
+            sum(t - start for t in finished[PRIORITY_BATCH]) / max(len(finished[PRIORITY_BATCH]), 1), 2
+        ),
+    }
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import random
+import time
+
+from tools.str_match import find_matches
+
+
+def legacy_line_window_matches(content, old_str):
+    # The matcher TextEditTools.str_replace used before find_matches: compare a
+    # slice of len(old_lines) lines at every line offset in the file.
+    lines = content.splitlines(keepends=True)
+    old_lines = old_str.splitlines(keepends=True)
+    matches = []
+    for i in range(len(lines) - len(old_lines) + 1):
+        if lines[i : i + len(old_lines)] == old_lines:
+            matches.append(i)
+    return matches
+
+
+def generate_content(num_lines, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(num_lines):
+        indent = "    " * rng.randint(0, 3)
+        lines.append(f"{indent}value_{i} = compute({rng.randint(0, 10**6)}, {i % 97})\n")
+    return "".join(lines)
+
+
+def best_of(repeat, fn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(num_lines, block_lines, repeat):
+    content = generate_content(num_lines)
+    lines = content.splitlines(keepends=True)
+    start = max(0, num_lines - block_lines - 10)
+    old_str = "".join(lines[start : start + block_lines])
+
+    # Sanity check that both matchers agree before timing them.
+    legacy = legacy_line_window_matches(content, old_str)
+    current = find_matches(content, old_str)
+    assert [line - 1 for _, line in current] == legacy, (legacy, current)
+
+    legacy_time = best_of(repeat, legacy_line_window_matches, content, old_str)
+    current_time = best_of(repeat, find_matches, content, old_str)
+    return {
+        "lines": num_lines,
+        "block_lines": block_lines,
+        "legacy_s": legacy_time,
+        "find_matches_s": current_time,
+        "speedup": legacy_time / current_time if current_time else float("inf"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark str_replace matching")
+    parser.add_argument("--lines", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--block", type=int, nargs="+", default=[1, 50, 300])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'lines':>8} {'block':>6} {'legacy (ms)':>12} {'find (ms)':>10} {'speedup':>8}")
+    for num_lines in args.lines:
+        for block_lines in args.block:
+            result = run(num_lines, block_lines, args.repeat)
+            print(
+                f"{result['lines']:>8} {result['block_lines']:>6} "
+                f"{result['legacy_s'] * 1000:>12.2f} "
+                f"{result['find_matches_s'] * 1000:>10.3f} "
+                f"{result['speedup']:>7.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.workloads import (
+    environment,
+    generate_large_file,
+    generate_workspace,
+    summarize,
+    write_report,
+)
+from tools.text_edit_tools import TextEditTools
+
+VIEW_RANGE_LINES = 50
+
+
+def timed(samples, fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def check(result):
+    # A benchmark of an operation that failed would measure the wrong thing
+    if isinstance(result, tuple) or (isinstance(result, str) and result.startswith("Error")):
+        raise RuntimeError(f"Operation failed: {result}")
+    return result
+
+
+def bench_large_file(size_mb, repeat):
+    directory = f"bench_file_{size_mb}mb"
+    path, line_count = generate_large_file(
+        os.path.join("work_dir", directory), "large.txt", size_mb * 1024 * 1024
+    )
+    tools = TextEditTools(directory)
+    samples = {op: [] for op in ("view", "view_range", "str_replace", "insert", "undo_edit")}
+    middle = line_count // 2
+    # A line near the end, the worst case for finding old_str
+    target = line_count - 10
+    with open(path) as f:
+        for number, line in enumerate(f):
+            if number == target:
+                old_str = line
+                break
+    new_str = "replaced " + old_str
+    for i in range(repeat):
+        # The first full view also populates the caches; its time is the
+        # cold read
+        timed(samples["view"], lambda: check(tools.view("/repo/large.txt")))
+        start_line = (middle + i * VIEW_RANGE_LINES) % max(line_count - VIEW_RANGE_LINES, 1) + 1
+        view_range = [start_line, start_line + VIEW_RANGE_LINES - 1]
+        timed(samples["view_range"], lambda: check(tools.view("/repo/large.txt", view_range)))
+        # Replaced one way, then back, so every iteration edits the same file
+        pair = (old_str, new_str) if i % 2 == 0 else (new_str, old_str)
+        timed(samples["str_replace"], lambda: check(tools.str_replace("/repo/large.txt", *pair)))
+        timed(samples["insert"], lambda: check(tools.insert("/repo/large.txt", middle, "inserted\n")))
+        timed(samples["undo_edit"], lambda: check(tools.undo_edit("/repo/large.txt")))
+    if repeat % 2:
+        tools.str_replace("/repo/large.txt", new_str, old_str)
+    case = {"case": f"file_{size_mb}mb", "bytes": os.path.getsize(path), "lines": line_count}
+    return [dict(case, op=op, **summarize(times)) for op, times in samples.items()]
+
+
+def bench_workspace(num_files, repeat):
+    directory = f"bench_workspace_{num_files}"
+    generate_workspace(os.path.join("work_dir", directory), num_files)
+    tools = TextEditTools(directory)
+    samples = {op: [] for op in ("list_directory", "list_directory_deep", "search", "view")}
+    for i in range(repeat):
+        timed(samples["list_directory"], lambda: check(tools.list_directory("/repo/", 2)))
+        timed(samples["list_directory_deep"], lambda: check(tools.list_directory("/repo/", 6)))
+        timed(samples["search"], lambda: check(tools.search(f"function_{i * 7 % num_files}_0")))
+        timed(samples["view"], lambda: check(tools.view(f"/repo/module_{i % 20}.py")))
+    case = {"case": f"workspace_{num_files}", "files": num_files}
+    return [dict(case, op=op, **summarize(times)) for op, times in samples.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TextEditTools operations")
+    parser.add_argument("--files", type=int, nargs="*", default=[100, 10_000])
+    parser.add_argument("--file-mb", type=int, nargs="*", default=[1, 10])
+    parser.add_argument("--full", action="store_true", help="Also 100k files and a 100 MB file")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--root",
+        help="Where to generate workspaces; reused across runs. Defaults to a temporary directory",
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.full:
+        args.files = sorted(set(args.files) | {100_000})
+        args.file_mb = sorted(set(args.file_mb) | {100})
+
+    root = args.root or tempfile.mkdtemp(prefix="bench_text_edit_tools_")
+    os.makedirs(root, exist_ok=True)
+    report_path = os.path.abspath(args.output) if args.output else None
+    cwd = os.getcwd()
+    # TextEditTools works under ./work_dir
+    os.chdir(root)
+    try:
+        results = []
+        for size_mb in args.file_mb:
+            results.extend(bench_large_file(size_mb, args.repeat))
+        for num_files in args.files:
+            results.extend(bench_workspace(num_files, args.repeat))
+    finally:
+        os.chdir(cwd)
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+    write_report(
+        {
+            "benchmark": "text_edit_tools",
+            "environment": environment(),
+            "repeat": args.repeat,
+            "results": results,
+        },
+        report_path,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+import argparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.workloads import environment, summarize, write_report
+from tools.channel import DEFAULT_SOCKET_PATH, ChannelClient
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILES_PER_DIRECTORY = 20
+LINES_PER_FILE = 400
+# (operation, weight); edits go to a file owned by each client so that
+# concurrent clients never invalidate each other's old_str
+WORKLOAD = [
+    ("view", 35),
+    ("view_range", 20),
+    ("str_replace", 15),
+    ("insert_undo", 5),
+    ("list_directory", 5),
+    ("search", 10),
+    ("batch", 10),
+]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_service(root):
+    # A separate process, so the load generator does not compete with the
+    # service for the GIL. Returns (process, base url).
+    port = _free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "tools.tools_service:app",
+            "--port", str(port), "--log-level", "warning",
+        ],
+        cwd=root,
+        env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{url}/stats", timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The tools service did not start")
+
+
+def _file_text(seed):
+    rng = random.Random(seed)
+    return "".join(
+        f"line {i}: value = compute({rng.randint(0, 10**6)})\n" for i in range(LINES_PER_FILE)
+    )
+
+
+def populate(url, directories, clients):
+    session = requests.Session()
+    for d in range(directories):
+        base = f"{url}/text_editor/bench_{d}"
+        for f in range(FILES_PER_DIRECTORY):
+            session.post(
+                f"{base}/create", json={"path": f"/repo/file_{f}.txt", "file_text": _file_text(f)}
+            )
+    for c in range(clients):
+        base = f"{url}/text_editor/bench_{c % directories}"
+        session.post(
+            f"{base}/create", json={"path": f"/repo/client_{c}.txt", "file_text": _file_text(c)}
+        )
+
+
+class Client:
+    # Sends its requests over HTTP, or over a channel connection of its own
+    # when given a socket path
+    def __init__(self, url, index, directories, seed, socket_path=None):
+        self.directory = f"bench_{index % directories}"
+        self.base = f"{url}/text_editor/{self.directory}"
+        self.channel = ChannelClient(socket_path) if socket_path else None
+        self.own_file = f"/repo/client_{index}.txt"
+        self.session = requests.Session()
+        self.rng = random.Random(seed)
+        self.replaced = False
+        self.samples = {op: [] for op, _ in WORKLOAD}
+        self.requests = 0
+        self.errors = 0
+        self.last_error = None
+
+    def _post(self, endpoint, payload):
+        self.requests += 1
+        if self.channel is not None:
+            envelope = self.channel.call(self.directory, endpoint, payload)
+            result = envelope.get("result")
+            if not envelope["ok"] or (isinstance(result, str) and result.startswith("Error")):
+                self.errors += 1
+                self.last_error = f"{endpoint}: {envelope.get('error') or result[:200]}"
+            return envelope
+        response = self.session.post(f"{self.base}/{endpoint}", json=payload)
+        # Tool errors come back as 200 responses whose text starts with Error
+        if response.status_code != 200 or '"Error' in response.text[:20]:
+            self.errors += 1
+            self.last_error = f"{endpoint}: {response.status_code} {response.text[:200]}"
+        return response
+
+    def _random_file(self):
+        return f"/repo/file_{self.rng.randrange(FILES_PER_DIRECTORY)}.txt"
+
+    def step(self, op):
+        if op == "view":
+            self._post("view", {"path": self._random_file()})
+        elif op == "view_range":
+            start = self.rng.randrange(1, LINES_PER_FILE - 20)
+            self._post("view", {"path": self._random_file(), "view_range": [start, start + 20]})
+        elif op == "str_replace":
+            old, new = "line 0: ", "line 0 (edited): "
+            if self.replaced:
+                old, new = new, old
+            self._post("str_replace", {"path": self.own_file, "old_str": old, "new_str": new})
+            self.replaced = not self.replaced
+        elif op == "insert_undo":
+            self._post("insert", {"path": self.own_file, "insert_line": 10, "new_str": "x\n"})
+            self._post("undo_edit", {"path": self.own_file})
+        elif op == "list_directory":
+            self._post("list_directory", {"path": "/repo/", "depth": 2})
+        elif op == "search":
+            self._post("search", {"query": f"compute({self.rng.randint(0, 9)}"})
+        elif op == "batch":
+            self._post(
+                "batch",
+                {
+                    "operations": [
+                        {"op": "view", "args": {"path": self._random_file()}} for _ in range(4)
+                    ]
+                },
+            )
+
+    def run(self, deadline):
+        ops, weights = zip(*WORKLOAD)
+        while time.perf_counter() < deadline:
+            op = self.rng.choices(ops, weights)[0]
+            start = time.perf_counter()
+            self.step(op)
+            self.samples[op].append(time.perf_counter() - start)
+        if self.replaced:
+            # Leaves the file as the next run's client for it expects
+            self.step("str_replace")
+        if self.channel is not None:
+            self.channel.close()
+
+
+def load_test(url, clients, directories, duration, seed, socket_path=None):
+    workers = [Client(url, i, directories, seed + i, socket_path) for i in range(clients)]
+    start = time.perf_counter()
+    deadline = start + duration
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(lambda client: client.run(deadline), workers))
+    elapsed = time.perf_counter() - start
+    per_op = {op: [] for op, _ in WORKLOAD}
+    for client in workers:
+        for op, samples in client.samples.items():
+            per_op[op].extend(samples)
+    everything = [sample for samples in per_op.values() for sample in samples]
+    requests_sent = sum(client.requests for client in workers)
+    return {
+        "clients": clients,
+        "directories": directories,
+        "seconds": elapsed,
+        "requests": requests_sent,
+        "throughput_rps": requests_sent / elapsed,
+        "errors": sum(client.errors for client in workers),
+        "last_error": next((c.last_error for c in workers if c.last_error), None),
+        "latency": summarize(everything),
+        "operations": {op: summarize(samples) for op, samples in per_op.items() if samples},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the tools service")
+    parser.add_argument("--url", help="A running service; by default one is started locally")
+    parser.add_argument("--clients", type=int, nargs="*", default=[1, 8, 32])
+    parser.add_argument("--directories", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="Seconds per client count")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--transport",
+        choices=("http", "channel"),
+        default="http",
+        help="Send requests over HTTP or over the service's channel socket",
+    )
+    parser.add_argument(
+        "--socket",
+        help="The channel socket of the service at --url; by default the started service's",
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    process = root = None
+    url = args.url
+    socket_path = args.socket
+    if url is None:
+        root = tempfile.mkdtemp(prefix="bench_tools_service_")
+        process, url = start_service(root)
+        socket_path = socket_path or os.path.join(root, DEFAULT_SOCKET_PATH)
+    if args.transport == "http":
+        socket_path = None
+    elif socket_path is None:
+        parser.error("--transport channel with --url needs --socket")
+    try:
+        populate(url, args.directories, max(args.clients))
+        runs = [
+            load_test(url, clients, args.directories, args.duration, args.seed, socket_path)
+            for clients in args.clients
+        ]
+        stats = requests.get(f"{url}/stats").json()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(root, ignore_errors=True)
+    write_report(
+        {
+            "benchmark": "tools_service",
+            "environment": environment(),
+            "url": args.url,
+            "transport": args.transport,
+            "runs": runs,
+            "service_stats": stats,
+        },
+        args.output,
+    )
+
+
+if __name__ == "__main__":
+    main()
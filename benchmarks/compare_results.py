@@ -0,0 +1,68 @@
+import argparse
+import json
+import sys
+
+DEFAULT_THRESHOLD = 1.25
+
+
+def _latencies(report):
+    # {name: p50 seconds} for either benchmark's report
+    if report["benchmark"] == "text_edit_tools":
+        return {f"{r['case']} {r['op']}": r["p50_s"] for r in report["results"]}
+    latencies = {}
+    for run in report["runs"]:
+        latencies[f"{run['clients']} clients"] = run["latency"]["p50_s"]
+        for op, summary in run["operations"].items():
+            latencies[f"{run['clients']} clients {op}"] = summary["p50_s"]
+    return latencies
+
+
+def compare(base, new, threshold=DEFAULT_THRESHOLD):
+    # Returns (rows, regressions); a regression is a p50 more than threshold
+    # times the base's
+    if base["benchmark"] != new["benchmark"]:
+        raise ValueError(f"Cannot compare {base['benchmark']} with {new['benchmark']}")
+    base_latencies = _latencies(base)
+    new_latencies = _latencies(new)
+    rows = []
+    regressions = []
+    for name, before in base_latencies.items():
+        after = new_latencies.get(name)
+        if after is None:
+            continue
+        ratio = after / before if before else float("inf")
+        rows.append((name, before, after, ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Flag operations whose p50 grew by more than this factor",
+    )
+    args = parser.parse_args()
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    rows, regressions = compare(base, new, args.threshold)
+    print(f"{base['environment']['revision']} -> {new['environment']['revision']}")
+    print(f"{'operation':<40} {'base p50 (ms)':>14} {'new p50 (ms)':>13} {'ratio':>7}")
+    for name, before, after, ratio in rows:
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<40} {before * 1000:>14.3f} {after * 1000:>13.3f} {ratio:>6.2f}x{flag}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) above {args.threshold}x")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
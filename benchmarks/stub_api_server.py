@@ -0,0 +1,104 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLimits:
+    # Fixed-window rate limit shared by all handler threads
+    def __init__(self, requests_per_minute, window=60.0):
+        self.limit = requests_per_minute
+        self.window = window
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.count = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def admit(self):
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.window:
+                self.window_start = now
+                self.count = 0
+            if self.count >= self.limit:
+                self.rejected += 1
+                return False, 0, self.window - (now - self.window_start)
+            self.count += 1
+            self.accepted += 1
+            return True, self.limit - self.count, self.window - (now - self.window_start)
+
+
+def make_handler(limits, latency):
+    class Handler(BaseHTTPRequestHandler):
+        # A stand-in for POST /v1/messages that answers with a one-line text
+        # message, or a 429 with retry-after once the window's quota is spent.
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status, body, headers):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))))
+            admitted, remaining, reset_in = limits.admit()
+            headers = {
+                # Real limits are reported per minute, whatever the stub's window
+                "anthropic-ratelimit-requests-limit": str(int(limits.limit * 60 / limits.window)),
+                "anthropic-ratelimit-requests-remaining": str(remaining),
+            }
+            if not admitted:
+                headers["retry-after"] = f"{reset_in:.3f}"
+                error = {"type": "rate_limit_error", "message": "Number of requests exceeded"}
+                self._send(429, {"type": "error", "error": error}, headers)
+                return
+            time.sleep(latency)
+            message = {
+                "id": "msg_stub",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model", "stub"),
+                "content": [{"type": "text", "text": "ok"}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {"input_tokens": 10, "output_tokens": 1},
+            }
+            self._send(200, message, headers)
+
+    return Handler
+
+
+def start_stub_server(requests_per_minute=60, window=60.0, latency=0.05, port=0):
+    # Returns (server, base_url, limits); the server runs on a daemon thread
+    limits = StubLimits(requests_per_minute, window)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(limits, latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a rate-limited stub of the messages API")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+    server, url, _ = start_stub_server(args.rpm, latency=args.latency, port=args.port)
+    print(f"Stub messages API on {url} (ANTHROPIC_BASE_URL={url})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
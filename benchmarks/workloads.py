@@ -0,0 +1,154 @@
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.bench_str_replace import generate_content
+
+FILES_PER_DIRECTORY = 20
+SUBDIRECTORIES = 8
+# Written in chunks so a 100 MB file never has to be held as one string
+CHUNK_LINES = 50_000
+# Records the parameters a workspace or file was generated with
+_MARKER = ".bench_{}.json"
+
+
+def _source_file(rng, index, lines):
+    # Something resembling a small Python module, so search and outline
+    # have realistic input
+    body = [f"import module_{rng.randint(0, 500)}\n", "\n"]
+    for j in range(max(lines // 6, 1)):
+        body.append(f"def function_{index}_{j}(value):\n")
+        body.append(f"    result = compute(value, {rng.randint(0, 10**6)})\n")
+        body.append(f"    if result > {rng.randint(0, 1000)}:\n")
+        body.append(f"        return result * {j}\n")
+        body.append("    return None\n")
+        body.append("\n")
+    return "".join(body)
+
+
+def _file_paths(num_files):
+    # Nested directories of FILES_PER_DIRECTORY files each, SUBDIRECTORIES
+    # wide, so listings and searches have some depth to walk
+    for index in range(num_files):
+        directory = index // FILES_PER_DIRECTORY
+        parts = []
+        while directory:
+            directory, digit = divmod(directory - 1, SUBDIRECTORIES)
+            parts.append(f"pkg_{digit}")
+        parts.reverse()
+        yield index, os.path.join(*parts, f"module_{index}.py")
+
+
+def _up_to_date(marker, params):
+    # Extra keys recorded by _mark (such as a file's line count) are ignored
+    try:
+        with open(marker) as f:
+            recorded = json.load(f)
+        return {key: recorded.get(key) for key in params} == params
+    except (OSError, ValueError):
+        return False
+
+
+def _mark(marker, params):
+    with open(marker, "w") as f:
+        json.dump(params, f)
+
+
+def generate_workspace(root, num_files, lines_per_file=30, seed=0):
+    # Deterministic for a given (num_files, lines_per_file, seed); an existing
+    # workspace generated with the same parameters is reused as is
+    params = {"files": num_files, "lines": lines_per_file, "seed": seed}
+    marker = os.path.join(root, _MARKER.format("workspace"))
+    if _up_to_date(marker, params):
+        return
+    rng = random.Random(seed)
+    for index, relative in _file_paths(num_files):
+        path = os.path.join(root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(_source_file(rng, index, lines_per_file))
+    _mark(marker, params)
+
+
+def generate_large_file(root, name, size_bytes, seed=0):
+    # Returns the file's path and line count. Every line starts with its
+    # number, so any line is a unique str_replace target.
+    params = {"bytes": size_bytes, "seed": seed}
+    path = os.path.join(root, name)
+    marker = os.path.join(root, _MARKER.format(name))
+    if _up_to_date(marker, params):
+        return path, _generated_lines(marker)
+    os.makedirs(root, exist_ok=True)
+    written = 0
+    line_count = 0
+    chunk_seed = seed
+    with open(path, "w") as f:
+        while written < size_bytes:
+            chunk = []
+            for line in generate_content(CHUNK_LINES, chunk_seed).splitlines(keepends=True):
+                line = f"{line_count}: {line}"
+                chunk.append(line)
+                written += len(line)
+                line_count += 1
+                if written >= size_bytes:
+                    break
+            chunk_seed += 1
+            f.write("".join(chunk))
+    _mark(marker, dict(params, lines=line_count))
+    return path, line_count
+
+
+def _generated_lines(marker):
+    with open(marker) as f:
+        return json.load(f)["lines"]
+
+
+def summarize(samples):
+    # Latency statistics in seconds; samples need not be sorted
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(p / 100 * len(ordered)), len(ordered) - 1)]
+
+    return {
+        "n": len(ordered),
+        "min_s": ordered[0],
+        "p50_s": percentile(50),
+        "p99_s": percentile(99),
+        "max_s": ordered[-1],
+        "mean_s": statistics.fmean(ordered),
+    }
+
+
+def environment():
+    # Enough to tell apart results from different revisions and machines
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        "revision": revision or None,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.time(),
+    }
+
+
+def write_report(report, output):
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
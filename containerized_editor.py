@@ -1,61 +1,223 @@
 import anthropic
 from dotenv import load_dotenv
+import json
 import yaml
 import sys
+import time
 import requests
 from anthropic.types.beta import BetaTextBlock, BetaToolUseBlock
+from agent.compaction import ContextCompactor
+from agent.rate_limiter import PRIORITY_INTERACTIVE, shared_scheduler
+from agent.tool_definitions import APPLY_PATCH_TOOL, OUTLINE_TOOL, SEARCH_TOOL, VIEW_MANY_TOOL
+from agent.tool_scheduler import ToolScheduler, tool_access
+from agent.replay import model_client, prompt_user
+from agent.tracing import Tracer
+from agent.prompt_cache import cached_system, cached_tools, with_history_breakpoint, format_usage
+from tools.channel import DEFAULT_SOCKET_PATH, ChannelClient
 import readline
 
 load_dotenv()
 
-client = anthropic.Anthropic()
+# Created in main(): the API client, or a recording or replaying stand-in
+# when the config names a cassette (see agent.replay)
+client = None
 global_history = []
+# (snapshot id, history length) taken as each goal starts, for /rollback
+checkpoints = []
+
+with open("system_prompt.txt", "r") as f:
+    SYSTEM_PROMPT = f.read()
+
+TOOLS = [
+    {"type": "text_editor_20241022", "name": "str_replace_editor"},
+    {
+        "name": "file_delete",
+        "description": "Delete a file",
+        "input_schema": {
+            "type": "object",
+            "properties": {
+                "path": {
+                    "type": "string",
+                    "description": "The path to the file to delete",
+                }
+            },
+            "required": ["path"],
+        },
+    },
+    SEARCH_TOOL,
+    VIEW_MANY_TOOL,
+    OUTLINE_TOOL,
+    APPLY_PATCH_TOOL,
+    {"type": "bash_20241022", "name": "bash"},
+]
+
+# System prompt and tool definitions never change, so both carry a cache
+# breakpoint; the history gets one on its latest message every turn.
+CACHED_SYSTEM = cached_system(SYSTEM_PROMPT)
+CACHED_TOOLS = cached_tools(TOOLS)
+
+# Token budget for the history sent each turn, see main() for overriding it
+compactor = ContextCompactor()
+# Per-turn timing and token spans, written as JSONL when trace_file is set
+tracer = Tracer()
 
 TOOLS_SERVICE_URL = "http://localhost:9191/text_editor"
+# Reused for every call so tool calls share one keep-alive connection
+session = requests.Session()
+# The service's persistent socket, used instead of HTTP when it can be
+# reached; see main() for pointing it elsewhere or turning it off
+channel = ChannelClient(DEFAULT_SOCKET_PATH)
 
 def call_tools_service(endpoint, directory, payload):
     url = f"{TOOLS_SERVICE_URL}/{directory}/{endpoint}"
-    response = requests.post(url, json=payload)
+    response = session.post(url, json=payload)
     response.raise_for_status()
     return response.text
 
-def process_goal(input_goal, start_dir="."):
-    system_prompt = open("system_prompt.txt", "r").read()
+def tool_operation(name, tool_input):
+    # Maps a tool_use block onto an operation of the service's batch endpoint
+    if name == "file_delete":
+        op = "delete"
+    elif name in ("search", "view_many", "outline", "apply_patch"):
+        op = name
+    elif name == "bash":
+        op = "bash"
+    else:
+        op = tool_input["command"]
+    if op == "bash":
+        print(f"> {tool_input.get('command')}")
+    elif op == "search":
+        print(f"> search {tool_input.get('query')}")
+    elif op == "apply_patch":
+        print("> apply_patch")
+    elif op == "view_many":
+        print(f"> view_many {', '.join(spec.get('path', '') for spec in tool_input.get('files', []))}")
+    else:
+        print(f"> {op} {tool_input.get('path')}")
+    return {"op": op, "args": tool_input}
+
+def call_tools_batch(directory, operations, span=None):
+    url = f"{TOOLS_SERVICE_URL}/{directory}/batch"
+    start = time.perf_counter()
+    response = session.post(url, json={"operations": operations})
+    if span is not None:
+        span.service_call(time.perf_counter() - start, response.headers.get("Server-Timing"))
+    response.raise_for_status()
+    return response.json()["results"]
+
+def call_tools_channel(directory, operations, span=None):
+    # Every operation is sent before waiting on any; the service keeps
+    # writes in order, as the batch endpoint does
+    start = time.perf_counter()
+    futures = [channel.submit(directory, op["op"], op["args"]) for op in operations]
+    results = []
+    server_seconds = 0.0
+    for future in futures:
+        envelope = future.result()
+        server_seconds += envelope.get("server_seconds", 0.0)
+        if envelope["ok"]:
+            results.append({"result": envelope["result"]})
+        else:
+            results.append({"error": envelope["error"]})
+    if span is not None:
+        round_trip = time.perf_counter() - start
+        span.service_call(round_trip, server_seconds=min(server_seconds, round_trip))
+    return results
+
+def run_operations(directory, operations, span=None):
+    try:
+        if channel is not None and channel.available():
+            return call_tools_channel(directory, operations, span)
+        return call_tools_batch(directory, operations, span)
+    except requests.HTTPError as e:
+        print(f"HTTP error occurred: {e}")
+        return [{"error": str(e)}] * len(operations)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return [{"error": str(e)}] * len(operations)
+
+def tool_result_block(tool_use_id, result):
+    tool_result = {"type": "tool_result", "tool_use_id": tool_use_id}
+    if "error" in result:
+        tool_result["content"] = f"Error: {result['error']}"
+        tool_result["is_error"] = True
+    else:
+        tool_result["content"] = json.dumps(result["result"])
+    return tool_result
+
+def checkpoint_label(input_goal):
+    return input_goal.strip().split("\n")[0][:80]
+
+def rollback(start_dir):
+    # Undoes the last goal: the whole workspace, including what bash changed,
+    # goes back to the checkpoint taken as the goal started, and the goal
+    # leaves the history
+    if not checkpoints:
+        print("Nothing to roll back")
+        return
+    snapshot_id, history_length = checkpoints.pop()
+    result = run_operations(start_dir, [{"op": "restore", "args": {"snapshot_id": snapshot_id}}])[0]
+    if "error" in result or result["result"].startswith("Error"):
+        print(result.get("error") or result["result"])
+        checkpoints.append((snapshot_id, history_length))
+    else:
+        print(result["result"])
+        del global_history[history_length:]
+
+def process_goal(input_goal, start_dir=".", stream=False):
+    snapshot = run_operations(
+        start_dir, [{"op": "checkpoint", "args": {"label": checkpoint_label(input_goal)}}]
+    )[0]
+    if isinstance(snapshot.get("result"), dict):
+        checkpoints.append((snapshot["result"]["id"], len(global_history)))
+    else:
+        print(snapshot.get("error") or snapshot["result"])
     input_goal_message = {"role": "user", "content": input_goal}
 
     global_history.append(input_goal_message)
+    compactor.compact(global_history)
     message_history = global_history.copy()
+    # Streamed tool calls are sent as they complete; independent ones run in
+    # parallel and conflicting ones keep their order
+    scheduler = ToolScheduler()
 
     done = False
     while not done:
-        response = client.beta.messages.create(
+        compacted = compactor.compact(message_history)
+        if compacted:
+            print(f"Compacted context from ~{compacted[0]} to ~{compacted[1]} tokens")
+        pending = {}
+        span = tracer.turn(message_history)
+
+        def dispatch(block):
+            print(block.name)
+            operation = tool_operation(block.name, block.input)
+            access = tool_access(block.name, block.input)
+            pending[block.id] = scheduler.submit(
+                access, span.timed(block.name, run_operations), start_dir, [operation], span
+            )
+
+        request = dict(
             model="claude-3-5-sonnet-20241022",
-            system=system_prompt,
+            system=CACHED_SYSTEM,
             max_tokens=4095,
-            tools=[
-                {"type": "text_editor_20241022", "name": "str_replace_editor"},
-                {
-                    "name": "file_delete",
-                    "description": "Delete a file",
-                    "input_schema": {
-                        "type": "object",
-                        "properties": {
-                            "path": {
-                                "type": "string",
-                                "description": "The path to the file to delete",
-                            }
-                        },
-                        "required": ["path"],
-                    },
-                },
-                {"type": "bash_20241022", "name": "bash"},
-            ],
-            messages=message_history,
+            tools=CACHED_TOOLS,
+            messages=with_history_breakpoint(message_history),
             betas=["computer-use-2024-10-22"],
         )
+        if stream:
+            response = shared_scheduler.stream(
+                client, priority=PRIORITY_INTERACTIVE, on_tool_use=dispatch, **request
+            )
+        else:
+            response = shared_scheduler.create(client, priority=PRIORITY_INTERACTIVE, **request)
+        span.model_done(response)
+        print(format_usage(response.usage))
         if response.stop_reason == "tool_use":
             messages = response.content
             content = []
+            operations = []
+            tool_use_ids = []
             for message in messages:
                 if isinstance(message, BetaTextBlock):
                     content.append({"type": "text", "text": message.text})
@@ -69,57 +231,44 @@ def process_goal(input_goal, start_dir="."):
                             "input": tool_input,
                         }
                     )
-                    message_history.append({"role": "assistant", "content": content})
+                    if message.id in pending:
+                        continue
                     print(message.name)
-                    try:
-                        if message.name == "file_delete":
-                            command = tool_input['command']
-                            print(f"> {command} {tool_input['path']}")
-                            result = call_tools_service("delete", start_dir, tool_input)
-                        if message.name=='str_replace_editor':
-                            # look for the sub command in 'command' in tool_input
-                            command = tool_input['command']
-                            print(f"> {command} {tool_input['path']}")
-                            if command == "view":
-                                result = call_tools_service("view", start_dir, tool_input)
-                            elif command == "create":
-                                result = call_tools_service("create", start_dir, tool_input)
-                            elif command == "str_replace":
-                                result = call_tools_service("str_replace", start_dir, tool_input)
-                            elif command == "insert":
-                                result = call_tools_service("insert", start_dir, tool_input)
-                            elif command == "undo_edit":
-                                result = call_tools_service("undo_edit", start_dir, tool_input)
-                        if message.name == "bash":
-                            print(f"> {tool_input['command']}")
-                            result = call_tools_service("bash", start_dir, tool_input)
-                        message_history.append(
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "tool_result",
-                                        "tool_use_id": message.id,
-                                        "content": result,
-                                    }
-                                ],
-                            }
-                        )
-                    except requests.HTTPError as e:
-                        print(f"HTTP error occurred: {e}")
-                    except Exception as e:
-                        print(f"An error occurred: {e}")
+                    operations.append(tool_operation(message.name, tool_input))
+                    tool_use_ids.append(message.id)
+            message_history.append({"role": "assistant", "content": content})
+
+            # Tool calls that were not streamed go to the service in one request
+            results = {}
+            if operations:
+                run_batch = span.timed(
+                    "batch(" + ",".join(op["op"] for op in operations) + ")", run_operations
+                )
+                results.update(zip(tool_use_ids, run_batch(start_dir, operations, span)))
+            for tool_use_id, future in pending.items():
+                results[tool_use_id] = future.result()[0]
+
+            tool_results = [
+                tool_result_block(block["id"], results[block["id"]])
+                for block in content
+                if block["type"] == "tool_use"
+            ]
+            message_history.append({"role": "user", "content": tool_results})
+        tracer.finish(span)
 
         if response.stop_reason in ["end_turn", "max_tokens", "stop_sequence"]:
             print("Stopped: ", response.stop_reason)
-            print(response.content[0].text)
+            if not stream:
+                print(response.content[0].text)
             done = True
             global_history.append(
                 {"role": "assistant", "content": response.content[0].text}
             )
+    scheduler.shutdown()
 
 
 def main():
+    global client, channel
     config_path = sys.argv[1] if len(sys.argv) > 1 else "config.yaml"
 
     with open("yamls/" + config_path, "r") as f:
@@ -127,6 +276,15 @@ def main():
 
     repo_path = config["repo_path"]
     input_goal = config["input_goal"]
+    compactor.budget_tokens = config.get("context_budget_tokens", compactor.budget_tokens)
+    stream = "--stream" in sys.argv or config.get("stream", False)
+    shared_scheduler.configure(config.get("requests_per_minute"), config.get("tokens_per_minute"))
+    tracer.path = config.get("trace_file")
+    # An empty tools_service_socket keeps every call on HTTP
+    channel.path = config.get("tools_service_socket", channel.path)
+    if not channel.path:
+        channel = None
+    client = model_client(config, anthropic.Anthropic)
 
     if config.get("include_files", True):
         input_goal += f"""
@@ -138,14 +296,16 @@ Review the existing files and create or update files as needed to execute the go
 """
     # if we have an arg that says --cli, skip the first process_goal call
     if "--cli" not in sys.argv:
-        process_goal(input_goal, repo_path)
+        process_goal(input_goal, repo_path, stream)
     user_quit = False
     while not user_quit:
-        user_input = input("> ")
+        user_input = prompt_user(client, "> ")
         if user_input == "/quit":
             user_quit = True
+        elif user_input == "/rollback":
+            rollback(repo_path)
         else:
-            process_goal(user_input, repo_path)
+            process_goal(user_input, repo_path, stream)
 
 
 if __name__ == "__main__":
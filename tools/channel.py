@@ -0,0 +1,295 @@
+import asyncio
+import itertools
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+# A persistent, multiplexed channel to the tools service over a Unix domain
+# socket. Each frame is a 4-byte big-endian payload length, a flags byte and
+# a JSON payload. Requests are {"id", "directory", "op", "args"}; every
+# response, whatever the operation, is {"id", "ok", "result" or "error",
+# "server_seconds"}. Requests may be pipelined: responses carry the id of
+# their request and may arrive in any order.
+
+DEFAULT_SOCKET_PATH = os.path.join("work_dir", ".tools_service.sock")
+# Payloads at least this large are zlib-compressed when the peer accepts it
+DEFAULT_COMPRESS_MIN_BYTES = 16 * 1024
+MAX_FRAME_BYTES = 256 * 1024 * 1024
+FLAG_COMPRESSED = 0x1
+# Set on requests by a client that accepts compressed responses
+FLAG_ACCEPTS_COMPRESSED = 0x2
+_HEADER = struct.Struct(">IB")
+
+
+def encode_frame(message, compress=False, min_bytes=DEFAULT_COMPRESS_MIN_BYTES, flags=0):
+    payload = json.dumps(message, separators=(",", ":")).encode()
+    if compress and len(payload) >= min_bytes:
+        payload = zlib.compress(payload, 1)
+        flags |= FLAG_COMPRESSED
+    return _HEADER.pack(len(payload), flags) + payload
+
+
+def decode_payload(payload, flags):
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    return json.loads(payload)
+
+
+def _check_length(length):
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f"Frame of {length} bytes exceeds the {MAX_FRAME_BYTES} byte limit")
+
+
+class _DirectoryOrder:
+    # Within one connection and directory, read-only requests run
+    # concurrently, and any other request waits for everything sent before it
+    # and holds back everything after it, as in the batch endpoint
+    __slots__ = ("last_write", "reads")
+
+    def __init__(self):
+        self.last_write = None
+        self.reads = set()
+
+
+class ChannelServer:
+    # Serves the channel protocol on the service's event loop. handle is an
+    # async (state, directory, op, args) -> result callable that raises
+    # ChannelError for failed operations; state is a dict private to the
+    # connection, passed to close_state(state) when the connection ends.
+
+    def __init__(
+        self,
+        path,
+        handle,
+        close_state,
+        read_only_ops,
+        compress_min_bytes=DEFAULT_COMPRESS_MIN_BYTES,
+    ):
+        self.path = path
+        self.handle = handle
+        self.close_state = close_state
+        self.read_only_ops = read_only_ops
+        self.compress_min_bytes = compress_min_bytes
+        self.server = None
+        self.connections = 0
+        # The task serving each open connection, cancelled by close()
+        self._connection_tasks = set()
+
+    async def start(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # A socket left behind by a previous run would make the bind fail
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for task in list(self._connection_tasks):
+                task.cancel()
+            if self._connection_tasks:
+                await asyncio.wait(self._connection_tasks)
+            await self.server.wait_closed()
+            self.server = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        connection_task = asyncio.current_task()
+        self._connection_tasks.add(connection_task)
+        state = {}
+        orders = {}
+        tasks = set()
+        write_lock = asyncio.Lock()
+
+        async def respond(message, compress):
+            async with write_lock:
+                writer.write(encode_frame(message, compress, self.compress_min_bytes))
+                await writer.drain()
+
+        async def run(request, dependencies, compress):
+            if dependencies:
+                await asyncio.wait(dependencies)
+            start = time.perf_counter()
+            try:
+                result = await self.handle(
+                    state, request["directory"], request["op"], request.get("args") or {}
+                )
+                response = {"id": request["id"], "ok": True, "result": result}
+            except ChannelError as e:
+                response = {"id": request["id"], "ok": False, "error": str(e)}
+            except Exception as e:
+                response = {"id": request["id"], "ok": False, "error": f"Internal error: {e}"}
+            response["server_seconds"] = time.perf_counter() - start
+            await respond(response, compress)
+
+        try:
+            while True:
+                try:
+                    length, flags = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                    _check_length(length)
+                    request = decode_payload(await reader.readexactly(length), flags)
+                except asyncio.IncompleteReadError:
+                    break
+                compress = bool(flags & FLAG_ACCEPTS_COMPRESSED)
+                if not isinstance(request, dict) or not {"id", "directory", "op"} <= set(request):
+                    await respond(
+                        {
+                            "id": request.get("id") if isinstance(request, dict) else None,
+                            "ok": False,
+                            "error": "Requests need id, directory and op",
+                        },
+                        compress,
+                    )
+                    continue
+                if request["op"] == "ping":
+                    # Answered straight from the read loop, which makes it a
+                    # measure of the channel's own overhead
+                    await respond({"id": request["id"], "ok": True, "result": "pong"}, compress)
+                    continue
+                order = orders.setdefault(request["directory"], _DirectoryOrder())
+                dependencies = {order.last_write} if order.last_write is not None else set()
+                if request["op"] not in self.read_only_ops:
+                    dependencies |= order.reads
+                dependencies = {task for task in dependencies if not task.done()}
+                task = asyncio.ensure_future(run(request, dependencies, compress))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if request["op"] in self.read_only_ops:
+                    order.reads.add(task)
+                    task.add_done_callback(order.reads.discard)
+                else:
+                    order.last_write = task
+                    order.reads = set()
+        except (ConnectionError, ValueError, zlib.error):
+            pass
+        except asyncio.CancelledError:
+            # The server is closing; requests already running still finish
+            # and the connection's state is still released
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+            self.connections -= 1
+            writer.close()
+            await self.close_state(state)
+            self._connection_tasks.discard(connection_task)
+
+
+class ChannelError(Exception):
+    pass
+
+
+class ChannelClient:
+    # Thread-safe client. submit() sends a request right away and returns a
+    # Future of its response envelope, so any number of requests can be in
+    # flight on the one connection; a reader thread resolves them as
+    # responses arrive. The connection is opened on first use and reopened
+    # after it breaks.
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, compress=True, compress_min_bytes=DEFAULT_COMPRESS_MIN_BYTES):
+        self.path = path
+        self.compress = compress
+        self.compress_min_bytes = compress_min_bytes
+        self._sock = None
+        # Futures of requests awaiting a response, by socket and then by id
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def available(self):
+        # Whether the service's socket exists and accepts a connection
+        try:
+            self._connection()
+            return True
+        except OSError:
+            return False
+
+    def _connection(self):
+        with self._lock:
+            if self._sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(self.path)
+                except OSError:
+                    sock.close()
+                    raise
+                self._sock = sock
+                threading.Thread(target=self._read_loop, args=(sock,), daemon=True).start()
+            return self._sock
+
+    def _read_loop(self, sock):
+        stream = sock.makefile("rb")
+        try:
+            while True:
+                header = stream.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, flags = _HEADER.unpack(header)
+                _check_length(length)
+                payload = stream.read(length)
+                if len(payload) < length:
+                    break
+                response = decode_payload(payload, flags)
+                with self._lock:
+                    future = self._pending.get(sock, {}).pop(response.get("id"), None)
+                if future is not None:
+                    future.set_result(response)
+        except (OSError, ValueError, zlib.error):
+            pass
+        finally:
+            self._disconnected(sock)
+
+    def _disconnected(self, sock):
+        with self._lock:
+            if self._sock is sock:
+                self._sock = None
+            # Only requests sent on this socket; one sent after a reconnect
+            # is waiting on the new socket
+            pending = self._pending.pop(sock, {})
+        sock.close()
+        for future in pending.values():
+            future.set_exception(ConnectionError("Connection to the tools service was lost"))
+
+    def submit(self, directory, op, args=None):
+        sock = self._connection()
+        request_id = next(self._ids)
+        future = Future()
+        flags = FLAG_ACCEPTS_COMPRESSED if self.compress else 0
+        frame = encode_frame(
+            {"id": request_id, "directory": directory, "op": op, "args": args or {}},
+            self.compress,
+            self.compress_min_bytes,
+            flags,
+        )
+        with self._lock:
+            # A socket dropped since it was handed out would never resolve
+            # the future
+            if self._sock is not sock:
+                raise ConnectionError("Connection to the tools service was lost")
+            pending = self._pending.setdefault(sock, {})
+            pending[request_id] = future
+            try:
+                sock.sendall(frame)
+            except OSError:
+                pending.pop(request_id, None)
+                raise
+        return future
+
+    def call(self, directory, op, args=None, timeout=None):
+        return self.submit(directory, op, args).result(timeout)
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+
+from tools.dir_index import RACY_MTIME_NS
+from tools.metrics import CACHE_LOOKUPS, FILE_BYTES
+
+DEFAULT_MAX_CACHE_BYTES = 16 * 1024 * 1024
+# Larger files are streamed through the line index instead
+DEFAULT_MAX_CACHED_FILE_BYTES = 2 * 1024 * 1024
+
+
+class CachedContent:
+    # One file's content as stored on disk (raw) and with universal newlines
+    # applied (text, what open(path, "r") returns), plus the offsets in text
+    # where each line starts. text and starts are derived on first use.
+    __slots__ = ("key", "raw", "_text", "_starts")
+
+    def __init__(self, key, raw):
+        self.key = key
+        self.raw = raw
+        self._text = None
+        self._starts = None
+
+    @property
+    def text(self):
+        if self._text is None:
+            if "\r" in self.raw:
+                self._text = self.raw.replace("\r\n", "\n").replace("\r", "\n")
+            else:
+                self._text = self.raw
+        return self._text
+
+    @property
+    def starts(self):
+        if self._starts is None:
+            text = self.text
+            # Each line starts one past the end of the previous one; the
+            # running sum ends with len(text) + 1, which starts nothing
+            lengths = map((1).__add__, map(len, text.split("\n")))
+            starts = array("Q", accumulate(lengths, initial=0))
+            starts.pop()
+            if starts[-1] == len(text):
+                # A trailing newline (or an empty file) does not start a line
+                starts.pop()
+            self._starts = starts
+        return self._starts
+
+    def line_count(self):
+        return len(self.starts)
+
+    def lines(self, start=0, end=None):
+        # Yields lines start..end (0-based, end exclusive) with their line
+        # endings, as readlines() would return them
+        starts = self.starts
+        text = self.text
+        end = len(starts) if end is None else min(end, len(starts))
+        for i in range(start, end):
+            yield text[starts[i] : starts[i + 1] if i + 1 < len(starts) else len(text)]
+
+    @property
+    def size(self):
+        # Bytes on disk, which is close enough to the memory used
+        return self.key[1]
+
+
+class ContentCache:
+    # Decoded contents of recently used files, validated against the file's
+    # (inode, size, mtime) on every lookup and bounded by total size, least
+    # recently used first. Writes through the editing tools replace the
+    # entry with what they wrote. As in tools.dir_index, a file modified
+    # within RACY_MTIME_NS of being read or written is not cached, since
+    # another write of the same size within the same mtime tick would leave
+    # its key unchanged.
+
+    def __init__(
+        self,
+        max_bytes=DEFAULT_MAX_CACHE_BYTES,
+        max_file_bytes=DEFAULT_MAX_CACHED_FILE_BYTES,
+    ):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, st):
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, path):
+        # Returns a CachedContent, or None if the file is too large to cache.
+        # Raises OSError if it cannot be read.
+        st = os.stat(path)
+        key = self._key(st)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.key == key:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="content", result="hit")
+                return entry
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache="content", result="miss")
+        if st.st_size > self.max_file_bytes:
+            return None
+        with open(path, "r", newline="") as f:
+            raw = f.read()
+        FILE_BYTES.inc(st.st_size, direction="read")
+        entry = CachedContent(key, raw)
+        self._store(path, entry)
+        return entry
+    def put(self, path, content):
+        # Records content just written to path
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            return
+        if st.st_size > self.max_file_bytes:
+            self.invalidate(path)
+            return
+        self._store(path, CachedContent(self._key(st), content))
+
+    def _store(self, path, entry):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self.bytes -= old.size
+            if time.time_ns() - entry.key[2] <= RACY_MTIME_NS:
+                return
+            self._entries[path] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+
+    def invalidate(self, path):
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None:
+                self.bytes -= entry.size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
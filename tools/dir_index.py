@@ -0,0 +1,230 @@
+import fnmatch
+import os
+import re
+import threading
+import time
+
+DEFAULT_IGNORE_NAMES = (
+    "node_modules",
+    "__pycache__",
+    "venv",
+    ".venv",
+    ".git",
+    ".next",
+    ".cache",
+)
+DEFAULT_MAX_ENTRIES = 2000
+# Directories modified this recently are rescanned on every listing, since a
+# second change within the same mtime tick would otherwise go unnoticed.
+RACY_MTIME_NS = 2 * 1_000_000_000
+
+
+def _glob_to_regex(pattern):
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            parts.append("/.*")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            end = pattern.find("]", i + 1)
+            if end == -1:
+                parts.append(re.escape(pattern[i]))
+                i += 1
+            else:
+                # fnmatch already knows how to turn a bracket class into a regex
+                parts.append(fnmatch.translate(pattern[i : end + 1])[4:-3])
+                i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(parts)
+
+
+class GitignoreRules:
+    # The subset of .gitignore syntax that matters for listings: comments,
+    # negation, directory-only patterns, anchored patterns and ** globs.
+
+    def __init__(self, lines):
+        self.rules = []
+        for line in lines:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                regex = _glob_to_regex(line.lstrip("/"))
+            else:
+                regex = "(?:.*/)?" + _glob_to_regex(line)
+            self.rules.append((re.compile(regex + r"\Z"), negate, dir_only))
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r", errors="replace") as f:
+            return cls(f.readlines())
+
+    def match(self, relative_path, is_dir, ignored):
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative_path):
+                ignored = not negate
+        return ignored
+
+
+class DirectoryIndex:
+    # Cached view of one workspace tree. Each directory's entries are kept
+    # together with the directory's mtime, so a repeated listing costs one
+    # stat per visited directory and only changed directories are rescanned.
+
+    def __init__(self, root, ignore_names=DEFAULT_IGNORE_NAMES, max_entries=DEFAULT_MAX_ENTRIES):
+        self.root = os.path.abspath(root)
+        self.ignore_names = set(ignore_names)
+        self.max_entries = max_entries
+        self._dirs = {}
+        self._gitignores = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, path=None):
+        if path is None:
+            self._dirs.clear()
+            self._gitignores.clear()
+        else:
+            self._dirs.pop(os.path.abspath(path), None)
+
+    def _entries(self, path):
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self._dirs.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append((entry.name, is_dir))
+        entries.sort()
+        if time.time_ns() - mtime_ns > RACY_MTIME_NS:
+            self._dirs[path] = (mtime_ns, entries)
+        else:
+            self._dirs.pop(path, None)
+        return entries
+
+    def _gitignore(self, path):
+        gitignore_path = os.path.join(path, ".gitignore")
+        try:
+            mtime_ns = os.stat(gitignore_path).st_mtime_ns
+        except OSError:
+            return None
+        cached = self._gitignores.get(gitignore_path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+        rules = GitignoreRules.from_file(gitignore_path)
+        self._gitignores[gitignore_path] = (mtime_ns, rules)
+        return rules
+
+    def _ignored(self, full_path, is_dir, gitignores):
+        ignored = False
+        for base, rules in gitignores:
+            relative_path = full_path[len(base) + 1 :]
+            ignored = rules.match(relative_path, is_dir, ignored)
+        return ignored
+
+    def _inherited_gitignores(self, path):
+        # .gitignore files in the directories above path, down from the root
+        gitignores = []
+        if path == self.root or not path.startswith(self.root + os.sep):
+            return gitignores
+        current = self.root
+        parents = path[len(self.root) + 1 :].split(os.sep)[:-1]
+        for part in [None] + parents:
+            if part is not None:
+                current = os.path.join(current, part)
+            rules = self._gitignore(current)
+            if rules is not None:
+                gitignores.append((current, rules))
+        return gitignores
+
+    def list(self, path, depth, max_entries=None):
+        # Returns (paths, omitted) where paths are absolute, in sorted
+        # depth-first order, and omitted maps each top-level directory under
+        # path to the number of entries left out once the cap was reached.
+        path = os.path.abspath(path)
+        if max_entries is None:
+            max_entries = self.max_entries
+        result = []
+        omitted = {}
+
+        def walk(current_path, current_depth, gitignores, top_level):
+            if current_depth > depth:
+                return
+            rules = self._gitignore(current_path)
+            if rules is not None:
+                gitignores = gitignores + [(current_path, rules)]
+            for name, is_dir in self._entries(current_path):
+                if name.startswith(".") or name in self.ignore_names:
+                    continue
+                full_path = os.path.join(current_path, name)
+                if gitignores and self._ignored(full_path, is_dir, gitignores):
+                    continue
+                group = top_level or full_path
+                if len(result) < max_entries:
+                    result.append(full_path)
+                else:
+                    omitted[group] = omitted.get(group, 0) + 1
+                if is_dir:
+                    walk(full_path, current_depth + 1, gitignores, group)
+
+        walk(path, 1, self._inherited_gitignores(path), None)
+        return result, omitted
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def parse_ignore_names(value):
+    # A comma-separated list such as TEXT_EDITOR_IGNORE, or None for the
+    # defaults when it is unset or empty
+    if not value:
+        return None
+    return tuple(name.strip() for name in value.split(",") if name.strip())
+
+
+def get_directory_index(root, ignore_names=None, **kwargs):
+    # One index per workspace root, shared by every TextEditTools instance for
+    # it so the cache survives across goals. ignore_names of None keeps the
+    # index's current list.
+    root = os.path.abspath(root)
+    with _indexes_lock:
+        index = _indexes.get(root)
+        if index is None:
+            index = DirectoryIndex(root, ignore_names or DEFAULT_IGNORE_NAMES, **kwargs)
+            _indexes[root] = index
+        elif ignore_names is not None and set(ignore_names) != index.ignore_names:
+            index.ignore_names = set(ignore_names)
+            index.invalidate()
+        return index
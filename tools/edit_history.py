@@ -0,0 +1,224 @@
+import os
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+DEFAULT_MAX_FILE_BYTES = 16 * 1024 * 1024
+DEFAULT_MAX_MEMORY_BYTES = 64 * 1024 * 1024
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+# Rough per-entry bookkeeping cost so thousands of tiny deltas still count.
+ENTRY_OVERHEAD = 64
+
+
+def _checksum(text):
+    return (len(text), zlib.crc32(text.encode("utf-8", "surrogatepass")))
+
+
+class _HistoryEntry:
+    __slots__ = ("seq", "start", "new_len", "old_text", "after_checksum", "size", "spill_path")
+
+    def __init__(self, seq, start, new_len, old_text, after_checksum):
+        self.seq = seq
+        self.start = start
+        self.new_len = new_len
+        self.old_text = old_text
+        self.after_checksum = after_checksum
+        self.size = len(old_text) + ENTRY_OVERHEAD
+        self.spill_path = None
+
+
+class EditHistory:
+    # Undo stacks of reverse deltas, one stack per file. Each entry records
+    # that after[start:start + new_len] replaced old_text, which is enough to
+    # rebuild the previous content from the current one. Retained history is
+    # capped per file and per directory; the oldest entries are spilled to
+    # disk (when spill_dir is set) or dropped.
+
+    def __init__(
+        self,
+        max_file_bytes=DEFAULT_MAX_FILE_BYTES,
+        max_memory_bytes=DEFAULT_MAX_MEMORY_BYTES,
+        spill_dir=None,
+        max_disk_bytes=DEFAULT_MAX_DISK_BYTES,
+    ):
+        self.max_file_bytes = max_file_bytes
+        self.max_memory_bytes = max_memory_bytes
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self._stacks = {}
+        self._file_bytes = {}
+        # seq -> path, oldest first, for the directory-wide caps
+        self._in_memory = OrderedDict()
+        self._on_disk = OrderedDict()
+        self._seq = 0
+        self._spill_prefix = uuid.uuid4().hex
+        # Edits to different files of one directory share the caps above
+        self._lock = threading.RLock()
+
+    def __contains__(self, path):
+        with self._lock:
+            return bool(self._stacks.get(path))
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(stack) for stack in self._stacks.values())
+
+    def depth(self, path):
+        with self._lock:
+            return len(self._stacks.get(path, ()))
+
+    def paths(self):
+        with self._lock:
+            return [path for path, stack in self._stacks.items() if stack]
+
+    def record(self, path, after, start, new_len, old_text):
+        with self._lock:
+            self._seq += 1
+            entry = _HistoryEntry(self._seq, start, new_len, old_text, _checksum(after))
+            self._stacks.setdefault(path, []).append(entry)
+            self._file_bytes[path] = self._file_bytes.get(path, 0) + entry.size
+            self._in_memory[entry.seq] = path
+            self.memory_bytes += entry.size
+            self._enforce_limits(path)
+
+    def reset(self, path, content):
+        # A freshly created file starts a new history whose single entry
+        # restores the created text, as the full-copy history used to.
+        with self._lock:
+            self.clear(path)
+            self.record(path, content, 0, len(content), content)
+
+    def clear(self, path):
+        with self._lock:
+            for entry in self._stacks.pop(path, []):
+                self._forget(path, entry)
+            self._file_bytes.pop(path, None)
+
+    def undo(self, path, current):
+        # Returns the content before the most recent retained edit, or None
+        # when there is nothing to undo. Raises ValueError if the file no
+        # longer matches what the last edit wrote, since a reverse delta
+        # cannot be applied to content it was not computed against.
+        with self._lock:
+            stack = self._stacks.get(path)
+            if not stack:
+                return None
+            entry = stack[-1]
+            if _checksum(current) != entry.after_checksum:
+                raise ValueError("file changed since the last recorded edit")
+            old_text = self._load(entry)
+            stack.pop()
+            self._file_bytes[path] -= entry.size
+            self._forget(path, entry)
+        return current[: entry.start] + old_text + current[entry.start + entry.new_len :]
+
+    def to_state(self):
+        # JSON-serializable snapshot of every stack. Spilled entries refer to
+        # their spill file, which is left on disk for restore.
+        with self._lock:
+            entries = []
+            for path, stack in self._stacks.items():
+                for entry in stack:
+                    entries.append(
+                        {
+                            "path": path,
+                            "seq": entry.seq,
+                            "start": entry.start,
+                            "new_len": entry.new_len,
+                            "old_text": entry.old_text,
+                            "after_checksum": list(entry.after_checksum),
+                            "size": entry.size,
+                            "spill_path": entry.spill_path,
+                        }
+                    )
+            entries.sort(key=lambda data: data["seq"])
+            return {"entries": entries}
+
+    def restore(self, state):
+        # Replaces the stacks of every path in state, oldest entry first so
+        # the caps evict in the same order as before
+        with self._lock:
+            for path in {data["path"] for data in state["entries"]}:
+                self.clear(path)
+            for data in state["entries"]:
+                path = data["path"]
+                self._seq += 1
+                entry = _HistoryEntry(
+                    self._seq,
+                    data["start"],
+                    data["new_len"],
+                    data["old_text"] or "",
+                    tuple(data["after_checksum"]),
+                )
+                entry.size = data["size"]
+                self._stacks.setdefault(path, []).append(entry)
+                self._file_bytes[path] = self._file_bytes.get(path, 0) + entry.size
+                if data["spill_path"] is not None:
+                    entry.old_text = None
+                    entry.spill_path = data["spill_path"]
+                    self._on_disk[entry.seq] = path
+                    self.disk_bytes += entry.size
+                else:
+                    self._in_memory[entry.seq] = path
+                    self.memory_bytes += entry.size
+            for path in self.paths():
+                self._enforce_limits(path)
+
+    def _load(self, entry):
+        if entry.old_text is not None:
+            return entry.old_text
+        with open(entry.spill_path, "r", encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def _forget(self, path, entry):
+        if entry.spill_path is not None:
+            self._on_disk.pop(entry.seq, None)
+            self.disk_bytes -= entry.size
+            try:
+                os.remove(entry.spill_path)
+            except OSError:
+                pass
+        else:
+            self._in_memory.pop(entry.seq, None)
+            self.memory_bytes -= entry.size
+
+    def _drop_oldest(self, path):
+        stack = self._stacks[path]
+        entry = stack.pop(0)
+        self._file_bytes[path] -= entry.size
+        self._forget(path, entry)
+
+    def _spill(self, path, entry):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        spill_path = os.path.join(self.spill_dir, f"{self._spill_prefix}-{entry.seq}.txt")
+        with open(spill_path, "w", encoding="utf-8", newline="") as f:
+            f.write(entry.old_text)
+        del self._in_memory[entry.seq]
+        self.memory_bytes -= entry.size
+        entry.old_text = None
+        entry.spill_path = spill_path
+        self._on_disk[entry.seq] = path
+        self.disk_bytes += entry.size
+
+    def _enforce_limits(self, path):
+        # Always keep the newest entry of the file just edited, even if it is
+        # larger than the caps on its own.
+        while self._file_bytes[path] > self.max_file_bytes and len(self._stacks[path]) > 1:
+            self._drop_oldest(path)
+
+        while self.memory_bytes > self.max_memory_bytes and len(self._in_memory) > 1:
+            seq, oldest_path = next(iter(self._in_memory.items()))
+            if seq == self._seq:
+                break
+            if self.spill_dir is None:
+                self._drop_oldest(oldest_path)
+                continue
+            entry = next(e for e in self._stacks[oldest_path] if e.seq == seq)
+            self._spill(oldest_path, entry)
+
+        while self.disk_bytes > self.max_disk_bytes and self._on_disk:
+            _, oldest_path = next(iter(self._on_disk.items()))
+            self._drop_oldest(oldest_path)
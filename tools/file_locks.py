@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# When atomic_write calls fsync: "never" leaves flushing to the OS, "file"
+# syncs the new content before it is renamed into place, "full" also syncs
+# the directory so the rename itself survives a crash.
+FSYNC_POLICIES = ("never", "file", "full")
+DEFAULT_FSYNC_POLICY = "never"
+
+
+def _read_umask():
+    # os.umask can only be read by setting it, which is not thread-safe, so
+    # read it once at import
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# mkstemp creates files as 0600; new files get the usual open() mode instead
+_UMASK = _read_umask()
+
+
+class ReadWriteLock:
+    # Any number of readers or one writer. Waiting writers block new readers,
+    # so a steady stream of views cannot starve an edit.
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+
+class PathLocks:
+    # One ReadWriteLock per path, created on first use and dropped once no
+    # thread holds or waits for it, so the table only grows with the number
+    # of paths in use at the same time.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+
+    def _checkout(self, path):
+        with self._lock:
+            entry = self._locks.get(path)
+            if entry is None:
+                entry = self._locks[path] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, path):
+        with self._lock:
+            entry = self._locks[path]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[path]
+
+    @contextmanager
+    def read(self, path):
+        lock = self._checkout(path)
+        lock.acquire_read()
+        try:
+            yield
+        finally:
+            lock.release_read()
+            self._checkin(path)
+
+    @contextmanager
+    def write(self, path):
+        lock = self._checkout(path)
+        lock.acquire_write()
+        try:
+            yield
+        finally:
+            lock.release_write()
+            self._checkin(path)
+
+    def __len__(self):
+        return len(self._locks)
+
+
+def atomic_write(path, content, fsync=DEFAULT_FSYNC_POLICY):
+    # Writes to a temporary file next to path and renames it over path, so
+    # readers see either the old or the new content, never a partial write.
+    # The temporary name starts with a dot, which directory listings skip.
+    # Returns the number of bytes written.
+    if fsync not in FSYNC_POLICIES:
+        raise ValueError(f"Unknown fsync policy: {fsync}")
+    directory, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            written = f.tell()
+            if fsync != "never":
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o666 & ~_UMASK)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    if fsync == "full":
+        dir_fd = os.open(directory or ".", os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    return written
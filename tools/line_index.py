@@ -0,0 +1,90 @@
+import os
+import re
+import threading
+from array import array
+from collections import OrderedDict
+
+from tools.metrics import CACHE_LOOKUPS
+
+SCAN_CHUNK_SIZE = 1024 * 1024
+# Line endings as universal newlines see them, like the cached path
+_LINE_END = re.compile(rb"\r\n?|\n")
+DEFAULT_MAX_INDEXED_FILES = 64
+
+
+class LineIndex:
+    # Byte offsets of line starts in one file, discovered lazily: the file is
+    # only scanned as far as the furthest line requested so far.
+
+    def __init__(self, key):
+        self.key = key
+        self.starts = array("Q", [0])
+        self.scanned = 0
+        self.complete = False
+        # Concurrent views of the same file share one index
+        self.lock = threading.Lock()
+
+    def _extend(self, f, target_line):
+        while len(self.starts) <= target_line and not self.complete:
+            f.seek(self.scanned)
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            if not chunk:
+                self.complete = True
+                break
+            if b"\r" in chunk:
+                if chunk.endswith(b"\r"):
+                    # So a \r\n split between chunks is seen as one ending
+                    chunk += f.read(1)
+                self.starts.extend(self.scanned + m.end() for m in _LINE_END.finditer(chunk))
+            else:
+                pos = chunk.find(b"\n")
+                while pos != -1:
+                    self.starts.append(self.scanned + pos + 1)
+                    pos = chunk.find(b"\n", pos + 1)
+            self.scanned += len(chunk)
+
+    def offset(self, f, line):
+        # Byte offset where 0-based line starts, or None past the end of file
+        with self.lock:
+            self._extend(f, line + 1)
+            if line < self.line_count_so_far():
+                return self.starts[line]
+            return None
+
+    def line_count(self, f):
+        with self.lock:
+            self._extend(f, float("inf"))
+            return self.line_count_so_far()
+
+    def line_count_so_far(self):
+        count = len(self.starts)
+        if self.complete and self.starts[-1] == self.scanned:
+            # A trailing newline (or an empty file) does not start a new line
+            count -= 1
+        return count
+
+
+class LineIndexCache:
+    def __init__(self, max_files=DEFAULT_MAX_INDEXED_FILES):
+        self.max_files = max_files
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            index = self._indexes.get(path)
+            hit = index is not None and index.key == key
+            CACHE_LOOKUPS.inc(cache="line_index", result="hit" if hit else "miss")
+            if not hit:
+                index = LineIndex(key)
+                self._indexes[path] = index
+                while len(self._indexes) > self.max_files:
+                    self._indexes.popitem(last=False)
+            self._indexes.move_to_end(path)
+            return index
+
+    def invalidate(self, path):
+        with self._lock:
+            self._indexes.pop(path, None)
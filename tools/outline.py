@@ -0,0 +1,241 @@
+import ast
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from tools.metrics import CACHE_LOOKUPS
+
+DEFAULT_MAX_CACHED_OUTLINES = 256
+PYTHON_EXTENSIONS = {".py", ".pyi"}
+JS_EXTENSIONS = {".js", ".jsx", ".mjs", ".cjs", ".ts", ".tsx", ".mts", ".cts"}
+
+_IDENT = r"[A-Za-z_$][\w$]*"
+_MODIFIERS = (
+    r"(?:(?:export|default|declare|abstract|async|static|public|private|protected"
+    r"|readonly|override|get|set)\s+)*"
+)
+_ARROW = rf"(?:async\s+)?(?:(?:<[^>]*>\s*)?\([^)]*\)?|{_IDENT})\s*(?::[^=]+)?=>"
+_JS_DECLARATIONS = [
+    ("class", re.compile(rf"\s*{_MODIFIERS}class\s+({_IDENT})")),
+    ("interface", re.compile(rf"\s*{_MODIFIERS}interface\s+({_IDENT})")),
+    ("enum", re.compile(rf"\s*{_MODIFIERS}(?:const\s+)?enum\s+({_IDENT})")),
+    ("type", re.compile(rf"\s*{_MODIFIERS}type\s+({_IDENT})\s*(?:<.*>)?\s*=")),
+    ("function", re.compile(rf"\s*{_MODIFIERS}function\s*\*?\s*({_IDENT})")),
+    (
+        "function",
+        re.compile(
+            rf"\s*{_MODIFIERS}(?:const|let|var)\s+({_IDENT})\s*(?::[^=]+)?=\s*"
+            rf"(?:async\s+)?(?:function\b|{_ARROW})"
+        ),
+    ),
+]
+# Members of a class or interface body: name(...) or name = (...) =>
+_JS_MEMBERS = [
+    re.compile(rf"\s*{_MODIFIERS}\*?\s*(#?{_IDENT})\s*\??\s*(?:<.*>)?\s*\("),
+    re.compile(rf"\s*{_MODIFIERS}(#?{_IDENT})\s*(?::[^=]+)?=\s*{_ARROW}"),
+]
+_JS_KEYWORDS = {"if", "for", "while", "switch", "catch", "return", "function", "new", "super"}
+# A declaration line ending like this continues on the next line
+_CONTINUATION_ENDINGS = ("=>", "=", ",", "(", ":", "|", "&")
+
+
+class Symbol:
+    __slots__ = ("kind", "name", "start", "end", "depth")
+
+    def __init__(self, kind, name, start, end, depth):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.depth = depth
+
+
+def python_symbols(source):
+    # Raises SyntaxError if source does not parse
+    symbols = []
+
+    def visit(node, depth, in_class):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                kind = "class"
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                kind = "method" if in_class else "function"
+            else:
+                continue
+            # Decorators belong to the definition they decorate
+            start = min([d.lineno for d in child.decorator_list] + [child.lineno])
+            symbols.append(Symbol(kind, child.name, start, child.end_lineno, depth))
+            visit(child, depth + 1, kind == "class")
+
+    visit(ast.parse(source), 0, False)
+    return symbols
+
+
+def _strip_js_line(line, in_comment):
+    # Blanks out comments and the contents of string literals so that braces
+    # inside them are not counted. Template literals spanning several lines
+    # are not tracked.
+    result = []
+    i = 0
+    while i < len(line):
+        if in_comment:
+            end = line.find("*/", i)
+            if end == -1:
+                return "".join(result), True
+            in_comment = False
+            i = end + 2
+            continue
+        if line.startswith("//", i):
+            break
+        if line.startswith("/*", i):
+            in_comment = True
+            i += 2
+            continue
+        char = line[i]
+        if char in "'\"`":
+            end = i + 1
+            while end < len(line) and line[end] != char:
+                end += 2 if line[end] == "\\" else 1
+            result.append(char + char)
+            i = end + 1
+            continue
+        result.append(char)
+        i += 1
+    return "".join(result), in_comment
+
+
+class _OpenSymbol:
+    __slots__ = ("symbol", "base", "opened", "parens")
+
+    def __init__(self, symbol, base):
+        self.symbol = symbol
+        self.base = base
+        self.opened = False
+        self.parens = 0
+
+
+def js_symbols(source):
+    # A line-based parser for JavaScript and TypeScript. Declarations are
+    # recognized at the start of a line; a symbol's body is the first brace
+    # block after its name, and a symbol without one (an expression-bodied
+    # arrow function, a type alias) ends at its semicolon or line.
+    symbols = []
+    stack = []
+    depth = 0
+    in_comment = False
+    for line_number, raw_line in enumerate(source.splitlines(), 1):
+        line, in_comment = _strip_js_line(raw_line, in_comment)
+        top = stack[-1] if stack else None
+        in_body = top is not None and top.opened and depth == top.base + 1
+        kind = name = None
+        if top is None or in_body:
+            for candidate_kind, pattern in _JS_DECLARATIONS:
+                match = pattern.match(line)
+                if match:
+                    kind, name = candidate_kind, match.group(1)
+                    break
+        if kind is None and in_body and top.symbol.kind in ("class", "interface"):
+            for pattern in _JS_MEMBERS:
+                match = pattern.match(line)
+                if match and match.group(1) not in _JS_KEYWORDS:
+                    kind, name = "method", match.group(1)
+                    break
+        if kind is not None:
+            symbol = Symbol(kind, name, line_number, line_number, len(stack))
+            symbols.append(symbol)
+            stack.append(_OpenSymbol(symbol, depth))
+
+        for char in line:
+            top = stack[-1] if stack else None
+            if char == "{":
+                depth += 1
+                if top is not None and not top.opened and depth == top.base + 1:
+                    top.opened = True
+            elif char == "}":
+                depth -= 1
+                if top is not None and top.opened and depth == top.base:
+                    top.symbol.end = line_number
+                    stack.pop()
+            elif top is not None and not top.opened:
+                if char == "(":
+                    top.parens += 1
+                elif char == ")":
+                    top.parens -= 1
+                elif char == ";" and depth == top.base and top.parens <= 0:
+                    top.symbol.end = line_number
+                    stack.pop()
+
+        top = stack[-1] if stack else None
+        if (
+            top is not None
+            and not top.opened
+            and top.parens <= 0
+            and line.strip()
+            and not line.rstrip().endswith(_CONTINUATION_ENDINGS)
+        ):
+            top.symbol.end = line_number
+            stack.pop()
+    for open_symbol in stack:
+        open_symbol.symbol.end = line_number
+    return symbols
+
+
+def format_outline(symbols):
+    return "\n".join(
+        f"{'  ' * symbol.depth}{symbol.kind} {symbol.name} (lines {symbol.start}-{symbol.end})"
+        for symbol in symbols
+    )
+
+
+def outline_language(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PYTHON_EXTENSIONS:
+        return "python"
+    if extension in JS_EXTENSIONS:
+        return "javascript"
+    return None
+
+
+class OutlineCache:
+    # Parsed outlines keyed on the file's (inode, size, mtime), so an outline
+    # is only reparsed after the file changed. Least recently used outlines
+    # are dropped beyond max_files.
+
+    def __init__(self, max_files=DEFAULT_MAX_CACHED_OUTLINES):
+        self.max_files = max_files
+        self._outlines = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        # Returns the file's symbols; raises SyntaxError for Python that does
+        # not parse and ValueError for unsupported file types
+        language = outline_language(path)
+        if language is None:
+            raise ValueError("unsupported file type")
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            cached = self._outlines.get(path)
+            if cached is not None and cached[0] == key:
+                self._outlines.move_to_end(path)
+                self.hits += 1
+                CACHE_LOOKUPS.inc(cache="outline", result="hit")
+                return cached[1]
+            self.misses += 1
+        CACHE_LOOKUPS.inc(cache="outline", result="miss")
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            source = f.read()
+        symbols = python_symbols(source) if language == "python" else js_symbols(source)
+        with self._lock:
+            self._outlines[path] = (key, symbols)
+            self._outlines.move_to_end(path)
+            while len(self._outlines) > self.max_files:
+                self._outlines.popitem(last=False)
+        return symbols
+
+    def invalidate(self, path):
+        with self._lock:
+            self._outlines.pop(path, None)
@@ -0,0 +1,259 @@
+import re
+
+# How far from its stated position a hunk's context is searched for
+DEFAULT_SEARCH_WINDOW = 1000
+# Context lines that may be dropped from each end of a hunk, as patch's fuzz
+DEFAULT_MAX_FUZZ = 2
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+_NO_NEWLINE = "\\ No newline at end of file"
+
+
+class PatchError(ValueError):
+    pass
+
+
+class Hunk:
+    def __init__(self, header, old_start):
+        self.header = header
+        self.old_start = old_start
+        # (tag, text) with tag " ", "-" or "+", text without its newline
+        self.lines = []
+        self.old_missing_newline = False
+        self.new_missing_newline = False
+
+    @property
+    def old_lines(self):
+        return [text for tag, text in self.lines if tag != "+"]
+
+    @property
+    def new_lines(self):
+        return [text for tag, text in self.lines if tag != "-"]
+
+
+class FilePatch:
+    def __init__(self, old_path, new_path):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks = []
+
+    @property
+    def is_new(self):
+        return self.old_path is None
+
+    @property
+    def is_delete(self):
+        return self.new_path is None
+
+    @property
+    def path(self):
+        return self.old_path if self.new_path is None else self.new_path
+
+
+def _diff_path(header):
+    # "--- a/src/x.py\t2024-01-01 ..." -> "src/x.py"; /dev/null -> None
+    path = header[4:].split("\t")[0].strip()
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    if path == "/dev/null":
+        return None
+    if path.startswith(("a/", "b/")):
+        path = path[2:]
+    return path
+
+
+def parse_unified_diff(text):
+    # Returns a FilePatch per file. Lines outside of file and hunk headers
+    # (diff --git, index, commentary) are ignored.
+    patches = []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not (line.startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ ")):
+            i += 1
+            continue
+        patch = FilePatch(_diff_path(line), _diff_path(lines[i + 1]))
+        if patch.old_path is None and patch.new_path is None:
+            raise PatchError("Both sides of a file header are /dev/null")
+        patches.append(patch)
+        i += 2
+        while i < len(lines) and lines[i].startswith("@@"):
+            match = _HUNK_HEADER.match(lines[i])
+            if not match:
+                raise PatchError(f"Malformed hunk header: {lines[i]}")
+            old_count = int(match.group(2) or 1)
+            new_count = int(match.group(4) or 1)
+            hunk = Hunk(lines[i], int(match.group(1)))
+            patch.hunks.append(hunk)
+            i += 1
+            old_seen = new_seen = 0
+            while i < len(lines) and (old_seen < old_count or new_seen < new_count):
+                line = lines[i]
+                if line.startswith(_NO_NEWLINE[:2]):
+                    i += 1
+                    continue
+                tag, body = (line[:1] or " "), line[1:]
+                if tag not in " -+":
+                    raise PatchError(f"Unexpected line in hunk {hunk.header}: {line}")
+                hunk.lines.append((tag, body))
+                old_seen += tag != "+"
+                new_seen += tag != "-"
+                i += 1
+            if old_seen != old_count or new_seen != new_count:
+                raise PatchError(f"Hunk {hunk.header} is truncated")
+            # A marker right after the hunk applies to its last line
+            if i < len(lines) and lines[i].startswith(_NO_NEWLINE[:2]):
+                last_tag = hunk.lines[-1][0] if hunk.lines else " "
+                hunk.old_missing_newline = last_tag != "+"
+                hunk.new_missing_newline = last_tag != "-"
+                i += 1
+        if not patch.hunks and not patch.is_delete:
+            raise PatchError(f"No hunks for {patch.path}")
+    if not patches:
+        raise PatchError("No file headers (--- / +++) found in patch")
+    return patches
+
+
+def patch_paths(text):
+    # Paths a patch touches, or None if it cannot be parsed
+    try:
+        return [patch.path for patch in parse_unified_diff(text)]
+    except PatchError:
+        return None
+
+
+def _matches(lines, position, expected, normalize):
+    if position < 0 or position + len(expected) > len(lines):
+        return False
+    if normalize is None:
+        return lines[position : position + len(expected)] == expected
+    return all(
+        normalize(lines[position + k]) == normalize(expected[k]) for k in range(len(expected))
+    )
+
+
+def _find(lines, expected, hint, lower_bound, window, normalize):
+    # Nearest position at or after lower_bound where expected matches,
+    # searching outward from hint
+    if not expected:
+        return min(max(hint, lower_bound), len(lines))
+    for distance in range(window + 1):
+        for position in (hint - distance, hint + distance) if distance else (hint,):
+            if position >= lower_bound and _matches(lines, position, expected, normalize):
+                return position
+    return None
+
+
+def _leading_context(hunk):
+    count = 0
+    for tag, _ in hunk.lines:
+        if tag != " ":
+            break
+        count += 1
+    return count
+
+
+def _trailing_context(hunk):
+    count = 0
+    for tag, _ in reversed(hunk.lines):
+        if tag != " ":
+            break
+        count += 1
+    return count
+
+
+def apply_hunks(content, hunks, window=DEFAULT_SEARCH_WINDOW, max_fuzz=DEFAULT_MAX_FUZZ):
+    # Returns (new_content, notes) or raises PatchError. Each hunk is looked
+    # for near its stated line (shifted by the hunks before it), first
+    # exactly, then ignoring trailing and then all surrounding whitespace,
+    # then with up to max_fuzz context lines dropped from either end.
+    lines = content.split("\n")
+    ends_with_newline = content.endswith("\n")
+    if ends_with_newline or not content:
+        lines.pop()
+    notes = []
+    offset = 0
+    lower_bound = 0
+    strategies = [
+        (None, ""),
+        (str.rstrip, "ignoring trailing whitespace"),
+        (str.strip, "ignoring indentation"),
+    ]
+    for number, hunk in enumerate(hunks, 1):
+        hint = max(hunk.old_start - 1, 0) + offset
+        if not hunk.old_lines and hunk.old_start == 0:
+            hint = 0
+        found = None
+        for fuzz in range(max_fuzz + 1):
+            leading = min(fuzz, _leading_context(hunk))
+            trailing = min(fuzz, _trailing_context(hunk))
+            if fuzz and not (leading or trailing):
+                break
+            body = hunk.lines[leading : len(hunk.lines) - trailing]
+            old = [text for tag, text in body if tag != "+"]
+            for normalize, description in strategies:
+                position = _find(lines, old, hint + leading, lower_bound, window, normalize)
+                if position is not None:
+                    found = (position, body, description, fuzz)
+                    break
+            if found:
+                break
+        if found is None:
+            raise PatchError(f"hunk {number} ({hunk.header}) does not match the file")
+        position, body, description, fuzz = found
+        old_len = sum(tag != "+" for tag, _ in body)
+        new = [text for tag, text in body if tag != "-"]
+        lines[position : position + old_len] = new
+        shift = position - (hint + min(fuzz, _leading_context(hunk)))
+        details = []
+        if shift:
+            details.append(f"{shift:+d} lines from its stated position")
+        if description:
+            details.append(description)
+        if fuzz:
+            details.append(f"with fuzz {fuzz}")
+        if details:
+            notes.append(f"hunk {number} applied " + ", ".join(details))
+        offset += len(new) - old_len + shift
+        lower_bound = position + len(new)
+        if hunk.new_missing_newline and position + len(new) == len(lines):
+            ends_with_newline = False
+        elif hunk.old_missing_newline and position + len(new) == len(lines):
+            ends_with_newline = True
+    new_content = "\n".join(lines)
+    if lines and ends_with_newline:
+        new_content += "\n"
+    return new_content, notes
+
+
+_SPAN_BLOCK = 4096
+
+
+def changed_span(old, new):
+    # (prefix, suffix): the lengths of the longest common prefix and suffix
+    # of old and new that do not overlap. Compared a block at a time, so a
+    # small change to a large file costs slice comparisons, not a Python
+    # loop over every character.
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit:
+        step = min(_SPAN_BLOCK, limit - prefix)
+        if old[prefix : prefix + step] == new[prefix : prefix + step]:
+            prefix += step
+            continue
+        while old[prefix] == new[prefix]:
+            prefix += 1
+        break
+    limit -= prefix
+    suffix = 0
+    while suffix < limit:
+        step = min(_SPAN_BLOCK, limit - suffix)
+        old_end, new_end = len(old) - suffix, len(new) - suffix
+        if old[old_end - step : old_end] == new[new_end - step : new_end]:
+            suffix += step
+            continue
+        while old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+        break
+    return prefix, suffix
@@ -0,0 +1,235 @@
+import os
+import re
+import stat
+import threading
+
+from tools.metrics import CACHE_LOOKUPS, counter, histogram
+
+DEFAULT_MAX_RESULTS = 50
+MAX_INDEXED_FILES = 100_000
+MAX_FILE_BYTES = 2 * 1024 * 1024
+MAX_SNIPPET_CHARS = 200
+# Files with a NUL byte in their first block are treated as binary
+BINARY_SNIFF_BYTES = 8192
+# Characters that end a run of literal characters in a regex
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+_QUANTIFIERS = set("*?")
+
+
+SEARCH_FILES = counter(
+    "text_editor_search_files_total",
+    "Files under the searched path, and the candidates among them left to scan",
+    ("stage",),
+)
+SEARCH_SECONDS = histogram("text_editor_search_duration_seconds", "Time spent in searches")
+
+
+def _trigrams(text):
+    # Lower-cased so case-insensitive queries can use the same index
+    text = text.lower()
+    return set(zip(text, text[1:], text[2:]))
+
+
+def _required_literals(pattern):
+    # Literal runs that every match of pattern must contain. Only the top
+    # level of the pattern is considered; with an alternation there, nothing
+    # is required.
+    literals = []
+    run = []
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            escaped = pattern[i + 1 : i + 2]
+            i += 2
+            if depth == 0 and escaped and not escaped.isalnum():
+                run.append(escaped)
+                continue
+            literals.append("".join(run))
+            run = []
+            continue
+        if char == "[":
+            # Skip the class; a ] right after [ or [^ is part of it
+            end = i + 1
+            if pattern[end : end + 1] == "^":
+                end += 1
+            if pattern[end : end + 1] == "]":
+                end += 1
+            end = pattern.find("]", end)
+            i = len(pattern) if end == -1 else end + 1
+            literals.append("".join(run))
+            run = []
+            continue
+        if char == "{" and depth == 0:
+            # A counted repeat: the character before it may not appear, and
+            # the digits inside are not literals
+            end = pattern.find("}", i)
+            if run:
+                run.pop()
+            literals.append("".join(run))
+            run = []
+            i = len(pattern) if end == -1 else end + 1
+            continue
+        if char == "|" and depth == 0:
+            return []
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        if depth > 0 or char in _REGEX_SPECIAL:
+            if char in _QUANTIFIERS and run:
+                # The quantified character may not appear at all
+                run.pop()
+            literals.append("".join(run))
+            run = []
+        else:
+            run.append(char)
+        i += 1
+    literals.append("".join(run))
+    return [literal for literal in literals if len(literal) >= 3]
+
+
+class SearchIndex:
+    # Trigram index over the files of one workspace. Each file's trigrams are
+    # kept together with its (mtime, size); a search first re-stats the files
+    # under the searched path (through the shared DirectoryIndex, so
+    # unchanged directories are not rescanned) and reindexes only the files
+    # that changed. The editing tools also mark the files they write as
+    # stale, so their own edits are seen even within the same mtime tick.
+
+    def __init__(self, dir_index):
+        self.dir_index = dir_index
+        self._files = {}
+        self._postings = {}
+        self._stale = set()
+        self._lock = threading.Lock()
+        self.files_indexed = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def _add(self, path, key, trigrams):
+        # trigrams is None for binary and oversized files, which are tracked
+        # but never searched
+        self._remove(path)
+        self._files[path] = (key, trigrams)
+        for trigram in trigrams or ():
+            self._postings.setdefault(trigram, set()).add(path)
+        self.files_indexed += 1
+
+    def _remove(self, path):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            return
+        for trigram in entry[1] or ():
+            paths = self._postings[trigram]
+            paths.discard(path)
+            if not paths:
+                del self._postings[trigram]
+
+    def _read(self, path, st):
+        if st.st_size > MAX_FILE_BYTES:
+            return None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if b"\0" in data[:BINARY_SNIFF_BYTES]:
+            return None
+        return data.decode("utf-8", errors="replace")
+
+    def update(self, path):
+        # Called after an edit. The file is reindexed by the next search that
+        # covers it, so a burst of edits costs nothing until then.
+        with self._lock:
+            self._stale.add(os.path.abspath(path))
+
+    def remove(self, path):
+        with self._lock:
+            path = os.path.abspath(path)
+            self._stale.discard(path)
+            self._remove(path)
+
+    def _refresh(self, root):
+        listed, _ = self.dir_index.list(root, float("inf"), MAX_INDEXED_FILES)
+        seen = set()
+        for path in listed:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            seen.add(path)
+            key = (st.st_mtime_ns, st.st_size)
+            entry = self._files.get(path)
+            if entry is None or entry[0] != key or path in self._stale:
+                CACHE_LOOKUPS.inc(cache="search_index", result="miss")
+                self._stale.discard(path)
+                content = self._read(path, st)
+                self._add(path, key, _trigrams(content) if content is not None else None)
+            else:
+                CACHE_LOOKUPS.inc(cache="search_index", result="hit")
+        prefix = root + os.sep
+        for path in [p for p in self._files if p.startswith(prefix) and p not in seen]:
+            self._remove(path)
+        return sorted(path for path in seen if self._files[path][1] is not None)
+
+    def candidates(self, root, literals):
+        # Files under root that contain every trigram of every literal
+        root = os.path.abspath(root)
+        with self._lock:
+            paths = self._refresh(root)
+            SEARCH_FILES.inc(len(paths), stage="indexed")
+            for literal in literals:
+                for trigram in _trigrams(literal):
+                    posting = self._postings.get(trigram, ())
+                    paths = [path for path in paths if path in posting]
+            SEARCH_FILES.inc(len(paths), stage="candidate")
+            return paths
+
+    def search(self, root, query, regex=False, ignore_case=False, max_results=DEFAULT_MAX_RESULTS):
+        # Returns ([(path, line_number, line)], truncated). Raises re.error
+        # for an invalid regex.
+        flags = re.IGNORECASE if ignore_case else 0
+        if regex:
+            compiled = re.compile(query, flags)
+            # Whitespace and comments in verbose patterns are not literal
+            literals = [] if compiled.flags & re.VERBOSE else _required_literals(query)
+        else:
+            compiled = re.compile(re.escape(query), flags)
+            literals = [query] if len(query) >= 3 else []
+        with SEARCH_SECONDS.time():
+            return self._scan(self.candidates(root, literals), compiled, max_results)
+
+    def _scan(self, paths, compiled, max_results):
+        matches = []
+        for path in paths:
+            try:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    for line_number, line in enumerate(f, 1):
+                        if compiled.search(line):
+                            if len(matches) == max_results:
+                                return matches, True
+                            matches.append((path, line_number, line.rstrip("\r\n")))
+            except OSError:
+                continue
+        return matches, False
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_search_index(dir_index):
+    # One index per workspace root, shared by every TextEditTools instance for
+    # it, so a new instance (each goal of anthropic_editor makes one) does not
+    # rebuild it from disk
+    with _indexes_lock:
+        index = _indexes.get(dir_index.root)
+        if index is None:
+            index = SearchIndex(dir_index)
+            _indexes[dir_index.root] = index
+        return index
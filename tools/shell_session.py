@@ -0,0 +1,371 @@
+import asyncio
+import codecs
+import os
+import shlex
+import signal
+import time
+import uuid
+
+from tools.metrics import counter, histogram
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_GLOBAL_LIMIT = 8
+DEFAULT_HEAD_CHARS = 16 * 1024
+DEFAULT_TAIL_CHARS = 16 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SESSIONS = 32
+DEFAULT_IDLE_TIMEOUT = 600
+REAP_INTERVAL = 30
+# How long a shell whose output streams closed gets to exit on its own
+# before it is killed
+EXIT_GRACE_SECONDS = 1.0
+SHELL = ("bash", "--noprofile", "--norc")
+
+BASH_SECONDS = histogram(
+    "bash_command_duration_seconds", "Time from a command's start to its exit, in its shell"
+)
+BASH_COMMANDS = counter(
+    "bash_commands_total", "Commands run, by outcome: ok, failed or timeout", ("outcome",)
+)
+BASH_SHELLS_STARTED = counter("bash_shells_started_total", "Shell processes started")
+
+
+class CappedOutput:
+    # Keeps the first head_chars and the last tail_chars of a stream and
+    # counts what was dropped in between.
+
+    def __init__(self, head_chars=DEFAULT_HEAD_CHARS, tail_chars=DEFAULT_TAIL_CHARS):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.head = []
+        self.head_len = 0
+        self.tail = ""
+        self.total = 0
+
+    def append(self, text):
+        self.total += len(text)
+        if self.head_len < self.head_chars:
+            take = text[: self.head_chars - self.head_len]
+            self.head.append(take)
+            self.head_len += len(take)
+            text = text[len(take) :]
+        if text and self.tail_chars:
+            self.tail = (self.tail + text)[-self.tail_chars :]
+
+    @property
+    def omitted(self):
+        return self.total - self.head_len - len(self.tail)
+
+    def render(self):
+        head = "".join(self.head)
+        if self.omitted > 0:
+            return f"{head}\n... [{self.omitted} characters omitted] ...\n{self.tail}"
+        return head + self.tail
+
+
+class _LineReader:
+    # Decodes a byte stream incrementally and hands out text on line
+    # boundaries, so path rewriting never sees a path split across chunks.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.pending = ""
+
+    async def read(self):
+        while True:
+            data = await self.stream.read(READ_CHUNK_SIZE)
+            if not data:
+                text = self.pending + self.decoder.decode(b"", final=True)
+                self.pending = ""
+                return text or None
+            self.pending += self.decoder.decode(data)
+            cut = self.pending.rfind("\n") + 1
+            if cut == 0 and len(self.pending) < READ_CHUNK_SIZE:
+                continue
+            if cut == 0:
+                cut = len(self.pending)
+            text, self.pending = self.pending[:cut], self.pending[cut:]
+            return text
+
+
+class BashResult:
+    def __init__(self, returncode, stdout, stderr, timed_out, session_reset=False):
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        # Set when a persistent shell had to be restarted before the command,
+        # losing its working directory and environment
+        self.session_reset = session_reset
+
+
+class ShellSession:
+    # One long-lived bash process. Commands are written to its stdin, each
+    # followed by printf calls that emit a sentinel line with the exit status
+    # on stdout and another on stderr; a command is complete once both have
+    # been read. cd, exported variables and activated virtualenvs therefore
+    # carry over from one command to the next.
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self.process = None
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+        self.commands_run = 0
+        self.sentinel = f"__SHELL_SESSION_{uuid.uuid4().hex}__"
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        # Also used to replace a shell that timed out or exited
+        self.process = await asyncio.create_subprocess_exec(
+            *SHELL,
+            cwd=self.cwd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        self._readers = {
+            "stdout": _LineReader(self.process.stdout),
+            "stderr": _LineReader(self.process.stderr),
+        }
+
+    def _script(self, command):
+        # eval keeps a syntax error in the command from breaking the framing,
+        # and stdin comes from /dev/null so the command cannot read the
+        # framing lines that follow it. The leading newline puts the sentinel
+        # on a line of its own; _pump drops it again.
+        return (
+            f"eval {shlex.quote(command)} < /dev/null\n"
+            f"printf '\\n%s %d\\n' {self.sentinel} $?\n"
+            f"printf '\\n%s\\n' {self.sentinel} >&2\n"
+        )
+
+    async def _pump(self, name, outputs, on_output, rewrite):
+        # Reads one stream up to its sentinel. Returns the sentinel line, or
+        # None if the shell exited first.
+        reader = self._readers[name]
+        held = ""
+
+        async def emit(text):
+            if not text:
+                return
+            if rewrite is not None:
+                text = rewrite(text)
+            outputs[name].append(text)
+            if on_output is not None:
+                await on_output(name, text)
+
+        while True:
+            text = await reader.read()
+            if text is None:
+                await emit(held)
+                return None
+            text = held + text
+            held = ""
+            pos = text.find("\n" + self.sentinel)
+            if pos != -1:
+                end = text.find("\n", pos + 1)
+                end = len(text) if end == -1 else end + 1
+                await emit(text[:pos])
+                # Output of background jobs after the sentinel belongs to
+                # whatever runs next
+                reader.pending = text[end:] + reader.pending
+                return text[pos + 1 : end].strip()
+            # A trailing newline may be the one printed before the sentinel
+            if text.endswith("\n"):
+                text, held = text[:-1], "\n"
+            await emit(text)
+
+    async def run(self, command, timeout, outputs, on_output=None, rewrite=None):
+        # Returns (returncode, timed_out, killed). After a timeout, or if the
+        # command exits the shell, the session is dead and must be replaced.
+        # killed is set when the command closed or redirected the shell's
+        # stdout or stderr (exec >log), which leaves no way to frame what
+        # follows, so the still running shell was killed.
+        self.commands_run += 1
+        deadline = time.monotonic() + timeout
+        pumps = []
+        try:
+            self.process.stdin.write(self._script(command).encode())
+            await self.process.stdin.drain()
+            pumps = [
+                asyncio.ensure_future(self._pump("stdout", outputs, on_output, rewrite)),
+                asyncio.ensure_future(self._pump("stderr", outputs, on_output, rewrite)),
+            ]
+            pending = set(pumps)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(deadline - time.monotonic(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    await self.close()
+                    return -signal.SIGKILL, True, False
+                # A stream closed before its sentinel: the other one may
+                # never see its own, so it only gets a moment to finish
+                if any(task.result() is None for task in done):
+                    if pending:
+                        grace = min(EXIT_GRACE_SECONDS, max(deadline - time.monotonic(), 0))
+                        await asyncio.wait(pending, timeout=grace)
+                    break
+            ends = [task.result() if task.done() else None for task in pumps]
+        except (BrokenPipeError, ConnectionResetError):
+            ends = [None, None]
+        except BaseException:
+            # Includes cancellation when a streaming client disconnects; the
+            # shell may be mid-command, so it cannot be reused
+            await self.close()
+            raise
+        finally:
+            for task in pumps:
+                task.cancel()
+            self.last_used = time.monotonic()
+        stdout_end = ends[0]
+        if None not in ends:
+            return int(stdout_end.rsplit(" ", 1)[1]), False, False
+        grace = min(EXIT_GRACE_SECONDS, max(deadline - time.monotonic(), 0))
+        try:
+            returncode = await asyncio.wait_for(self.process.wait(), grace)
+            killed = False
+        except asyncio.TimeoutError:
+            await self.close()
+            returncode = self.process.returncode
+            killed = True
+        if stdout_end is not None:
+            returncode = int(stdout_end.rsplit(" ", 1)[1])
+        return returncode, False, killed
+
+    async def close(self):
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        await self.process.wait()
+
+
+class ShellSessionManager:
+    # One ShellSession per workspace directory, created on first use and
+    # reused by later commands. Commands in the same workspace run one at a
+    # time, in arrival order; at most global_limit run at once overall.
+    # Sessions idle for idle_timeout seconds are closed by a background
+    # reaper, and beyond max_sessions the least recently used idle session
+    # is closed to make room.
+
+    def __init__(
+        self,
+        global_limit=DEFAULT_GLOBAL_LIMIT,
+        max_sessions=DEFAULT_MAX_SESSIONS,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        head_chars=DEFAULT_HEAD_CHARS,
+        tail_chars=DEFAULT_TAIL_CHARS,
+    ):
+        self.global_limit = global_limit
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.sessions = {}
+        self.sessions_started = 0
+        self.sessions_reaped = 0
+        self._global_semaphore = None
+        self._reaper = None
+
+    def _ensure_background(self):
+        # Created lazily so they bind to the event loop the service runs on
+        if self._global_semaphore is None:
+            self._global_semaphore = asyncio.Semaphore(self.global_limit)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_forever())
+
+    def _session(self, directory, cwd):
+        session = self.sessions.get(directory)
+        if session is None:
+            session = ShellSession(cwd)
+            self.sessions[directory] = session
+        return session
+
+    async def _make_room(self, keep):
+        idle = [
+            (session.last_used, directory)
+            for directory, session in self.sessions.items()
+            if directory != keep and not session.lock.locked()
+        ]
+        for _, directory in sorted(idle)[: max(len(self.sessions) - self.max_sessions, 0)]:
+            await self.sessions.pop(directory).close()
+            self.sessions_reaped += 1
+
+    async def run(
+        self, directory, command, cwd, timeout=DEFAULT_TIMEOUT, on_output=None, rewrite=None
+    ):
+        # on_output, if given, is awaited with (stream_name, text) as output
+        # arrives; rewrite is applied to each piece of text first. cwd is where
+        # a new session starts
+        self._ensure_background()
+        session = self._session(directory, cwd)
+        async with session.lock, self._global_semaphore:
+            # The session may have been reaped while this command waited
+            self.sessions.setdefault(directory, session)
+            reset = False
+            if not session.alive:
+                # A shell that timed out or exited is replaced by a fresh one
+                reset = session.process is not None
+                await session.start()
+                self.sessions_started += 1
+                BASH_SHELLS_STARTED.inc()
+                await self._make_room(directory)
+            outputs = {
+                "stdout": CappedOutput(self.head_chars, self.tail_chars),
+                "stderr": CappedOutput(self.head_chars, self.tail_chars),
+            }
+            with BASH_SECONDS.time():
+                returncode, timed_out, killed = await session.run(
+                    command, timeout, outputs, on_output, rewrite
+                )
+            if timed_out:
+                BASH_COMMANDS.inc(outcome="timeout")
+            else:
+                BASH_COMMANDS.inc(outcome="ok" if returncode == 0 else "failed")
+            return BashResult(
+                returncode,
+                outputs["stdout"].render(),
+                outputs["stderr"].render(),
+                timed_out,
+                session_reset=reset or killed,
+            )
+
+    async def _reap_forever(self):
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            await self.reap_idle()
+
+    async def reap_idle(self):
+        now = time.monotonic()
+        for directory, session in list(self.sessions.items()):
+            if not session.lock.locked() and now - session.last_used > self.idle_timeout:
+                if self.sessions.get(directory) is session:
+                    del self.sessions[directory]
+                await session.close()
+                self.sessions_reaped += 1
+
+    async def close_all(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            await session.close()
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "sessions_started": self.sessions_started,
+            "sessions_reaped": self.sessions_reaped,
+        }
@@ -0,0 +1,417 @@
+import contextlib
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import quote
+
+from tools.dir_index import RACY_MTIME_NS
+from tools.file_locks import ReadWriteLock, atomic_write
+from tools.metrics import counter, histogram
+
+# Shared by every workspace, so identical files are stored once across all
+# of them
+SNAPSHOT_ROOT = os.path.join("work_dir", ".snapshots")
+# Snapshots kept per workspace; older ones are pruned after each checkpoint
+DEFAULT_KEEP_SNAPSHOTS = 20
+_CHUNK_BYTES = 1024 * 1024
+_SNAPSHOT_ID = re.compile(r"\d{8}-\d{6}-\d{6}")
+
+SNAPSHOT_SECONDS = histogram(
+    "text_editor_snapshot_duration_seconds", "Time spent taking and restoring snapshots", ("op",)
+)
+SNAPSHOT_FILES = counter(
+    "text_editor_snapshot_files_total",
+    "Files checkpointed (hashed or reused unread) and restored (written or deleted)",
+    ("action",),
+)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _walk(root, skip=None):
+    # (relative path, DirEntry) of everything under root, without following
+    # symlinks, except the directory skip and what is in it
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        with os.scandir(os.path.join(root, relative)) as it:
+            for entry in it:
+                if skip is not None and os.path.abspath(entry.path) == skip:
+                    continue
+                path = os.path.join(relative, entry.name) if relative else entry.name
+                yield path, entry
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(path)
+
+
+class RestorePlan:
+    # What restoring a snapshot changes, computed before anything is touched.
+    # Paths are relative to the workspace.
+
+    def __init__(self, snapshot_id, root):
+        self.snapshot_id = snapshot_id
+        self.root = root
+        self.remove_files = []
+        self.remove_dirs = []
+        self.make_dirs = []
+        self.write = []
+        self.links = []
+        self.chmods = []
+
+    def paths(self):
+        # The files whose content changes, for locking and cache invalidation
+        changed = self.remove_files + [path for path, _, _ in self.write]
+        return [os.path.join(self.root, path) for path in changed]
+
+    def __bool__(self):
+        return bool(
+            self.remove_files or self.remove_dirs or self.make_dirs
+            or self.write or self.links or self.chmods
+        )
+
+
+class SnapshotStore:
+    # Whole-workspace snapshots in a content-addressed store. Each distinct
+    # file content is kept once, as blobs/<sha256>; a snapshot is a manifest
+    # mapping paths to blobs. A checkpoint reuses the hash of any file whose
+    # size, mtime and inode match the previous snapshot, so an unchanged tree
+    # costs one stat per file, and a restore rewrites only the files that
+    # differ from the snapshot.
+
+    def __init__(self, root=SNAPSHOT_ROOT, keep=DEFAULT_KEEP_SNAPSHOTS):
+        # Absolute, so a checkpoint of work_dir itself can leave the store out
+        self.root = os.path.abspath(root)
+        self.keep = keep
+        self.blob_dir = os.path.join(root, "blobs")
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        # Checkpoints share it; garbage collection takes it alone, so it
+        # cannot remove a blob that a checkpoint has just found and reused
+        self._gc_lock = ReadWriteLock()
+
+    def _lock(self, name):
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    @contextlib.contextmanager
+    def pin_blobs(self):
+        # Garbage collection waits while this is held, so blobs found by a
+        # checkpoint or a restore plan are still there when they are used
+        self._gc_lock.acquire_read()
+        try:
+            yield
+        finally:
+            self._gc_lock.release_read()
+
+    def _manifest_dir(self, name):
+        # One flat directory per workspace name, whatever characters it has
+        return os.path.join(self.root, "manifests", quote(name, safe="").replace(".", "%2E"))
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def _ids(self, name):
+        try:
+            names = os.listdir(self._manifest_dir(name))
+        except FileNotFoundError:
+            return []
+        # Ids are timestamps, so they sort oldest first
+        return sorted(n[: -len(".json")] for n in names if n.endswith(".json"))
+
+    def _load(self, name, snapshot_id):
+        if not _SNAPSHOT_ID.fullmatch(snapshot_id):
+            raise SnapshotError(f"Invalid snapshot id: {snapshot_id}")
+        path = os.path.join(self._manifest_dir(name), snapshot_id + ".json")
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise SnapshotError(f"No snapshot {snapshot_id}")
+
+    def _store_blob(self, path):
+        # Returns (digest, whether the blob is new)
+        digest = _hash_file(path)
+        if os.path.exists(self._blob_path(digest)):
+            return digest, False
+        os.makedirs(self.blob_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".blob.", dir=self.blob_dir)
+        try:
+            # Hashed again while copying, so a file that changed since it
+            # was hashed is stored under the hash of what was copied
+            copied = hashlib.sha256()
+            with open(path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                for chunk in iter(lambda: src.read(_CHUNK_BYTES), b""):
+                    copied.update(chunk)
+                    dst.write(chunk)
+            digest = copied.hexdigest()
+            os.chmod(temp_path, 0o444)
+            blob = self._blob_path(digest)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            # A link, unlike a rename, never replaces a blob that a
+            # concurrent checkpoint stored first
+            try:
+                os.link(temp_path, blob)
+                return digest, True
+            except FileExistsError:
+                return digest, False
+        finally:
+            os.remove(temp_path)
+
+    def checkpoint(self, workspace, name, label=None):
+        # Snapshots the directory workspace under name; returns a summary
+        # with the new snapshot's id. A workspace that does not exist yet
+        # gives an empty snapshot, which restores to an empty directory.
+        with SNAPSHOT_SECONDS.time(op="checkpoint"), self._lock(name):
+            with self.pin_blobs():
+                summary, ids = self._checkpoint(workspace, name, label)
+            if self.keep and len(ids) > self.keep:
+                self._prune(name, ids[: len(ids) - self.keep])
+            return summary
+
+    def _checkpoint(self, workspace, name, label):
+        # Returns the summary and the ids of all snapshots of name
+        ids = self._ids(name)
+        previous = self._load(name, ids[-1]) if ids else {"files": {}, "created_ns": 0}
+        # Files modified within the mtime granularity of the previous
+        # checkpoint may have changed without their mtime changing
+        trusted_before = previous["created_ns"] - RACY_MTIME_NS
+        created_ns = time.time_ns()
+        files, links, dirs = {}, {}, []
+        hashed = reused = new_blobs = total_bytes = 0
+        for path, entry in _walk(workspace, self.root) if os.path.isdir(workspace) else ():
+            if entry.is_symlink():
+                links[path] = os.readlink(entry.path)
+            elif entry.is_dir():
+                dirs.append(path)
+            elif entry.is_file():
+                st = entry.stat(follow_symlinks=False)
+                known = previous["files"].get(path)
+                if (
+                    known is not None
+                    and known[1:4] == [st.st_size, st.st_mtime_ns, st.st_ino]
+                    and st.st_mtime_ns < trusted_before
+                ):
+                    digest = known[0]
+                    reused += 1
+                else:
+                    digest, is_new = self._store_blob(entry.path)
+                    hashed += 1
+                    new_blobs += is_new
+                files[path] = [digest, st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode & 0o7777]
+                total_bytes += st.st_size
+        # UTC, so ids keep sorting by creation time across DST changes
+        snapshot_id = time.strftime("%Y%m%d-%H%M%S", time.gmtime(created_ns / 1e9))
+        snapshot_id += f"-{created_ns // 1000 % 1_000_000:06d}"
+        manifest = {
+            "id": snapshot_id,
+            "label": label,
+            "created_ns": created_ns,
+            "files": files,
+            "links": links,
+            "dirs": sorted(dirs),
+        }
+        os.makedirs(self._manifest_dir(name), exist_ok=True)
+        atomic_write(
+            os.path.join(self._manifest_dir(name), snapshot_id + ".json"), json.dumps(manifest)
+        )
+        SNAPSHOT_FILES.inc(hashed, action="hashed")
+        SNAPSHOT_FILES.inc(reused, action="reused")
+        summary = {
+            "id": snapshot_id,
+            "label": label,
+            "files": len(files),
+            "bytes": total_bytes,
+            "hashed": hashed,
+            "new_blobs": new_blobs,
+        }
+        return summary, ids + [snapshot_id]
+
+    def _digests(self, name, snapshot_id):
+        return {record[0] for record in self._load(name, snapshot_id)["files"].values()}
+
+    def _prune(self, name, snapshot_ids):
+        dropped = set()
+        for snapshot_id in snapshot_ids:
+            dropped |= self._digests(name, snapshot_id)
+            os.remove(os.path.join(self._manifest_dir(name), snapshot_id + ".json"))
+        # Most blobs of a pruned snapshot are still in the ones kept, newest
+        # first being the likeliest, and only the rest can have become garbage
+        for snapshot_id in reversed(self._ids(name)):
+            if not dropped:
+                return
+            dropped -= self._digests(name, snapshot_id)
+        if dropped:
+            self.collect_garbage(dropped)
+
+    def collect_garbage(self, candidates=None):
+        # Removes the blobs no snapshot of any workspace refers to, checking
+        # only those in candidates if given
+        self._gc_lock.acquire_write()
+        try:
+            return self._collect_garbage(candidates)
+        finally:
+            self._gc_lock.release_write()
+
+    def _collect_garbage(self, candidates):
+        referenced = set()
+        manifests = os.path.join(self.root, "manifests")
+        for path, entry in _walk(manifests) if os.path.isdir(manifests) else ():
+            if entry.is_file() and entry.name.endswith(".json"):
+                with open(entry.path) as f:
+                    manifest = json.load(f)
+                referenced.update(record[0] for record in manifest["files"].values())
+        removed = 0
+        if candidates is not None:
+            for digest in candidates - referenced:
+                try:
+                    os.remove(self._blob_path(digest))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+            return removed
+        for path, entry in _walk(self.blob_dir) if os.path.isdir(self.blob_dir) else ():
+            # A blob being stored right now has a temporary name
+            if entry.is_file() and not entry.name.startswith(".") and entry.name not in referenced:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    def list(self, name):
+        snapshots = []
+        for snapshot_id in self._ids(name):
+            manifest = self._load(name, snapshot_id)
+            snapshots.append(
+                {
+                    "id": snapshot_id,
+                    "label": manifest["label"],
+                    "created": manifest["created_ns"] / 1e9,
+                    "files": len(manifest["files"]),
+                    "bytes": sum(record[1] for record in manifest["files"].values()),
+                }
+            )
+        return snapshots
+
+    def plan_restore(self, workspace, name, snapshot_id=None):
+        # The changes that bring workspace back to the snapshot, by default
+        # the latest. Hold pin_blobs() from planning until the plan is applied.
+        if snapshot_id is None:
+            ids = self._ids(name)
+            if not ids:
+                raise SnapshotError(f"No snapshots of {name}")
+            snapshot_id = ids[-1]
+        manifest = self._load(name, snapshot_id)
+        files, links, dirs = manifest["files"], manifest["links"], set(manifest["dirs"])
+        trusted_before = manifest["created_ns"] - RACY_MTIME_NS
+        plan = RestorePlan(snapshot_id, workspace)
+        current = set()
+        if os.path.isdir(workspace):
+            entries = _walk(workspace, self.root)
+        else:
+            entries = ()
+            plan.make_dirs.append("")
+        for path, entry in entries:
+            current.add(path)
+            if entry.is_symlink():
+                if links.get(path) == os.readlink(entry.path):
+                    continue
+                plan.remove_files.append(path)
+            elif entry.is_dir():
+                if path in dirs:
+                    continue
+                plan.remove_dirs.append(path)
+            elif path in files and entry.is_file():
+                record = files[path]
+                st = entry.stat(follow_symlinks=False)
+                unchanged = (
+                    [st.st_size, st.st_mtime_ns, st.st_ino] == record[1:4]
+                    and st.st_mtime_ns < trusted_before
+                ) or (st.st_size == record[1] and _hash_file(entry.path) == record[0])
+                if not unchanged:
+                    plan.write.append((path, record[0], record[4]))
+                elif st.st_mode & 0o7777 != record[4]:
+                    plan.chmods.append((path, record[4]))
+                continue
+            elif path in files or entry.is_file():
+                plan.remove_files.append(path)
+            else:
+                # Sockets and the like are neither snapshotted nor removed
+                continue
+            # Whatever is in the way of the snapshot's entry at this path
+            # goes, and the entry is created below
+            current.discard(path)
+        plan.make_dirs.extend(sorted(path for path in dirs if path not in current))
+        for path, record in files.items():
+            if path not in current:
+                plan.write.append((path, record[0], record[4]))
+        plan.links = [(path, target) for path, target in links.items() if path not in current]
+        for _, digest, _ in plan.write:
+            if not os.path.exists(self._blob_path(digest)):
+                raise SnapshotError(f"Snapshot {snapshot_id} refers to a missing blob {digest}")
+        # Deepest first, so each directory is empty by the time it goes
+        plan.remove_dirs.sort(reverse=True)
+        return plan
+
+    def apply(self, plan):
+        with SNAPSHOT_SECONDS.time(op="restore"):
+            root = plan.root
+            for path in plan.remove_files:
+                os.remove(os.path.join(root, path))
+            for path in plan.remove_dirs:
+                # Anything the plan did not know about, created since it was
+                # made, goes too
+                shutil.rmtree(os.path.join(root, path), ignore_errors=True)
+            for path in plan.make_dirs:
+                os.makedirs(os.path.join(root, path), exist_ok=True)
+            for path, digest, mode in plan.write:
+                target = os.path.join(root, path)
+                # Copied rather than linked: a command appending to the file
+                # in place would otherwise change the blob, and every snapshot
+                # holding it, too
+                fd, temp_path = tempfile.mkstemp(
+                    prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(target)
+                )
+                os.close(fd)
+                try:
+                    shutil.copyfile(self._blob_path(digest), temp_path)
+                    os.chmod(temp_path, mode)
+                    os.replace(temp_path, target)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+            for path, target in plan.links:
+                os.symlink(target, os.path.join(root, path))
+            for path, mode in plan.chmods:
+                os.chmod(os.path.join(root, path), mode)
+            SNAPSHOT_FILES.inc(len(plan.write), action="written")
+            SNAPSHOT_FILES.inc(len(plan.remove_files), action="deleted")
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_snapshot_store(root=SNAPSHOT_ROOT):
+    # One store per root, shared by every TextEditTools instance so their
+    # checkpoints and garbage collection see each other's locks
+    root = os.path.abspath(root)
+    with _stores_lock:
+        store = _stores.get(root)
+        if store is None:
+            store = SnapshotStore(root)
+            _stores[root] = store
+        return store
@@ -0,0 +1,42 @@
+def find_matches(text, needle, limit=None):
+    # Returns (offset, line_number) for every occurrence of needle in text,
+    # including overlapping ones, in a single left-to-right pass. Line numbers
+    # are 1-based and counted incrementally between matches.
+    matches = []
+    line_number = 1
+    last_offset = 0
+    pos = text.find(needle)
+    while pos != -1:
+        line_number += text.count("\n", last_offset, pos)
+        last_offset = pos
+        matches.append((pos, line_number))
+        if limit is not None and len(matches) >= limit:
+            break
+        pos = text.find(needle, pos + 1)
+    return matches
+
+
+def count_matches(text, needle, start=0):
+    # Occurrences of needle in text from start on, counted the way
+    # find_matches finds them, overlapping ones included
+    count = 0
+    pos = text.find(needle, start)
+    while pos != -1:
+        count += 1
+        pos = text.find(needle, pos + 1)
+    return count
+
+
+MAX_LISTED_MATCHES = 10
+
+
+def format_match_lines(matches, total=None, max_listed=MAX_LISTED_MATCHES):
+    # The lines of the first max_listed matches, each line listed once, and
+    # how many matches were left out; total is the number of matches when
+    # matches holds only the first of them
+    listed = matches[:max_listed]
+    lines = [str(line_number) for line_number in dict.fromkeys(line for _, line in listed)]
+    total = len(matches) if total is None else total
+    if total > len(listed):
+        lines.append(f"... ({total - len(listed)} more)")
+    return ", ".join(lines)
@@ -1,5 +1,5 @@
 import os
-from text_edit_tools import TextEditTools
+from tools.text_edit_tools import TextEditTools
 
 # Initialize with a test directory
 tools = TextEditTools('test_dir')
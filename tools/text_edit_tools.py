@@ -1,14 +1,75 @@
+import contextlib
+import io
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from tools.content_cache import CachedContent, ContentCache
+from tools.dir_index import get_directory_index
+from tools.edit_history import EditHistory
+from tools.file_locks import DEFAULT_FSYNC_POLICY, PathLocks, atomic_write
+from tools.line_index import LineIndexCache
+from tools.metrics import FILE_BYTES
+from tools.outline import OutlineCache, format_outline
+from tools.patch import PatchError, apply_hunks, changed_span, parse_unified_diff
+from tools.search_index import DEFAULT_MAX_RESULTS, MAX_SNIPPET_CHARS, get_search_index
+from tools.snapshots import SnapshotError, get_snapshot_store
+from tools.str_match import MAX_LISTED_MATCHES, count_matches, find_matches, format_match_lines
+
+# Characters of output shared by all the files of one view_many call
+DEFAULT_VIEW_MANY_BUDGET = 64_000
+MAX_VIEW_MANY_FILES = 50
+# Shared by all instances; views are short and mostly served from the cache
+_view_pool = ThreadPoolExecutor(max_workers=8)
+
+
+def _fair_shares(lengths, budget):
+    # Max-min fair split of budget: files that need less than an equal share
+    # get all they need, and what they leave is split among the rest
+    shares = [0] * len(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    for position, i in enumerate(order):
+        shares[i] = min(lengths[i], remaining // (len(order) - position))
+        remaining -= shares[i]
+    return shares
 
 
 class TextEditTools:
-    def __init__(self, directory):
+    def __init__(
+        self,
+        directory,
+        history=None,
+        spill_history=False,
+        fsync=DEFAULT_FSYNC_POLICY,
+        ignore_names=None,
+    ):
         self.directory = directory
-        self.file_histories = {}
+        self.fsync = fsync
+        if history is None:
+            spill_dir = None
+            if spill_history:
+                spill_dir = os.path.join("work_dir", ".history", directory)
+            history = EditHistory(spill_dir=spill_dir)
+        self.file_histories = history
+        # Names left out of listings and searches; None for the defaults
+        self.dir_index = get_directory_index(
+            os.path.join("work_dir", directory), ignore_names=ignore_names
+        )
+        self.line_indexes = LineIndexCache()
+        self.search_index = get_search_index(self.dir_index)
+        self.outlines = OutlineCache()
+        self.contents = ContentCache()
+        # Views of a file share its read lock; edits, which read, write and
+        # record history in one step, take its write lock
+        self.locks = PathLocks()
+        self.snapshots = get_snapshot_store()
 
     def _normalize_path(self, path):
         clean_path = path.replace("/repo/", "/", 1)
-        return os.path.join("work_dir", self.directory, clean_path.lstrip("/"))
+        # Normalized, so every spelling of a path shares its lock and cache
+        # entries
+        return os.path.normpath(os.path.join("work_dir", self.directory, clean_path.lstrip("/")))
 
     def _is_path_allowed(self, path):
         work_dir = os.path.join(os.getcwd(), "work_dir", self.directory)
@@ -17,31 +78,40 @@ class TextEditTools:
 
     def _denormalize_path(self, path):
         work_dir_prefix = os.path.join("work_dir", self.directory)
+        if path == work_dir_prefix:
+            return "/repo/"
         return "/repo/" + path.replace(work_dir_prefix + os.sep, "", 1)
 
+    def _write_file(self, path, content):
+        FILE_BYTES.inc(atomic_write(path, content, self.fsync), direction="write")
+        self.line_indexes.invalidate(path)
+        self.outlines.invalidate(path)
+        self.contents.put(path, content)
+        self.search_index.update(path)
+
     def view(self, path, view_range=None, truncate_length=None):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
         if os.path.isfile(path):
-            with open(path, "r") as f:
-                lines = f.readlines()
+            start_line = 0
+            end_line = -1
             if view_range:
-                start_line = view_range[0] - 1
+                start_line = max(view_range[0] - 1, 0)
                 end_line = view_range[1]
-                if end_line == -1:
-                    end_line = len(lines)
-                lines = lines[start_line:end_line]
-                line_offset = start_line
-            else:
-                line_offset = 0
-            numbered_lines = [
-                "{:>6}\t{}".format(idx + line_offset + 1, line)
-                for idx, line in enumerate(lines)
-            ]
-            output = "".join(numbered_lines)
+            with self.locks.read(path):
+                try:
+                    cached = self.contents.get(path)
+                    if cached is not None:
+                        output = self._numbered_lines(cached, start_line, end_line, truncate_length)
+                    else:
+                        output = self._read_numbered_lines(
+                            path, start_line, end_line, truncate_length
+                        )
+                except FileNotFoundError:
+                    output = "Error: Path does not exist"
         elif os.path.isdir(path):
-            output = self.list_directory(path, depth=2)
+            output = self.list_directory(self._denormalize_path(path), depth=2)
         else:
             output = f"Error: Path does not exist"
 
@@ -49,121 +119,425 @@ class TextEditTools:
             output = output[:truncate_length] + "\n<response clipped>"
         return output
 
-    def list_directory(self, path, depth):
+    def view_many(self, files, truncate_length=None):
+        # files is a list of {"path": ..., "view_range": [start, end]}. The
+        # files are read concurrently and the output budget is shared between
+        # them, so one large file cannot crowd out the rest. An error for one
+        # file is reported in its place.
+        if not files:
+            return "Error: No files given"
+        if len(files) > MAX_VIEW_MANY_FILES:
+            return f"Error: At most {MAX_VIEW_MANY_FILES} files can be viewed at once"
+        budget = truncate_length or DEFAULT_VIEW_MANY_BUDGET
+
+        def view_one(spec):
+            if not isinstance(spec, dict) or not isinstance(spec.get("path"), str):
+                return "Error: Each file needs a path"
+            view_range = spec.get("view_range")
+            if view_range is not None and (not isinstance(view_range, list) or len(view_range) != 2):
+                return "Error: view_range must be [start_line, end_line]"
+            try:
+                # Nothing beyond the whole budget can be shown anyway
+                return self.view(spec["path"], view_range, budget)
+            except Exception as e:
+                return f"Error: {e}"
+
+        outputs = list(_view_pool.map(view_one, files))
+        shares = _fair_shares([len(output) for output in outputs], budget)
+        sections = []
+        for spec, output, share in zip(files, outputs, shares):
+            if not isinstance(spec, dict):
+                spec = {}
+            header = f"==> {spec.get('path')}"
+            if spec.get("view_range"):
+                header += f" {spec['view_range']}"
+            if len(output) > share:
+                # At a line boundary where there is one, so no line is cut short
+                cut = output.rfind("\n", 0, share) + 1
+                output = output[: cut or share] + "<response clipped>"
+            sections.append(f"{header} <==\n{output}")
+        return "\n".join(sections)
+
+    def _read_content(self, path):
+        # The file's content, from the cache unless it is too large for it
+        cached = self.contents.get(path)
+        if cached is None:
+            with open(path, "r", newline="") as f:
+                cached = CachedContent(None, f.read())
+            FILE_BYTES.inc(os.path.getsize(path), direction="read")
+        return cached
+
+    def _numbered_lines(self, cached, start_line, end_line, limit=None):
+        line_count = cached.line_count()
+        if end_line == -1:
+            end_line = line_count
+        elif end_line < 0:
+            end_line = line_count + end_line
+        pieces = []
+        length = 0
+        for line_number, line in enumerate(cached.lines(start_line, end_line), start_line + 1):
+            piece = "{:>6}\t{}".format(line_number, line)
+            pieces.append(piece)
+            length += len(piece)
+            if limit and length > limit:
+                break
+        return "".join(pieces)
+
+    def _read_numbered_lines(self, path, start_line, end_line, limit=None):
+        # Seeks straight to start_line through the file's line index and
+        # stops reading at end_line, or as soon as the output exceeds limit.
+        index = self.line_indexes.get(path)
+        with open(path, "rb") as raw:
+            if end_line == -1:
+                end_line = None
+            elif end_line < 0:
+                end_line = index.line_count(raw) + end_line
+            offset = index.offset(raw, start_line)
+            if offset is None or (end_line is not None and end_line <= start_line):
+                return ""
+            raw.seek(offset)
+            pieces = []
+            length = 0
+            with io.TextIOWrapper(raw) as f:
+                for line_number, line in enumerate(f, start_line + 1):
+                    if end_line is not None and line_number > end_line:
+                        break
+                    piece = "{:>6}\t{}".format(line_number, line)
+                    pieces.append(piece)
+                    length += len(piece)
+                    if limit and length > limit:
+                        break
+                FILE_BYTES.inc(raw.tell() - offset, direction="read")
+        return "".join(pieces)
+
+    def outline(self, path):
+        # Classes, functions and methods with their line ranges, so that a
+        # large file can be viewed one symbol at a time
+        path = self._normalize_path(path)
+        if not self._is_path_allowed(path):
+            return "Error: Invalid path"
+        if os.path.isdir(path):
+            return "Error: Path is a directory; outline needs a file"
+        if not os.path.isfile(path):
+            return "Error: Path does not exist"
+        with self.locks.read(path):
+            try:
+                symbols = self.outlines.get(path)
+            except ValueError:
+                return "Error: Outlines are only supported for Python, JavaScript and TypeScript files"
+            except SyntaxError as e:
+                return f"Error: Could not parse file: {e.msg} (line {e.lineno})"
+            with open(path, "rb") as f:
+                line_count = self.line_indexes.get(path).line_count(f)
+        header = f"{self._denormalize_path(path)} ({line_count} lines)"
+        if not symbols:
+            return header + "\nNo classes or functions found"
+        return header + "\n" + format_outline(symbols)
+
+    def list_directory(self, path, depth, max_entries=None):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
-        result = []
-        work_dir_prefix = os.path.join(os.getcwd(), "work_dir", self.directory) + os.sep
         if not os.path.exists(path):
-            os.makedirs(path)
-
-        def helper(current_path, current_depth):
-            if current_depth > depth:
-                return
-            for item in os.listdir(current_path):
-                if not item.startswith("."):
-                    full_path = os.path.join(current_path, item)
-                    relative_path = "/repo/" + full_path[len(work_dir_prefix) :]
-                    result.append(relative_path)
-                    if os.path.isdir(full_path):
-                        helper(full_path, current_depth + 1)
-
-        helper(path, 1)
+            os.makedirs(path, exist_ok=True)
+
+        work_dir_prefix = self.dir_index.root + os.sep
+        paths, omitted = self.dir_index.list(path, depth, max_entries)
+        result = ["/repo/" + full_path[len(work_dir_prefix) :] for full_path in paths]
+        if omitted:
+            total = sum(omitted.values())
+            details = ", ".join(
+                f"/repo/{group[len(work_dir_prefix) :]} ({count})"
+                for group, count in sorted(omitted.items(), key=lambda item: -item[1])[:10]
+            )
+            result.append(f"... {total} more entries omitted: {details}")
         return "\n".join(result)
 
     def create(self, path, file_text):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
-        if os.path.exists(path):
-            if os.path.isfile(path):
-                return "Error: File already exists: " + self._denormalize_path(path)
+        with self.locks.write(path):
+            if os.path.exists(path):
+                if os.path.isfile(path):
+                    return "Error: File already exists: " + self._denormalize_path(path)
+                else:
+                    return "Error: Path exists and is not a file"
             else:
-                return "Error: Path exists and is not a file"
-        else:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, "w") as f:
-                f.write(file_text)
-            self.file_histories[path] = [file_text]
-            return f"File created at {self._denormalize_path(path)}"
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._write_file(path, file_text)
+                self.file_histories.reset(path, file_text)
+                return f"File created at {self._denormalize_path(path)}"
 
     def str_replace(self, path, old_str, new_str):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
-        if not os.path.isfile(path):
-            return "Error: File does not exist ", path
-
-        with open(path, "r") as f:
-            lines = f.readlines()
-        old_lines = old_str.splitlines(keepends=True)
-        new_lines = new_str.splitlines(keepends=True)
-
-        matches = []
-        for i in range(len(lines) - len(old_lines) + 1):
-            if lines[i : i + len(old_lines)] == old_lines:
-                matches.append(i)
-
-        if len(matches) == 0:
-            return "Error: old_str not found in file"
-        elif len(matches) > 1:
-            return "Error: old_str is not unique in file"
-        else:
-            idx = matches[0]
-            new_content_lines = lines[:idx] + new_lines + lines[idx + len(old_lines) :]
-            new_content = "".join(new_content_lines)
-            if path in self.file_histories:
-                self.file_histories[path].append("".join(lines))
+        with self.locks.write(path):
+            if not os.path.isfile(path):
+                return "Error: File does not exist ", path
+
+            if not old_str:
+                return "Error: old_str must not be empty"
+
+            content = self._read_content(path).text
+
+            # Only as many matches as the error message lists; the rest are
+            # just counted
+            matches = find_matches(content, old_str, limit=MAX_LISTED_MATCHES + 1)
+
+            if len(matches) == 0:
+                return "Error: old_str not found in file"
+            elif len(matches) > 1:
+                total = len(matches)
+                if total > MAX_LISTED_MATCHES:
+                    total = MAX_LISTED_MATCHES + count_matches(
+                        content, old_str, matches[MAX_LISTED_MATCHES - 1][0] + 1
+                    )
+                return (
+                    "Error: old_str is not unique in file (found at lines "
+                    + format_match_lines(matches, total)
+                    + ")"
+                )
             else:
-                self.file_histories[path] = ["".join(lines)]
-            with open(path, "w") as f:
-                f.write(new_content)
-            return f"Replaced text in {self._denormalize_path(path)}"
+                idx = matches[0][0]
+                new_content = content[:idx] + new_str + content[idx + len(old_str) :]
+                self._write_file(path, new_content)
+                self.file_histories.record(path, new_content, idx, len(new_str), old_str)
+                return f"Replaced text in {self._denormalize_path(path)}"
 
     def insert(self, path, insert_line, new_str):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
-        if not os.path.isfile(path):
-            return "Error: File does not exist ", path
-
-        with open(path, "r") as f:
-            lines = f.readlines()
-        if insert_line < 1 or insert_line > len(lines):
-            return "Error: insert_line is out of range"
-
-        insert_idx = insert_line
-        new_lines = new_str.splitlines(keepends=True)
-        new_content_lines = lines[:insert_idx] + new_lines + lines[insert_idx:]
-        new_content = "".join(new_content_lines)
-        if path in self.file_histories:
-            self.file_histories[path].append("".join(lines))
-        else:
-            self.file_histories[path] = ["".join(lines)]
-        with open(path, "w") as f:
-            f.write(new_content)
-        return f"Inserted text into {self._denormalize_path(path)} after line {insert_line}"
+        with self.locks.write(path):
+            if not os.path.isfile(path):
+                return "Error: File does not exist ", path
+
+            cached = self._read_content(path)
+            line_count = cached.line_count()
+            if insert_line < 1 or insert_line > line_count:
+                return "Error: insert_line is out of range"
+
+            content = cached.text
+            if insert_line < line_count:
+                insert_offset = cached.starts[insert_line]
+            else:
+                insert_offset = len(content)
+            new_content = content[:insert_offset] + new_str + content[insert_offset:]
+            self._write_file(path, new_content)
+            self.file_histories.record(path, new_content, insert_offset, len(new_str), "")
+            return f"Inserted text into {self._denormalize_path(path)} after line {insert_line}"
 
     def undo_edit(self, path):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path"
-        if path not in self.file_histories or len(self.file_histories[path]) == 0:
-            return "No edits to undo"
-        else:
-            last_content = self.file_histories[path].pop()
-            with open(path, "w") as f:
-                f.write(last_content)
-            return f"Last edit to {self._denormalize_path(path)} has been undone"
+        with self.locks.write(path):
+            if path not in self.file_histories:
+                return "No edits to undo"
+            elif not os.path.isfile(path):
+                return "Error: File does not exist"
+            else:
+                # Without newline translation, so the content matches exactly
+                # what the last edit wrote
+                current_content = self._read_content(path).raw
+                try:
+                    last_content = self.file_histories.undo(path, current_content)
+                except ValueError:
+                    return "Error: File was modified outside the editor since the last edit; cannot undo"
+                self._write_file(path, last_content)
+                return f"Last edit to {self._denormalize_path(path)} has been undone"
 
     def delete(self, path):
         path = self._normalize_path(path)
         if not self._is_path_allowed(path):
             return "Error: Invalid path ", path
+        with self.locks.write(path):
+            if not os.path.exists(path):
+                return "Error: File does not exist ", path
+            if os.path.isdir(path):
+                return "Error: Cannot delete directories"
+            os.remove(path)
+            self.line_indexes.invalidate(path)
+            self.outlines.invalidate(path)
+            self.contents.invalidate(path)
+            self.search_index.remove(path)
+            return f"Deleted file {self._denormalize_path(path)}"
+
+    def apply_patch(self, patch):
+        try:
+            file_patches = parse_unified_diff(patch)
+        except PatchError as e:
+            return f"Error: Invalid patch: {e}"
+        targets = {}
+        for file_patch in file_patches:
+            old_path, new_path = file_patch.old_path, file_patch.new_path
+            if old_path and new_path and old_path != new_path:
+                return f"Error: Renames are not supported: {old_path} -> {new_path}"
+            path = self._normalize_path(file_patch.path)
+            if not self._is_path_allowed(path):
+                return f"Error: Invalid path: {file_patch.path}"
+            if path in targets:
+                return f"Error: Patch touches {self._denormalize_path(path)} more than once"
+            targets[path] = file_patch
+
+        with contextlib.ExitStack() as stack:
+            # Sorted, so two patches touching the same files cannot deadlock
+            for path in sorted(targets):
+                stack.enter_context(self.locks.write(path))
+
+            # Everything is applied in memory first; nothing is written unless
+            # every hunk of every file applies
+            planned = []
+            for path, file_patch in targets.items():
+                shown = self._denormalize_path(path)
+                if file_patch.is_new:
+                    if os.path.exists(path):
+                        return f"Error: Patch not applied, nothing was changed: {shown} exists"
+                    old_content = ""
+                elif not os.path.isfile(path):
+                    return f"Error: Patch not applied, nothing was changed: {shown} does not exist"
+                else:
+                    old_content = self._read_content(path).text
+                try:
+                    new_content, notes = apply_hunks(old_content, file_patch.hunks)
+                except PatchError as e:
+                    return f"Error: Patch not applied, nothing was changed: {shown}: {e}"
+                if file_patch.is_delete and new_content:
+                    return (
+                        f"Error: Patch not applied, nothing was changed: {shown}: "
+                        "deletion does not remove the whole file"
+                    )
+                planned.append((path, file_patch, old_content, new_content, notes))
+
+            written = []
+            try:
+                for path, file_patch, old_content, new_content, _ in planned:
+                    if file_patch.is_delete:
+                        os.remove(path)
+                        self.line_indexes.invalidate(path)
+                        self.outlines.invalidate(path)
+                        self.contents.invalidate(path)
+                        self.search_index.remove(path)
+                    else:
+                        if file_patch.is_new:
+                            os.makedirs(os.path.dirname(path), exist_ok=True)
+                        self._write_file(path, new_content)
+                    written.append((path, file_patch, old_content))
+            except OSError as e:
+                # Put back the files already written so the patch is all or nothing
+                for path, file_patch, old_content in written:
+                    if file_patch.is_new:
+                        os.remove(path)
+                        self.contents.invalidate(path)
+                        self.search_index.remove(path)
+                    else:
+                        self._write_file(path, old_content)
+                return f"Error: Patch not applied, nothing was changed: {e}"
+
+            result = []
+            for path, file_patch, old_content, new_content, notes in planned:
+                shown = self._denormalize_path(path)
+                if file_patch.is_delete:
+                    result.append(f"{shown}: deleted")
+                    continue
+                if file_patch.is_new:
+                    self.file_histories.reset(path, new_content)
+                    result.append(f"{shown}: created")
+                    continue
+                # One undo entry covering the span between the unchanged
+                # prefix and suffix, so undo_edit reverts the whole patch
+                prefix, suffix = changed_span(old_content, new_content)
+                self.file_histories.record(
+                    path,
+                    new_content,
+                    prefix,
+                    len(new_content) - prefix - suffix,
+                    old_content[prefix : len(old_content) - suffix],
+                )
+                hunks = len(file_patch.hunks)
+                line = f"{shown}: {hunks} hunk{'s' if hunks != 1 else ''} applied"
+                if notes:
+                    line += " (" + "; ".join(notes) + ")"
+                result.append(line)
+            return "Patch applied:\n" + "\n".join(result)
+
+    def checkpoint(self, label=None):
+        # Snapshots the whole workspace, including changes made outside the
+        # editor; returns a summary with the snapshot's id
+        try:
+            return self.snapshots.checkpoint(
+                os.path.join("work_dir", self.directory), self.directory, label
+            )
+        except (SnapshotError, OSError) as e:
+            return f"Error: Checkpoint failed: {e}"
+
+    def list_snapshots(self):
+        return self.snapshots.list(self.directory)
+
+    def restore(self, snapshot_id=None):
+        # Brings the workspace back to a snapshot, by default the latest.
+        # Undo history of the files it rewrites no longer applies and is
+        # dropped.
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(self.snapshots.pin_blobs())
+            try:
+                plan = self.snapshots.plan_restore(
+                    os.path.join("work_dir", self.directory), self.directory, snapshot_id
+                )
+            except (SnapshotError, OSError) as e:
+                return f"Error: Restore failed: {e}"
+            paths = plan.paths()
+            for path in sorted(paths):
+                stack.enter_context(self.locks.write(path))
+            try:
+                self.snapshots.apply(plan)
+            except OSError as e:
+                return f"Error: Restore of {plan.snapshot_id} stopped partway: {e}"
+            finally:
+                for path in paths:
+                    self.line_indexes.invalidate(path)
+                    self.outlines.invalidate(path)
+                    self.contents.invalidate(path)
+                    self.search_index.remove(path)
+                    self.file_histories.clear(path)
+                for path, _, _ in plan.write:
+                    self.search_index.update(os.path.join(plan.root, path))
+                self.dir_index.invalidate()
+        return (
+            f"Restored snapshot {plan.snapshot_id}: {len(plan.write)} files written, "
+            f"{len(plan.remove_files)} deleted"
+        )
+
+    def search(self, query, path="/repo/", regex=False, ignore_case=False, max_results=None):
+        path = self._normalize_path(path)
+        if not self._is_path_allowed(path):
+            return "Error: Invalid path"
         if not os.path.exists(path):
-            return "Error: File does not exist ", path
-        if os.path.isdir(path):
-            return "Error: Cannot delete directories"
-        os.remove(path)
-        return f"Deleted file {self._denormalize_path(path)}"
+            return "Error: Path does not exist"
+        if not os.path.isdir(path):
+            return "Error: Path is not a directory"
+        if not query:
+            return "Error: query must not be empty"
+        if max_results is None:
+            max_results = DEFAULT_MAX_RESULTS
+        try:
+            matches, truncated = self.search_index.search(
+                path, query, regex, ignore_case, max_results
+            )
+        except re.error as e:
+            return f"Error: Invalid regex: {e}"
+        if not matches:
+            return "No matches found"
+        work_dir_prefix = self.dir_index.root + os.sep
+        result = []
+        for full_path, line_number, line in matches:
+            if len(line) > MAX_SNIPPET_CHARS:
+                line = line[:MAX_SNIPPET_CHARS] + "..."
+            result.append(f"/repo/{full_path[len(work_dir_prefix):]}:{line_number}: {line}")
+        if truncated:
+            result.append(
+                f"... showing the first {max_results} matches; narrow the query or path for more"
+            )
+        return "\n".join(result)
@@ -1,11 +1,22 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, Path
-from pydantic import BaseModel
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from fastapi import FastAPI, HTTPException, Depends, Path, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, ValidationError
 from tools.text_edit_tools import TextEditTools
+from tools.dir_index import parse_ignore_names
+from tools.file_locks import DEFAULT_FSYNC_POLICY, atomic_write
+from tools.shell_session import DEFAULT_TIMEOUT, ShellSessionManager
+from tools.metrics import CONTENT_TYPE, REGISTRY, counter, gauge, histogram
+from tools.channel import DEFAULT_SOCKET_PATH, ChannelError, ChannelServer
 import logging
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator
 from pathlib import Path as FilePath
-import subprocess
 
 app = FastAPI(
     title="Text Editor API",
@@ -24,9 +35,20 @@ class ViewRequest(BaseModel):
     truncate_length: Optional[int] = None
 
 
+class ViewSpec(BaseModel):
+    path: str
+    view_range: Optional[List[int]] = None
+
+
+class ViewManyRequest(BaseModel):
+    files: List[ViewSpec]
+    truncate_length: Optional[int] = None
+
+
 class ListDirectoryRequest(BaseModel):
     path: str
     depth: int
+    max_entries: Optional[int] = None
 
 
 class CreateRequest(BaseModel):
@@ -50,35 +72,302 @@ class PathRequest(BaseModel):
     path: str
 
 
+class SearchRequest(BaseModel):
+    query: str
+    path: str = "/repo/"
+    regex: bool = False
+    ignore_case: bool = False
+    max_results: Optional[int] = None
+
+
+class ApplyPatchRequest(BaseModel):
+    patch: str
+
+
+class CheckpointRequest(BaseModel):
+    label: Optional[str] = None
+
+
+class RestoreRequest(BaseModel):
+    # The latest snapshot when not given
+    snapshot_id: Optional[str] = None
+
+
+class EmptyRequest(BaseModel):
+    pass
+
+
 class BashCommandRequest(BaseModel):
     command: str
+    timeout: Optional[float] = None
+
+
+class BatchOperation(BaseModel):
+    op: str
+    args: Dict[str, Any] = {}
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+
+DEFAULT_MAX_INSTANCES = 64
+DEFAULT_MAX_HISTORY_BYTES = 512 * 1024 * 1024
+DEFAULT_STATE_DIR = os.path.join("work_dir", ".tools_state")
 
 
 class TextEditToolsFactory:
-    def __init__(self):
-        self._instances: Dict[str, TextEditTools] = {}
+    # Keeps the most recently used TextEditTools instances resident, at most
+    # max_instances of them and max_history_bytes of in-memory undo history
+    # in total. Least recently used instances beyond that are evicted: their
+    # history is written to state_dir and read back the next time the
+    # directory is used. Instances in use by a request are never evicted.
+
+    def __init__(
+        self,
+        fsync: str = DEFAULT_FSYNC_POLICY,
+        max_instances: int = DEFAULT_MAX_INSTANCES,
+        max_history_bytes: int = DEFAULT_MAX_HISTORY_BYTES,
+        state_dir: str = DEFAULT_STATE_DIR,
+        ignore_names: Optional[List[str]] = None,
+    ):
+        self.fsync = fsync
+        self.ignore_names = ignore_names
+        self.max_instances = max_instances
+        self.max_history_bytes = max_history_bytes
+        self.state_dir = state_dir
+        self._instances: "OrderedDict[str, TextEditTools]" = OrderedDict()
+        self._in_use: Dict[str, int] = {}
+        self.evictions = 0
+        self.rehydrations = 0
+        # Every request for a directory must get the same instance, or their
+        # file locks and histories would not see each other
+        self._lock = threading.Lock()
+
+    def _state_path(self, directory: str) -> str:
+        return os.path.join(self.state_dir, directory + ".json")
+
+    def acquire(self, directory: str) -> TextEditTools:
+        with self._lock:
+            tools = self._instances.get(directory)
+            if tools is None:
+                # Prepend work_dir to the directory path
+                work_dir_path = f"./work_dir/{directory}"
+                os.makedirs(work_dir_path, exist_ok=True)
+                tools = TextEditTools(
+                    directory=directory, fsync=self.fsync, ignore_names=self.ignore_names
+                )
+                self._rehydrate(directory, tools)
+                self._instances[directory] = tools
+            self._instances.move_to_end(directory)
+            self._in_use[directory] = self._in_use.get(directory, 0) + 1
+            self._evict()
+            return tools
+
+    def release(self, directory: str):
+        with self._lock:
+            self._in_use[directory] -= 1
+            if not self._in_use[directory]:
+                del self._in_use[directory]
+            # The request may have grown the history
+            self._evict()
+
+    def _rehydrate(self, directory: str, tools: TextEditTools):
+        state_path = self._state_path(directory)
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        tools.file_histories.restore(state)
+        os.remove(state_path)
+        self.rehydrations += 1
+        TOOLS_REHYDRATIONS.inc()
+
+    def _persist(self, directory: str, tools: TextEditTools):
+        state = tools.file_histories.to_state()
+        if state["entries"]:
+            os.makedirs(self.state_dir, exist_ok=True)
+            atomic_write(self._state_path(directory), json.dumps(state), self.fsync)
+
+    def resident_history_bytes(self) -> int:
+        return sum(tools.file_histories.memory_bytes for tools in self._instances.values())
+
+    def _evict(self):
+        history_bytes = self.resident_history_bytes()
+        for directory in list(self._instances):
+            if (
+                len(self._instances) <= self.max_instances
+                and history_bytes <= self.max_history_bytes
+            ):
+                break
+            if directory in self._in_use:
+                continue
+            tools = self._instances.pop(directory)
+            self._persist(directory, tools)
+            history_bytes -= tools.file_histories.memory_bytes
+            self.evictions += 1
+            TOOLS_EVICTIONS.inc()
+
+    def evict_all(self):
+        # Persists every idle instance, e.g. before the service exits
+        with self._lock:
+            for directory in list(self._instances):
+                if directory not in self._in_use:
+                    self._persist(directory, self._instances.pop(directory))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "resident_instances": len(self._instances),
+                "resident_history_bytes": self.resident_history_bytes(),
+                "in_use_instances": len(self._in_use),
+                "evictions": self.evictions,
+                "rehydrations": self.rehydrations,
+            }
+
+    def content_cache_stats(self) -> Dict[str, int]:
+        # Summed over the resident instances
+        with self._lock:
+            instances = list(self._instances.values())
+        totals = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0}
+        for tools in instances:
+            for name, value in tools.contents.stats().items():
+                totals[name] += value
+        return totals
+
+
+# TEXT_EDITOR_FSYNC is never, file or full; see tools.file_locks
+tools_factory = TextEditToolsFactory(
+    fsync=os.environ.get("TEXT_EDITOR_FSYNC", DEFAULT_FSYNC_POLICY),
+    max_instances=int(os.environ.get("TEXT_EDITOR_MAX_INSTANCES", DEFAULT_MAX_INSTANCES)),
+    max_history_bytes=int(
+        os.environ.get("TEXT_EDITOR_MAX_HISTORY_BYTES", DEFAULT_MAX_HISTORY_BYTES)
+    ),
+    # TEXT_EDITOR_IGNORE is a comma-separated list that replaces the default
+    # names left out of listings and searches; see tools.dir_index
+    ignore_names=parse_ignore_names(os.environ.get("TEXT_EDITOR_IGNORE")),
+)
+# One persistent shell per workspace, see tools.shell_session
+bash_sessions = ShellSessionManager()
 
-    def get_tools(self, directory: str) -> TextEditTools:
-        if directory not in self._instances:
-            # Prepend work_dir to the directory path
-            work_dir_path = f"./work_dir/{directory}"
-            if not os.path.exists(work_dir_path):
-                os.makedirs(work_dir_path)
-            self._instances[directory] = TextEditTools(directory=directory)
-        return self._instances[directory]
+# The service root; each workspace's shell starts in its work_dir, and /repo
+# paths are rewritten to it
+BASH_CWD = "/app"
 
 
-tools_factory = TextEditToolsFactory()
+REQUEST_SECONDS = histogram(
+    "tools_service_request_duration_seconds",
+    "HTTP request latency by endpoint, up to the response headers for streams",
+    ("endpoint",),
+)
+REQUESTS = counter(
+    "tools_service_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status")
+)
+IN_FLIGHT = gauge(
+    "tools_service_requests_in_flight", "HTTP requests being handled", ("endpoint",)
+)
+# Whether called directly or as part of a batch
+OPERATION_SECONDS = histogram(
+    "text_editor_operation_duration_seconds", "Latency of each text editor operation", ("op",)
+)
+TOOLS_EVICTIONS = counter(
+    "text_editor_evictions_total", "Idle TextEditTools instances persisted and dropped from memory"
+)
+TOOLS_REHYDRATIONS = counter(
+    "text_editor_rehydrations_total", "TextEditTools instances whose undo history was reloaded"
+)
+gauge(
+    "text_editor_resident_instances",
+    "TextEditTools instances held in memory",
+    callback=lambda: tools_factory.stats()["resident_instances"],
+)
+gauge(
+    "text_editor_resident_history_bytes",
+    "Undo history held in memory across resident instances",
+    callback=lambda: tools_factory.stats()["resident_history_bytes"],
+)
+gauge(
+    "text_editor_content_cache_bytes",
+    "File contents cached across resident instances",
+    callback=lambda: tools_factory.content_cache_stats()["bytes"],
+)
+gauge(
+    "bash_sessions", "Live shell sessions", callback=lambda: bash_sessions.stats()["sessions"]
+)
+
+
+def _endpoint(path: str) -> str:
+    # /text_editor/{directory}/{op}[/stream] -> op[/stream], so the label
+    # grows neither with the number of workspaces nor with unknown paths
+    parts = path.strip("/").split("/")
+    if len(parts) >= 3 and parts[0] == "text_editor":
+        endpoint = "/".join(parts[2:])
+        if endpoint in _BATCH_OPERATIONS or endpoint in ("batch", "bash", "bash/stream"):
+            return endpoint
+    elif len(parts) == 1 and parts[0] in ("metrics", "stats"):
+        return parts[0]
+    return "other"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    endpoint = _endpoint(request.url.path)
+    start = time.perf_counter()
+    status = 500
+    with IN_FLIGHT.track_in_progress(endpoint=endpoint):
+        try:
+            response = await call_next(request)
+            status = response.status_code
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUEST_SECONDS.observe(elapsed, endpoint=endpoint)
+            REQUESTS.inc(endpoint=endpoint, status=status)
+            if endpoint in _BATCH_OPERATIONS or endpoint == "bash":
+                OPERATION_SECONDS.observe(elapsed, op=endpoint)
+    # Lets clients tell time spent in the service from time on the network
+    response.headers["Server-Timing"] = f"app;dur={elapsed * 1000:.2f}"
+    return response
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
 
 
 async def get_tools(
     directory: str = Path(..., description="Working directory path")
-) -> TextEditTools:
+) -> AsyncIterator[TextEditTools]:
+    # Holds the instance for the whole request so it cannot be evicted
+    # while in use
     try:
-        return tools_factory.get_tools(directory)
+        tools = await run_in_threadpool(tools_factory.acquire, directory)
     except Exception as e:
         logger.error(f"Error getting tools for directory {directory}: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
+    try:
+        yield tools
+    finally:
+        await run_in_threadpool(tools_factory.release, directory)
+
+
+@app.on_event("shutdown")
+def persist_tools_state():
+    tools_factory.evict_all()
+
+
+@app.on_event("shutdown")
+async def close_shell_sessions():
+    await bash_sessions.close_all()
+
+
+@app.get("/stats")
+def stats() -> Dict[str, Any]:
+    return {
+        "tools_factory": tools_factory.stats(),
+        "content_cache": tools_factory.content_cache_stats(),
+        "shell_sessions": bash_sessions.stats(),
+    }
 
 
 @app.post(
@@ -86,7 +375,7 @@ async def get_tools(
     response_model=Dict[str, Any],
     description="View contents of a file",
 )
-async def view(
+def view(
     directory: str, request: ViewRequest, tools: TextEditTools = Depends(get_tools)
 ) -> Dict[str, Any]:
     try:
@@ -99,6 +388,27 @@ async def view(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/text_editor/{directory}/view_many")
+def view_many(
+    directory: str, request: ViewManyRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        files = [{"path": spec.path, "view_range": spec.view_range} for spec in request.files]
+        return tools.view_many(files, request.truncate_length)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/outline")
+def outline(
+    directory: str, request: PathRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.outline(request.path)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.post("/text_editor/{directory}/list_directory")
 def list_directory(
     directory: str,
@@ -106,7 +416,7 @@ def list_directory(
     tools: TextEditTools = Depends(get_tools),
 ):
     try:
-        return tools.list_directory(request.path, request.depth)
+        return tools.list_directory(request.path, request.depth, request.max_entries)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -163,29 +473,290 @@ def delete(
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@app.post("/text_editor/{directory}/apply_patch")
+def apply_patch(
+    directory: str, request: ApplyPatchRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.apply_patch(request.patch)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/checkpoint")
+def checkpoint(
+    directory: str, request: CheckpointRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.checkpoint(request.label)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/restore")
+def restore(
+    directory: str, request: RestoreRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.restore(request.snapshot_id)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/snapshots")
+def snapshots(
+    directory: str, request: EmptyRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.list_snapshots()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/search")
+def search(
+    directory: str, request: SearchRequest, tools: TextEditTools = Depends(get_tools)
+):
+    try:
+        return tools.search(
+            request.query,
+            request.path,
+            request.regex,
+            request.ignore_case,
+            request.max_results,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _prepare_bash_command(directory: str, command: str):
+    # Returns (command, rewrite, work_dir_path). The path is absolute so it
+    # stays valid after the session's shell has changed directory.
+    work_dir_path = os.path.abspath(os.path.join(BASH_CWD, "work_dir", directory))
+    os.makedirs(work_dir_path, exist_ok=True)
+    logger.info(f"Executing command '{command}' in directory {work_dir_path}")
+    # Our command may contain a path. `/repo` should map to the workspace;
+    # let's transform it first, and apply the reverse transformation to output
+    command = command.replace("/repo", work_dir_path)
+    return command, lambda text: text.replace(work_dir_path, "/repo"), work_dir_path
+
+
 @app.post("/text_editor/{directory}/bash")
 async def execute_bash_command(
     directory: str, request: BashCommandRequest
 ) -> Dict[str, Any]:
     try:
-        # Prepend work_dir to the directory path for bash commands
-        work_dir_path = f"./work_dir/{directory}"
-        if not os.path.exists(work_dir_path):
-            os.makedirs(work_dir_path)
-        logger.info(f"Executing command '{request.command}' in directory {work_dir_path}")
-        # Our command may contain a path. `/repo` should map to ./work_dir/{directory}
-        # let's transform it first
-        request.command = request.command.replace("/repo", work_dir_path)
-        result = subprocess.run(
-            request.command, shell=True, cwd="/app", capture_output=True, text=True
+        command, rewrite, work_dir_path = _prepare_bash_command(directory, request.command)
+        result = await bash_sessions.run(
+            directory,
+            command,
+            cwd=work_dir_path,
+            timeout=request.timeout or DEFAULT_TIMEOUT,
+            rewrite=rewrite,
         )
-        # and the reverse transformation for the output
-        result.stdout = result.stdout.replace(work_dir_path, "/repo")
-        return {
+        response = {
             "stdout": result.stdout,
             # "stderr": result.stderr,
             "returncode": result.returncode,
         }
+        if result.timed_out:
+            response["timed_out"] = True
+        if result.session_reset:
+            response["session_reset"] = True
+        return response
     except Exception as e:
         logger.error(f"Error executing command: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/text_editor/{directory}/bash/stream")
+async def stream_bash_command(directory: str, request: BashCommandRequest):
+    # Server-sent events: `stdout` and `stderr` events carry output as it is
+    # produced, followed by a single `exit` (or `error`) event.
+    command, rewrite, work_dir_path = _prepare_bash_command(directory, request.command)
+    # Bounded so a slow client applies backpressure to the subprocess pipes
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def on_output(name: str, text: str):
+        await queue.put((name, {"text": text}))
+
+    async def run():
+        try:
+            result = await bash_sessions.run(
+                directory,
+                command,
+                cwd=work_dir_path,
+                timeout=request.timeout or DEFAULT_TIMEOUT,
+                on_output=on_output,
+                rewrite=rewrite,
+            )
+            await queue.put(
+                (
+                    "exit",
+                    {
+                        "returncode": result.returncode,
+                        "timed_out": result.timed_out,
+                        "session_reset": result.session_reset,
+                    },
+                )
+            )
+        except Exception as e:
+            logger.error(f"Error executing command: {str(e)}")
+            await queue.put(("error", {"detail": str(e)}))
+
+    async def events():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event, data = await queue.get()
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+                if event in ("exit", "error"):
+                    break
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+_BATCH_OPERATIONS = {
+    "view": (ViewRequest, view),
+    "view_many": (ViewManyRequest, view_many),
+    "list_directory": (ListDirectoryRequest, list_directory),
+    "create": (CreateRequest, create),
+    "str_replace": (StrReplaceRequest, str_replace),
+    "insert": (InsertRequest, insert),
+    "undo_edit": (PathRequest, undo_edit),
+    "delete": (PathRequest, delete),
+    "apply_patch": (ApplyPatchRequest, apply_patch),
+    "search": (SearchRequest, search),
+    "outline": (PathRequest, outline),
+    "checkpoint": (CheckpointRequest, checkpoint),
+    "restore": (RestoreRequest, restore),
+    "snapshots": (EmptyRequest, snapshots),
+}
+
+
+# A checkpoint only reads the workspace, so it runs alongside other reads but
+# after every write sent before it
+_READ_ONLY_OPERATIONS = {
+    "view", "view_many", "list_directory", "search", "outline", "checkpoint", "snapshots"
+}
+
+
+async def _run_batch_operation(
+    directory: str, operation: BatchOperation, tools: TextEditTools
+) -> Dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        if operation.op == "bash":
+            result = await execute_bash_command(
+                directory, BashCommandRequest(**operation.args)
+            )
+        elif operation.op in _BATCH_OPERATIONS:
+            request_model, handler = _BATCH_OPERATIONS[operation.op]
+            op_request = request_model(**operation.args)
+            if asyncio.iscoroutinefunction(handler):
+                result = await handler(directory, op_request, tools)
+            else:
+                result = await run_in_threadpool(handler, directory, op_request, tools)
+        else:
+            raise HTTPException(
+                status_code=400, detail=f"Unknown operation: {operation.op}"
+            )
+        return {"result": result}
+    except HTTPException as e:
+        return {"error": e.detail}
+    except ValidationError as e:
+        return {"error": str(e)}
+    finally:
+        if operation.op in _BATCH_OPERATIONS or operation.op == "bash":
+            OPERATION_SECONDS.observe(time.perf_counter() - start, op=operation.op)
+
+
+@app.post("/text_editor/{directory}/batch")
+async def batch(
+    directory: str, request: BatchRequest, tools: TextEditTools = Depends(get_tools)
+) -> Dict[str, Any]:
+    # Runs the operations in order, except that consecutive read-only
+    # operations run concurrently. Each entry of `results` holds either the
+    # operation's usual response under "result" or an "error", so one failing
+    # operation does not abort the rest.
+    operations = request.operations
+    results = []
+    start = 0
+    while start < len(operations):
+        end = start + 1
+        if operations[start].op in _READ_ONLY_OPERATIONS:
+            while end < len(operations) and operations[end].op in _READ_ONLY_OPERATIONS:
+                end += 1
+        results.extend(
+            await asyncio.gather(
+                *(
+                    _run_batch_operation(directory, operation, tools)
+                    for operation in operations[start:end]
+                )
+            )
+        )
+        start = end
+    return {"results": results}
+
+
+async def _channel_call(
+    tools_by_directory: Dict[str, TextEditTools], directory: str, op: str, args: Dict[str, Any]
+) -> Any:
+    # The same namespace as the HTTP routes, where the directory is one path
+    # segment
+    if not isinstance(directory, str) or directory in ("", ".", "..") or os.sep in directory:
+        raise ChannelError(f"Invalid directory: {directory!r}")
+    # A connection keeps the instance of each directory it uses until it
+    # closes, rather than acquiring it per request
+    tools = tools_by_directory.get(directory)
+    if tools is None:
+        tools = await run_in_threadpool(tools_factory.acquire, directory)
+        tools_by_directory[directory] = tools
+    if op == "batch":
+        try:
+            return await batch(directory, BatchRequest(**args), tools)
+        except ValidationError as e:
+            raise ChannelError(str(e))
+    outcome = await _run_batch_operation(directory, BatchOperation(op=op, args=args), tools)
+    if "error" in outcome:
+        raise ChannelError(outcome["error"])
+    result = outcome["result"]
+    # Every operation's result is the tool output itself
+    if op == "view":
+        return result["file"]
+    return result
+
+
+async def _release_channel_tools(tools_by_directory: Dict[str, TextEditTools]):
+    for directory in tools_by_directory:
+        await run_in_threadpool(tools_factory.release, directory)
+
+
+# The channel listens here alongside HTTP; an empty TOOLS_SERVICE_SOCKET
+# turns it off. The default lies in the work_dir volume, so an editor on the
+# host can reach a containerised service through it.
+channel_server = ChannelServer(
+    os.environ.get("TOOLS_SERVICE_SOCKET", DEFAULT_SOCKET_PATH),
+    _channel_call,
+    _release_channel_tools,
+    _READ_ONLY_OPERATIONS,
+)
+gauge(
+    "tools_service_channel_connections",
+    "Open connections to the channel socket",
+    callback=lambda: channel_server.connections,
+)
+
+
+@app.on_event("startup")
+async def start_channel():
+    if channel_server.path:
+        await channel_server.start()
+
+
+@app.on_event("shutdown")
+async def close_channel():
+    await channel_server.close()